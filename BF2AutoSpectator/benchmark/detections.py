@@ -0,0 +1,351 @@
+"""
+Benchmark the game instance manager's detectors against a corpus of labeled frames.
+
+Corpus format: one folder per resolution, each holding frames of the game window's "body" (captured at the
+resolution's window size, e.g. 1280x720 for 720p) along with a labels.json describing them:
+
+    <corpus>/720p/labels.json
+    <corpus>/720p/menu-001.png
+    ...
+
+labels.json is a list of entries, one per frame:
+
+    [
+        {"file": "menu-001.png", "labels": ["menu", "multiplayer-menu"]},
+        {"file": "spawn-001.png", "labels": ["spawn-menu"], "team": 0},
+        {"file": "eor-001.png", "labels": ["eor", "join-game-button"], "map": "dalian-plant", "size": 64},
+        {"file": "dcv-001.png", "labels": ["default-camera-view"], "map": "dalian-plant", "size": 64},
+        {"file": "message-001.png", "labels": ["game-message"], "message": "kicked"}
+    ]
+
+Labels name what is visible on the frame, using the names of the boolean detectors (see DETECTORS). A frame counts as
+negative for any detector its labels do not name. Value detectors are only checked against frames carrying the value
+(team: "team", map details: "map" and "size" on "eor" frames, game message: "message").
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import cv2
+
+from BF2AutoSpectator.common import constants
+from BF2AutoSpectator.common.capture import ReplayCaptureBackend
+from BF2AutoSpectator.common.config import Config
+from BF2AutoSpectator.common.labels import LabelMatcher
+from BF2AutoSpectator.common.ocr import OCR, create_ocr_engine
+from BF2AutoSpectator.common.platform import SimulatedPlatformBackend
+from BF2AutoSpectator.common.references import ReferenceStore
+from BF2AutoSpectator.common.utility import Window, get_resolution_window_size, invalidate_frame_cache, \
+    set_capture_backend, set_platform_backend
+from BF2AutoSpectator.game import GameInstanceManager
+
+LABELS_FILE = 'labels.json'
+RESULTS_VERSION = 1
+
+# Boolean detectors: name (= corpus label), detector and (optional) function deriving the expected result from an entry
+DETECTORS: List[Tuple[str, Callable[[GameInstanceManager], bool], Optional[Callable[[dict], bool]]]] = [
+    ('game-message', GameInstanceManager.is_game_message_visible, None),
+    ('menu', GameInstanceManager.is_in_menu, None),
+    ('multiplayer-menu', GameInstanceManager.is_multiplayer_menu_active, None),
+    ('join-internet-menu', GameInstanceManager.is_join_internet_menu_active, None),
+    ('disconnect-prompt', GameInstanceManager.is_disconnect_prompt_visible, None),
+    ('disconnect-button', GameInstanceManager.is_disconnect_button_visible, None),
+    ('play-now-button', GameInstanceManager.is_play_now_button_visible, None),
+    ('eor', GameInstanceManager.is_round_end_screen_visible, None),
+    ('connect-to-ip-button', GameInstanceManager.is_connect_to_ip_button_visible, None),
+    ('join-game-button', GameInstanceManager.is_join_game_button_visible, None),
+    # The map is loading if the round end screen is shown without the join game button
+    ('map-loading', GameInstanceManager.is_map_loading,
+     lambda entry: 'eor' in entry['labels'] and 'join-game-button' not in entry['labels']),
+    ('loading-bar', GameInstanceManager.is_loading_bar_visible, None),
+    ('map-briefing', GameInstanceManager.is_map_briefing_visible, None),
+    ('spawn-menu', GameInstanceManager.is_spawn_menu_visible, None),
+    ('spawn-point-selectable', GameInstanceManager.is_spawn_point_selectable, None),
+    ('spawn-point-selected', GameInstanceManager.is_spawn_point_selected, None),
+    ('suicide-button', GameInstanceManager.is_suicide_button_visible, None),
+    ('scoreboard', GameInstanceManager.is_scoreboard_visible, None),
+    ('default-camera-view', GameInstanceManager.is_default_camera_view_visible, None),
+]
+
+# Value detectors: name, detector, function returning the expected value for an entry (None = entry does not apply)
+VALUE_DETECTORS: List[Tuple[str, Callable[[GameInstanceManager], Any], Callable[[dict], Any]]] = [
+    ('team', GameInstanceManager.get_player_team, lambda entry: entry.get('team')),
+    ('map-details', lambda gim: list(gim.get_map_details()[:2]),
+     lambda entry: [entry['map'], entry['size']] if 'eor' in entry['labels'] and 'map' in entry else None),
+    ('game-message-text', lambda gim: gim.get_game_message()[0].value, lambda entry: entry.get('message')),
+]
+
+
+def load_corpus(path: str, resolution: str) -> List[dict]:
+    directory = os.path.join(path, resolution)
+    with open(os.path.join(directory, LABELS_FILE)) as f:
+        entries = json.load(f)
+
+    expected_size = get_resolution_window_size(resolution)
+    corpus = []
+    for entry in entries:
+        frame = cv2.imread(os.path.join(directory, entry['file']), cv2.IMREAD_COLOR)
+        if frame is None:
+            print(f'Skipping {resolution}/{entry["file"]} (failed to read frame)')
+            continue
+
+        height, width = frame.shape[:2]
+        if (width, height) != expected_size:
+            print(f'Skipping {resolution}/{entry["file"]} (size is {width}x{height}, expected '
+                  f'{expected_size[0]}x{expected_size[1]})')
+            continue
+
+        corpus.append({'labels': [], **entry, 'frame': frame})
+
+    return corpus
+
+
+def get_game_window(resolution: str) -> Window:
+    # Size the window such that its body (excluding title bar and shadow) matches the corpus frames at (0, 0)
+    width, height = get_resolution_window_size(resolution)
+    return Window(
+        0,
+        constants.BF2_WINDOW_TITLE,
+        (
+            -constants.WINDOW_SHADOW_SIZE,
+            -constants.WINDOW_TITLE_BAR_HEIGHT,
+            width + constants.WINDOW_SHADOW_SIZE,
+            height + constants.WINDOW_SHADOW_SIZE
+        ),
+        'BF2',
+        0
+    )
+
+
+def measure(gim: GameInstanceManager, backend: ReplayCaptureBackend, corpus: List[dict],
+            detector: Callable[[GameInstanceManager], Any], iterations: int) -> Tuple[List[Any], List[float]]:
+    results = []
+    latencies = []
+    for iteration in range(iterations):
+        for index, entry in enumerate(corpus):
+            backend.seek(index)
+            # Detectors must capture the frame themselves, else we would only measure the first one's capture
+            invalidate_frame_cache()
+            gim.state.set_rotation_map_name(entry.get('map'))
+            gim.state.set_rotation_map_size(entry.get('size'))
+
+            started = time.perf_counter()
+            result = detector(gim)
+            latencies.append(time.perf_counter() - started)
+
+            # Results do not change between iterations, only keep the first iteration's
+            if iteration == 0:
+                results.append(result)
+
+    return results, latencies
+
+
+def summarize_latencies(latencies: List[float]) -> dict:
+    percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    total = sum(latencies)
+    return {
+        'calls': len(latencies),
+        'mean': statistics.mean(latencies),
+        'p50': statistics.median(latencies),
+        'p95': percentiles[94],
+        'p99': percentiles[98],
+        'throughput': len(latencies) / total if total > 0 else None
+    }
+
+
+def score_detector(corpus: List[dict], results: List[bool], expected: Callable[[dict], bool]) -> dict:
+    tp = fp = tn = fn = 0
+    mismatches = []
+    for entry, result in zip(corpus, results):
+        positive = expected(entry)
+        if result and positive:
+            tp += 1
+        elif result:
+            fp += 1
+        elif positive:
+            fn += 1
+        else:
+            tn += 1
+
+        if bool(result) != positive:
+            mismatches.append(entry['file'])
+
+    return {
+        'tp': tp,
+        'fp': fp,
+        'tn': tn,
+        'fn': fn,
+        'accuracy': (tp + tn) / len(results) if len(results) > 0 else None,
+        'precision': tp / (tp + fp) if tp + fp > 0 else None,
+        'recall': tp / (tp + fn) if tp + fn > 0 else None,
+        'mismatches': mismatches
+    }
+
+
+def score_value_detector(corpus: List[dict], results: List[Any], expected: List[Any]) -> dict:
+    mismatches = [
+        {'file': entry['file'], 'expected': value, 'detected': result}
+        for entry, result, value in zip(corpus, results, expected) if result != value
+    ]
+    return {
+        'frames': len(results),
+        'correct': len(results) - len(mismatches),
+        'accuracy': (len(results) - len(mismatches)) / len(results) if len(results) > 0 else None,
+        'mismatches': mismatches
+    }
+
+
+def benchmark_resolution(corpus: List[dict], resolution: str, iterations: int) -> Dict[str, dict]:
+    histograms = ReferenceStore(os.path.join(Config.ROOT_DIR, 'references')).load(resolution)
+    gim = GameInstanceManager('', '', '', resolution, histograms)
+    gim.game_window = get_game_window(resolution)
+
+    backend = ReplayCaptureBackend([entry['frame'] for entry in corpus], loop=False, advance_on_grab=False)
+    set_capture_backend(backend)
+
+    results = {}
+    for name, detector, expected in DETECTORS:
+        engine_calls = OCR().engine.calls
+        detected, latencies = measure(gim, backend, corpus, detector, iterations)
+        results[name] = {
+            **summarize_latencies(latencies),
+            'ocr_calls': (OCR().engine.calls - engine_calls) / len(latencies),
+            **score_detector(
+                corpus,
+                detected,
+                expected if expected is not None else lambda entry, label=name: label in entry['labels']
+            )
+        }
+
+    for name, detector, expected in VALUE_DETECTORS:
+        applicable = [entry for entry in corpus if expected(entry) is not None]
+        if len(applicable) == 0:
+            continue
+
+        backend.frames = [entry['frame'] for entry in applicable]
+        engine_calls = OCR().engine.calls
+        detected, latencies = measure(gim, backend, applicable, detector, iterations)
+        results[name] = {
+            **summarize_latencies(latencies),
+            'ocr_calls': (OCR().engine.calls - engine_calls) / len(latencies),
+            **score_value_detector(applicable, detected, [expected(entry) for entry in applicable])
+        }
+        backend.frames = [entry['frame'] for entry in corpus]
+
+    return results
+
+
+def compare(results: dict, baseline: dict, max_accuracy_drop: float, max_slowdown: Optional[float]) -> List[str]:
+    regressions = []
+    for resolution, detectors in results['resolutions'].items():
+        for name, result in detectors.items():
+            reference = baseline.get('resolutions', {}).get(resolution, {}).get(name)
+            if reference is None:
+                continue
+
+            for metric in ['accuracy', 'precision', 'recall']:
+                current, previous = result.get(metric), reference.get(metric)
+                if current is not None and previous is not None and previous - current > max_accuracy_drop:
+                    regressions.append(f'{resolution}/{name}: {metric} dropped from {previous:.3f} to {current:.3f}')
+
+            if max_slowdown is not None and reference['p95'] > 0 and result['p95'] / reference['p95'] > max_slowdown:
+                regressions.append(f'{resolution}/{name}: p95 latency increased from {reference["p95"] * 1000:.2f} ms '
+                                   f'to {result["p95"] * 1000:.2f} ms')
+
+    return regressions
+
+
+def print_results(resolution: str, results: Dict[str, dict]) -> None:
+    print(f'{resolution}:')
+    for name, result in results.items():
+        scores = f'accuracy {result["accuracy"]:.3f}' if result['accuracy'] is not None else 'accuracy n/a'
+        if 'precision' in result:
+            scores += f', precision {result["precision"]:.3f}' if result['precision'] is not None \
+                else ', precision n/a'
+        print(f'  {name}: {result["calls"]} calls, '
+              f'p50 {result["p50"] * 1000:.2f} ms, '
+              f'p95 {result["p95"] * 1000:.2f} ms, '
+              f'p99 {result["p99"] * 1000:.2f} ms, '
+              f'{result["throughput"]:.1f} calls/s, '
+              f'{result["ocr_calls"]:.2f} OCR calls/call, '
+              f'{scores}')
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        prog='BF2AutoSpectator detection benchmark',
+        description='Measure latency and accuracy of the game instance detectors on a corpus of labeled frames'
+    )
+    parser.add_argument('corpus', help='Path to corpus folder (containing one folder of labeled frames per resolution)',
+                        type=str)
+    parser.add_argument('--resolution', help='Resolution(s) to benchmark (default: all in corpus)',
+                        choices=['720p', '900p'], action='append')
+    parser.add_argument('--tesseract-path', help='Path to Tesseract install folder',
+                        type=str, default='C:\\Program Files\\Tesseract-OCR\\')
+    parser.add_argument('--ocr-engine', help='How to run Tesseract OCR', choices=['api', 'pytesseract'], type=str,
+                        default='api')
+    parser.add_argument('--no-label-templates', dest='label_templates', action='store_false',
+                        help='Always use OCR to detect menu labels instead of matching them against templates')
+    parser.add_argument('--iterations', help='Number of times to run each detector on each frame', type=int, default=3)
+    parser.add_argument('--output', help='Path to write results (JSON) to', type=str)
+    parser.add_argument('--baseline', help='Path to results (JSON) of a previous run to compare against', type=str)
+    parser.add_argument('--max-accuracy-drop', help='Max. drop in accuracy/precision/recall compared to the baseline '
+                                                    'before reporting a regression', type=float, default=0.0)
+    parser.add_argument('--max-slowdown', help='Max. factor of p95 latency compared to the baseline before reporting '
+                                               'a regression (default: do not compare latency)', type=float)
+    parser.set_defaults(label_templates=True)
+    args = parser.parse_args()
+
+    resolutions = args.resolution or [
+        resolution for resolution in ['720p', '900p']
+        if os.path.isfile(os.path.join(args.corpus, resolution, LABELS_FILE))
+    ]
+    if len(resolutions) == 0:
+        sys.exit(f'No labeled frames found in {args.corpus}')
+
+    # Detectors must not write debug screenshots of corpus frames
+    Config().set_debug_screenshot(False)
+    # Any detector moving the mouse (e.g. to not block a region) must not actually do so
+    set_platform_backend(SimulatedPlatformBackend())
+    # Every call should run OCR as during a real session, so results must not be cached between iterations
+    OCR().set_engine(create_ocr_engine(args.tesseract_path, args.ocr_engine))
+    OCR().set_cache(None)
+    if args.label_templates:
+        # Only use the shipped templates, learned ones would depend on previous runs
+        LabelMatcher().configure([os.path.join(Config.ROOT_DIR, 'templates')])
+
+    results = {'version': RESULTS_VERSION, 'iterations': args.iterations, 'resolutions': {}}
+    for resolution in resolutions:
+        corpus = load_corpus(args.corpus, resolution)
+        if len(corpus) == 0:
+            print(f'Skipping {resolution} (no usable frames)')
+            continue
+
+        results['resolutions'][resolution] = benchmark_resolution(corpus, resolution, args.iterations)
+        print_results(resolution, results['resolutions'][resolution])
+
+    OCR().engine.close()
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline, args.max_accuracy_drop, args.max_slowdown)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if len(regressions) > 0:
+            sys.exit(1)
+
+        print('No regressions compared to baseline')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,82 @@
+import argparse
+import statistics
+import sys
+import time
+from typing import List
+
+import cv2
+import numpy as np
+import pytesseract
+from numpy import ndarray
+
+from BF2AutoSpectator.common.capture import ReplayCaptureBackend
+from BF2AutoSpectator.common.ocr import OCREngine, PytesseractOCREngine, TesseractAPIOCREngine
+
+LABELS = ['quit', 'disconnect', 'play now', 'join game', 'select', 'done', 'suicide', 'map briefing', 'game message']
+
+
+def render_labels() -> List[ndarray]:
+    # Dark text on a light background, similar to what the usual "grayscale, colorize, invert" image ops produce
+    images = []
+    for label in LABELS:
+        image = np.full((24, 12 * len(label) + 16, 3), 255, dtype=np.uint8)
+        cv2.putText(image, label.upper(), (8, 18), cv2.FONT_HERSHEY_SIMPLEX, .5, (0, 0, 0), 1, cv2.LINE_AA)
+        images.append(image)
+
+    return images
+
+
+def measure(engine: OCREngine, images: List[ndarray], iterations: int, ocr_config: str) -> List[float]:
+    latencies = []
+    for _ in range(iterations):
+        for image in images:
+            started = time.perf_counter()
+            engine.image_to_string(image, ocr_config)
+            latencies.append(time.perf_counter() - started)
+
+    return latencies
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        prog='BF2AutoSpectator OCR benchmark',
+        description='Compare per-call latency of the available OCR engines'
+    )
+    parser.add_argument('--tesseract-path', help='Path to Tesseract install folder',
+                        type=str, default='C:\\Program Files\\Tesseract-OCR\\')
+    parser.add_argument('--images', help='Folder of (cropped and preprocessed) images to run OCR on '
+                                         '(uses rendered UI labels if not given)', type=str)
+    parser.add_argument('--iterations', help='Number of times to run OCR on each image', type=int, default=10)
+    parser.add_argument('--ocr-config', help='Tesseract config to use', type=str, default=r'--oem 3 --psm 7')
+    args = parser.parse_args()
+
+    images = ReplayCaptureBackend.load_frames(args.images) if args.images is not None else render_labels()
+    if len(images) == 0:
+        sys.exit(f'No images found in {args.images}')
+
+    results = {}
+    for name, factory in [('pytesseract', PytesseractOCREngine), ('api', TesseractAPIOCREngine)]:
+        try:
+            engine = factory(args.tesseract_path)
+            # Don't count one-time initialization towards per-call latency
+            engine.image_to_string(images[0], args.ocr_config)
+        except (OSError, pytesseract.TesseractNotFoundError) as e:
+            print(f'Skipping {name} engine ({e})')
+            continue
+
+        latencies = measure(engine, images, args.iterations, args.ocr_config)
+        engine.close()
+
+        results[name] = statistics.mean(latencies)
+        # Quantiles require at least two samples
+        p95 = f', p95 {statistics.quantiles(latencies, n=20)[18] * 1000:.2f} ms' if len(latencies) >= 2 else ''
+        print(f'{name}: {len(latencies)} calls, '
+              f'mean {results[name] * 1000:.2f} ms, '
+              f'p50 {statistics.median(latencies) * 1000:.2f} ms{p95}')
+
+    if 'pytesseract' in results and 'api' in results:
+        print(f'api engine is {results["pytesseract"] / results["api"]:.1f}x faster per call')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,264 @@
+import functools
+import os
+import threading
+from typing import Tuple, List, Union, Optional, Dict
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+
+class CaptureBackend:
+    """
+    Grabs screen regions as BGR images (numpy arrays of shape (height, width, 3) with dtype uint8)
+    """
+    def grab(self, region: Tuple[int, int, int, int]) -> ndarray:
+        """
+        Capture the specified screen region
+        :param region: region to capture, format: (left, top, width, height)
+        :return: BGR image of the region
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class DesktopCaptureBackend(CaptureBackend):
+    """
+    Captures the desktop via pyautogui (and thus PIL's ImageGrab)
+    """
+    def __init__(self):
+        # Only import pyautogui on first capture, it cannot be imported without a display (e.g. when replaying on Linux)
+        self.__pyautogui = None
+
+    def grab(self, region: Tuple[int, int, int, int]) -> ndarray:
+        if self.__pyautogui is None:
+            import pyautogui
+            self.__pyautogui = pyautogui
+
+        screenshot = self.__pyautogui.screenshot(region=region)
+        # Convert once per capture, any crop of the frame is just a view after this
+        return cv2.cvtColor(np.asarray(screenshot), cv2.COLOR_RGB2BGR)
+
+
+class GDICaptureBackend(CaptureBackend):
+    """
+    Captures the desktop by BitBlt-ing from the desktop device context into a reusable memory bitmap
+    """
+    __contexts: Dict[Tuple[int, int], tuple]
+
+    def __init__(self):
+        import win32con
+        import win32gui
+        import win32ui
+        self.__win32con = win32con
+        self.__win32gui = win32gui
+        self.__win32ui = win32ui
+
+        self.__desktop = win32gui.GetDesktopWindow()
+        self.__desktop_dc = win32gui.GetWindowDC(self.__desktop)
+        self.__source_dc = win32ui.CreateDCFromHandle(self.__desktop_dc)
+        self.__contexts = {}
+        self.__lock = threading.Lock()
+
+    def grab(self, region: Tuple[int, int, int, int]) -> ndarray:
+        left, top, width, height = region
+        with self.__lock:
+            memory_dc, bitmap = self.__get_context(width, height)
+            memory_dc.BitBlt((0, 0), (width, height), self.__source_dc, (left, top), self.__win32con.SRCCOPY)
+            buffer = bitmap.GetBitmapBits(True)
+
+        # Bitmap bits are BGRA, so dropping the alpha channel gives a BGR view without copying any pixel data
+        return np.frombuffer(buffer, dtype=np.uint8).reshape((height, width, 4))[:, :, :3]
+
+    def __get_context(self, width: int, height: int) -> tuple:
+        # Creating device contexts and bitmaps is comparatively expensive, so keep one per capture size
+        context = self.__contexts.get((width, height))
+        if context is None:
+            memory_dc = self.__source_dc.CreateCompatibleDC()
+            bitmap = self.__win32ui.CreateBitmap()
+            bitmap.CreateCompatibleBitmap(self.__source_dc, width, height)
+            memory_dc.SelectObject(bitmap)
+            context = memory_dc, bitmap
+            self.__contexts[(width, height)] = context
+
+        return context
+
+    def close(self) -> None:
+        with self.__lock:
+            for memory_dc, bitmap in self.__contexts.values():
+                memory_dc.DeleteDC()
+                self.__win32gui.DeleteObject(bitmap.GetHandle())
+            self.__contexts.clear()
+            self.__source_dc.DeleteDC()
+            self.__win32gui.ReleaseDC(self.__desktop, self.__desktop_dc)
+
+
+class ReplayCaptureBackend(CaptureBackend):
+    """
+    Serves previously recorded frames instead of capturing the screen. Frames are expected to show the same screen area
+    regions are requested for, with origin being the screen coordinates of each frame's top left corner.
+    Unless advance_on_grab is set, grabs keep serving the current frame until advance is called, so all rects captured
+    within one tick (e.g. by a capture plan) come from the same frame.
+    """
+    FILE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.npy')
+
+    frames: List[ndarray]
+    origin: Tuple[int, int]
+    loop: bool
+    advance_on_grab: bool
+    index: int
+
+    def __init__(self, frames: Union[str, List[ndarray]], origin: Tuple[int, int] = (0, 0), loop: bool = True,
+                 advance_on_grab: bool = False):
+        self.frames = self.load_frames(frames) if isinstance(frames, str) else frames
+        self.origin = origin
+        self.loop = loop
+        self.advance_on_grab = advance_on_grab
+        self.index = 0
+
+    @staticmethod
+    def load_frames(path: str) -> List[ndarray]:
+        frames = []
+        for filename in sorted(os.listdir(path)):
+            if not filename.lower().endswith(ReplayCaptureBackend.FILE_EXTENSIONS):
+                continue
+
+            file_path = os.path.join(path, filename)
+            if filename.lower().endswith('.npy'):
+                frames.append(np.load(file_path))
+            else:
+                frames.append(cv2.imread(file_path, cv2.IMREAD_COLOR))
+
+        return frames
+
+    def current(self) -> Optional[ndarray]:
+        if self.index >= len(self.frames):
+            return None
+
+        return self.frames[self.index]
+
+    def advance(self) -> bool:
+        self.index += 1
+        if self.index >= len(self.frames) and self.loop:
+            self.index = 0
+
+        return self.index < len(self.frames)
+
+    def seek(self, index: int) -> None:
+        self.index = index
+
+    def grab(self, region: Tuple[int, int, int, int]) -> ndarray:
+        frame = self.current()
+        if frame is None:
+            raise EOFError('No more frames to replay')
+
+        left, top, width, height = region
+        x, y = left - self.origin[0], top - self.origin[1]
+        if x < 0 or y < 0 or x + width > frame.shape[1] or y + height > frame.shape[0]:
+            raise ValueError(f'Region {region} is outside of frame ({frame.shape[1]}x{frame.shape[0]} at {self.origin})')
+
+        if self.advance_on_grab:
+            self.advance()
+
+        return frame[y:y + height, x:x + width]
+
+
+class CapturePlan:
+    """
+    Precomputed set of (absolute) screen rects to capture instead of a whole region, derived from the crops that will be
+    taken from the region. Only the planned rects are captured, crops are taken from whichever captured rect contains
+    them. Crops not covered by the plan cannot be served from a planned capture and require a full capture instead.
+    """
+    region: Tuple[int, int, int, int]
+    rects: List[Tuple[int, int, int, int]]
+
+    def __init__(self, region: Tuple[int, int, int, int], crops: List[Tuple[int, int, int, int]], merge: bool):
+        self.region = region
+        rects = [self.crop_to_rect(region, crop) for crop in crops]
+        self.rects = [self.union(rects)] if merge else rects
+        self.__covered = {}
+
+    @staticmethod
+    def crop_to_rect(region: Tuple[int, int, int, int], crop: Tuple[int, int, int, int]) -> Tuple[int, int, int, int]:
+        # Crops are borders to remove, format: (left, top, right, bottom)
+        left, top, width, height = region
+        crop_left, crop_top, crop_right, crop_bottom = crop
+        return (
+            left + crop_left,
+            top + crop_top,
+            width - crop_left - crop_right,
+            height - crop_top - crop_bottom
+        )
+
+    @staticmethod
+    def union(rects: List[Tuple[int, int, int, int]]) -> Tuple[int, int, int, int]:
+        left = min(rect[0] for rect in rects)
+        top = min(rect[1] for rect in rects)
+        right = max(rect[0] + rect[2] for rect in rects)
+        bottom = max(rect[1] + rect[3] for rect in rects)
+        return left, top, right - left, bottom - top
+
+    @staticmethod
+    def area(rect: Tuple[int, int, int, int]) -> int:
+        return rect[2] * rect[3]
+
+    def covers(self, crops: List[Tuple[int, int, int, int]]) -> bool:
+        return all(self.__covers(crop) for crop in crops)
+
+    @staticmethod
+    def contains(outer: Tuple[int, int, int, int], inner: Tuple[int, int, int, int]) -> bool:
+        o_left, o_top, o_width, o_height = outer
+        left, top, width, height = inner
+        return o_left <= left and o_top <= top and left + width <= o_left + o_width and top + height <= o_top + o_height
+
+    def __covers(self, crop: Tuple[int, int, int, int]) -> bool:
+        covered = self.__covered.get(crop)
+        if covered is None:
+            rect = self.crop_to_rect(self.region, crop)
+            covered = any(self.contains(planned, rect) for planned in self.rects)
+            self.__covered[crop] = covered
+
+        return covered
+
+    def capture(self, backend: CaptureBackend) -> List[Tuple[Tuple[int, int, int, int], ndarray]]:
+        """
+        Capture the planned rects
+        :param backend: backend to capture rects with
+        :return: captured rects along with their images, format: ((left, top, width, height), image)
+        """
+        return [(rect, backend.grab(rect)) for rect in self.rects]
+
+    def crop(self, captures: List[Tuple[Tuple[int, int, int, int], ndarray]],
+             crop: Tuple[int, int, int, int]) -> ndarray:
+        """
+        Take a crop of the region from a planned capture
+        :param captures: captured rects along with their images (as returned by capture)
+        :param crop: crop to take, format: (left, top, right, bottom)
+        :return: view of the cropped image
+        :raises ValueError: if the crop is not covered by the plan
+        """
+        rect = self.crop_to_rect(self.region, crop)
+        for captured, image in captures:
+            if self.contains(captured, rect):
+                left, top, width, height = rect
+                x, y = left - captured[0], top - captured[1]
+                return image[y:y + height, x:x + width]
+
+        raise ValueError(f'Crop {crop} is not covered by capture plan')
+
+
+@functools.lru_cache(maxsize=32)
+def build_capture_plan(region: Tuple[int, int, int, int], crops: Tuple[Tuple[int, int, int, int], ...]) -> CapturePlan:
+    """
+    Build a capture plan for the given crops of a region (plans are cached, so any rects are only computed once per
+    window position)
+    :param region: region the crops will be taken from, format: (left, top, width, height)
+    :param crops: crops that will be taken from the region, format: (left, top, right, bottom)
+    :return:
+    """
+    rects = [CapturePlan.crop_to_rect(region, crop) for crop in crops]
+    # Capture the union of all rects unless it contains a lot of pixels no crop needs, capture rects individually then
+    merge = CapturePlan.area(CapturePlan.union(rects)) <= 2 * sum(CapturePlan.area(rect) for rect in rects)
+    return CapturePlan(region, list(crops), merge)
@@ -0,0 +1,67 @@
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from BF2AutoSpectator.common.classes import Singleton
+from BF2AutoSpectator.common.exceptions import ClockStoppedException
+
+
+class Clock(metaclass=Singleton):
+    """
+    Source of time for the main loop (sleeps, wait timeouts, detector budgets and state timers). Uses real time by
+    default. When replaying a recorded session, the clock is virtual instead: time only passes when sleeping, so the
+    main loop runs as fast as it can process frames while behaving as if the sleeps actually took place.
+    """
+    virtual: bool
+    stop_after: Optional[float]
+
+    def __init__(self):
+        self.virtual = False
+        self.stop_after = None
+
+        self.__elapsed = 0.0
+        self.__started_at = datetime.now()
+        self.__lock = threading.Lock()
+
+    def set_virtual(self, started_at: datetime, stop_after: Optional[float] = None) -> None:
+        """
+        Switch to virtual time
+        :param started_at: date/time the virtual clock starts at
+        :param stop_after: number of virtual seconds after which any sleep raises a ClockStoppedException (None = never)
+        :return:
+        """
+        with self.__lock:
+            self.virtual = True
+            self.stop_after = stop_after
+            self.__elapsed = 0.0
+            self.__started_at = started_at
+
+    def elapsed(self) -> float:
+        """
+        Get the number of virtual seconds passed since switching to virtual time
+        :return:
+        """
+        return self.__elapsed
+
+    def monotonic(self) -> float:
+        if self.virtual:
+            return self.__elapsed
+
+        return time.monotonic()
+
+    def now(self) -> datetime:
+        if self.virtual:
+            return self.__started_at + timedelta(seconds=self.__elapsed)
+
+        return datetime.now()
+
+    def sleep(self, seconds: float) -> None:
+        if not self.virtual:
+            time.sleep(seconds)
+            return
+
+        with self.__lock:
+            self.__elapsed += max(seconds, 0.0)
+            if self.stop_after is not None and self.__elapsed > self.stop_after:
+                raise ClockStoppedException(f'Virtual clock stopped after {self.__elapsed:.2f}s')
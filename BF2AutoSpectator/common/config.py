@@ -1,15 +1,19 @@
 import os
 from datetime import datetime, timedelta
-from typing import Tuple, Optional
+from typing import Tuple, Optional, Dict
 
 from BF2AutoSpectator.common import constants
 from BF2AutoSpectator.common.classes import Singleton
+from BF2AutoSpectator.common.clock import Clock
 
 
 class Config(metaclass=Singleton):
-    ROOT_DIR: str = os.path.dirname(__file__).replace('\\BF2AutoSpectator\\common', '')
+    # Strip the package path on Windows as well as on Linux (where sessions can be replayed)
+    ROOT_DIR: str = os.path.dirname(__file__).replace('\\BF2AutoSpectator\\common', '').replace('/BF2AutoSpectator/common', '')
     PWD: str = os.getcwd()
     DEBUG_DIR: str = os.path.join(PWD, f'{constants.APP_NAME}-debug')
+    TEMPLATE_DIR: str = os.path.join(PWD, f'{constants.APP_NAME}-templates')
+    RECORDING_DIR: str = os.path.join(PWD, f'{constants.APP_NAME}-recordings')
 
     __player_name: str
     __player_pass: str
@@ -20,6 +24,10 @@ class Config(metaclass=Singleton):
 
     __game_path: str
     __tesseract_path: str
+    __ocr_engine: str
+    __ocr_cache_size: int
+    __ocr_cache_perceptual: bool
+    __label_templates: bool
     __limit_rtl: bool
     __instance_rtl: int
     __map_load_delay: int
@@ -31,7 +39,28 @@ class Config(metaclass=Singleton):
     __obs_source_name: str
 
     __resolution: str
+    __capture_backend: str
+    __mouse_mode: str
     __debug_screenshot: bool
+    __debug_screenshot_format: str
+    __debug_screenshot_quality: int
+    __debug_screenshot_quota: int
+    __debug_screenshot_sample_rates: Dict[str, int]
+
+    __motion_sample_rate: float
+    __motion_window: float
+    __motion_min_score: float
+    __afk_scan_candidates: int
+    __afk_scan_dwell: float
+    __detector_budgets: Dict[str, float]
+
+    __metrics_port: int
+    __metrics_log_interval: float
+    __trace: bool
+    __trace_flush_ticks: int
+    __record: bool
+    __record_chunk_size: int
+    __record_quota: int
 
     __min_iterations_on_player: int
     __max_iterations_on_player: int
@@ -42,9 +71,17 @@ class Config(metaclass=Singleton):
     __player_rotation_paused_until: datetime = None
 
     def set_options(self, player_name: str, player_pass: str, server_ip: str, server_port: str, server_pass: str,
-                    server_mod: str, game_path: str, tesseract_path: str, limit_rtl: bool, instance_rtl: int, map_load_delay: int,
+                    server_mod: str, game_path: str, tesseract_path: str, ocr_engine: str,
+                    ocr_cache_size: int, ocr_cache_perceptual: bool,
+                    label_templates: bool, limit_rtl: bool, instance_rtl: int, map_load_delay: int,
                     use_controller: bool, controller_base_uri: str, control_obs: bool, obs_url: str, obs_source_name: str,
-                    resolution: str, debug_screenshot: bool,
+                    resolution: str, capture_backend: str, mouse_mode: str, debug_screenshot: bool, debug_screenshot_format: str,
+                    debug_screenshot_quality: int, debug_screenshot_quota: int,
+                    debug_screenshot_sample_rates: Dict[str, int],
+                    motion_sample_rate: float, motion_window: float, motion_min_score: float,
+                    afk_scan_candidates: int, afk_scan_dwell: float, detector_budgets: Dict[str, float],
+                    metrics_port: int, metrics_log_interval: float, trace: bool, trace_flush_ticks: int,
+                    record: bool, record_chunk_size: int, record_quota: int,
                     min_iterations_on_player: int, max_iterations_on_player: int,
                     max_iterations_on_default_camera_view: int, lockup_iterations_on_spawn_menu: int):
         self.__player_name = player_name
@@ -56,6 +93,10 @@ class Config(metaclass=Singleton):
 
         self.__game_path = game_path
         self.__tesseract_path = tesseract_path
+        self.__ocr_engine = ocr_engine
+        self.__ocr_cache_size = ocr_cache_size
+        self.__ocr_cache_perceptual = ocr_cache_perceptual
+        self.__label_templates = label_templates
         self.__limit_rtl = limit_rtl
         self.__instance_rtl = instance_rtl
         self.__map_load_delay = map_load_delay
@@ -67,8 +108,29 @@ class Config(metaclass=Singleton):
         self.__obs_source_name = obs_source_name
 
         self.__resolution = resolution
+        self.__capture_backend = capture_backend
+        self.__mouse_mode = mouse_mode
 
         self.__debug_screenshot = debug_screenshot
+        self.__debug_screenshot_format = debug_screenshot_format
+        self.__debug_screenshot_quality = debug_screenshot_quality
+        self.__debug_screenshot_quota = debug_screenshot_quota
+        self.__debug_screenshot_sample_rates = debug_screenshot_sample_rates
+
+        self.__motion_sample_rate = motion_sample_rate
+        self.__motion_window = motion_window
+        self.__motion_min_score = motion_min_score
+        self.__afk_scan_candidates = afk_scan_candidates
+        self.__afk_scan_dwell = afk_scan_dwell
+        self.__detector_budgets = detector_budgets
+
+        self.__metrics_port = metrics_port
+        self.__metrics_log_interval = metrics_log_interval
+        self.__trace = trace
+        self.__trace_flush_ticks = trace_flush_ticks
+        self.__record = record
+        self.__record_chunk_size = record_chunk_size
+        self.__record_quota = record_quota
 
         self.__min_iterations_on_player = min_iterations_on_player
         self.__max_iterations_on_player = max_iterations_on_player
@@ -120,6 +182,18 @@ class Config(metaclass=Singleton):
     def get_tesseract_path(self) -> str:
         return self.__tesseract_path
 
+    def get_ocr_engine(self) -> str:
+        return self.__ocr_engine
+
+    def get_ocr_cache_size(self) -> int:
+        return self.__ocr_cache_size
+
+    def ocr_cache_perceptual(self) -> bool:
+        return self.__ocr_cache_perceptual
+
+    def label_templates(self) -> bool:
+        return self.__label_templates
+
     def limit_rtl(self) -> bool:
         return self.__limit_rtl
 
@@ -147,12 +221,69 @@ class Config(metaclass=Singleton):
     def get_resolution(self) -> str:
         return self.__resolution
 
+    def get_capture_backend(self) -> str:
+        return self.__capture_backend
+
+    def get_mouse_mode(self) -> str:
+        return self.__mouse_mode
+
     def debug_screenshot(self) -> bool:
         return self.__debug_screenshot
 
     def set_debug_screenshot(self, debug_screenshot: bool) -> None:
         self.__debug_screenshot = debug_screenshot
 
+    def get_debug_screenshot_format(self) -> str:
+        return self.__debug_screenshot_format
+
+    def get_debug_screenshot_quality(self) -> int:
+        return self.__debug_screenshot_quality
+
+    def get_debug_screenshot_quota(self) -> int:
+        return self.__debug_screenshot_quota
+
+    def get_debug_screenshot_sample_rates(self) -> Dict[str, int]:
+        return self.__debug_screenshot_sample_rates
+
+    def get_motion_sample_rate(self) -> float:
+        return self.__motion_sample_rate
+
+    def get_motion_window(self) -> float:
+        return self.__motion_window
+
+    def get_motion_min_score(self) -> float:
+        return self.__motion_min_score
+
+    def get_afk_scan_candidates(self) -> int:
+        return self.__afk_scan_candidates
+
+    def get_afk_scan_dwell(self) -> float:
+        return self.__afk_scan_dwell
+
+    def get_detector_budgets(self) -> Dict[str, float]:
+        return self.__detector_budgets
+
+    def get_metrics_port(self) -> int:
+        return self.__metrics_port
+
+    def get_metrics_log_interval(self) -> float:
+        return self.__metrics_log_interval
+
+    def trace(self) -> bool:
+        return self.__trace
+
+    def get_trace_flush_ticks(self) -> int:
+        return self.__trace_flush_ticks
+
+    def record(self) -> bool:
+        return self.__record
+
+    def get_record_chunk_size(self) -> int:
+        return self.__record_chunk_size
+
+    def get_record_quota(self) -> int:
+        return self.__record_quota
+
     def get_min_iterations_on_player(self) -> int:
         return self.__min_iterations_on_player
 
@@ -173,7 +304,7 @@ class Config(metaclass=Singleton):
 
     def pause_player_rotation(self, pause_for_minutes: int) -> None:
         self.__player_rotation_paused = True
-        self.__player_rotation_paused_until = datetime.now() + timedelta(minutes=pause_for_minutes)
+        self.__player_rotation_paused_until = Clock().now() + timedelta(minutes=pause_for_minutes)
 
     def unpause_player_rotation(self) -> None:
         self.__player_rotation_paused = False
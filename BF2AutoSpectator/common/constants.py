@@ -1,13 +1,18 @@
+import sys
+
 APP_NAME = 'BF2AutoSpectator'
 APP_VERSION = '0.14.0'
 BF2_EXE = 'BF2.exe'
 BF2_WINDOW_TITLE = 'BF2 (v1.5.3153-802.0, pid:'
-TESSERACT_EXE = 'tesseract.exe'
+# Replays run on Linux, where the executable has no extension
+TESSERACT_EXE = 'tesseract.exe' if sys.platform == 'win32' else 'tesseract'
 WINDOW_TITLE_BAR_HEIGHT = 31
 WINDOW_SHADOW_SIZE = 8
 HISTCMP_MAX_DELTA = 0.25
 DEFAULT_CAMERA_VIEW_HISTCMP_MAX_DELTA = 0.175
 PLAYER_ROTATION_PAUSE_DURATION = 5
+# format: tuple(left, top, right, bottom), pixels to remove from the game window's edges
+SPECTATED_VIEW_CROP = (168, 0, 168, 0)
 TEAMS_SPAWN_MENU_LEFT = ['usmc', 'eu', 'navy-seal', 'sas', 'rebels-left', 'spetsnaz-left', 'peglegs', 'canada-left',
                          'russia-left']
 TEAMS_SPAWN_MENU_RIGHT = ['china', 'mec', 'mec-sf', 'insurgent', 'rebels-right', 'spetsnaz-right', 'undead',
@@ -0,0 +1,155 @@
+import collections
+import os
+import threading
+from datetime import datetime
+from typing import Deque, Dict, Optional, Tuple
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from BF2AutoSpectator.common.classes import Singleton
+from BF2AutoSpectator.common.logger import logger
+
+
+class DebugScreenshotWriter(metaclass=Singleton):
+    """
+    Writes debug screenshots to disk on a background thread. Screenshots are queued in a bounded queue, dropping the
+    oldest queued screenshot if the writer cannot keep up. Written files are rotated (oldest first) to stay within
+    the disk quota.
+    """
+    FORMATS = ['jpg', 'png', 'npy']
+    FILE_PREFIX = 'screenshot-'
+
+    directory: Optional[str]
+    format: str
+    jpeg_quality: int
+    quota: int
+    sample_rates: Dict[str, int]
+    dropped: int
+
+    __queue: Deque[Tuple[str, ndarray]]
+    __files: Deque[Tuple[str, int]]
+    __counters: Dict[str, int]
+
+    def __init__(self):
+        self.directory = None
+        self.format = 'jpg'
+        self.jpeg_quality = 95
+        self.quota = 0
+        self.sample_rates = {}
+        self.dropped = 0
+
+        self.__queue = collections.deque(maxlen=64)
+        self.__files = collections.deque()
+        self.__bytes_written = 0
+        self.__counters = {}
+        self.__condition = threading.Condition()
+        self.__thread = None
+
+    def configure(self, directory: str, file_format: str = 'jpg', jpeg_quality: int = 95, quota_mb: int = 0,
+                  sample_rates: Optional[Dict[str, int]] = None, queue_size: int = 64) -> None:
+        """
+        Configure the writer
+        :param directory: directory to write screenshots to
+        :param file_format: format to write screenshots as (jpg, png or npy for raw numpy arrays)
+        :param jpeg_quality: quality to use for jpg screenshots (0-100)
+        :param quota_mb: max size of all written screenshots in megabytes, older screenshots get deleted (0 = no limit)
+        :param sample_rates: write every nth screenshot per region label ("default" applies to any other label)
+        :param queue_size: max number of screenshots waiting to be written
+        :return:
+        """
+        with self.__condition:
+            self.directory = directory
+            self.format = file_format
+            self.jpeg_quality = jpeg_quality
+            self.quota = quota_mb * 1000 * 1000
+            self.sample_rates = sample_rates if sample_rates is not None else {}
+            self.__queue = collections.deque(self.__queue, maxlen=queue_size)
+            self.__scan_existing_files()
+
+    def submit(self, image: ndarray, label: Optional[str] = None) -> None:
+        """
+        Queue a screenshot for writing (returns right away)
+        :param image: BGR or grayscale image to write
+        :param label: label of the screenshot's region, used for sampling and included in the filename
+        :return:
+        """
+        label = label if label is not None else 'region'
+        count = self.__counters.get(label, 0)
+        self.__counters[label] = count + 1
+        if count % max(self.sample_rates.get(label, self.sample_rates.get('default', 1)), 1) != 0:
+            return
+
+        filename = f'{self.FILE_PREFIX}{datetime.now().strftime("%Y-%m-%d-%H-%M-%S-%f")}-{label}.{self.format}'
+        with self.__condition:
+            if len(self.__queue) == self.__queue.maxlen:
+                self.dropped += 1
+            # Images may be views into a cached frame, so queue a copy
+            self.__queue.append((filename, np.array(image)))
+            self.__ensure_thread()
+            self.__condition.notify()
+
+    def __ensure_thread(self) -> None:
+        if self.__thread is None or not self.__thread.is_alive():
+            self.__thread = threading.Thread(target=self.__run, name='DebugScreenshotWriter', daemon=True)
+            self.__thread.start()
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                while len(self.__queue) == 0:
+                    self.__condition.wait()
+                filename, image = self.__queue.popleft()
+                directory = self.directory
+
+            if directory is None:
+                continue
+
+            path = os.path.join(directory, filename)
+            try:
+                self.__write(path, image)
+                with self.__condition:
+                    self.__track(path, os.path.getsize(path))
+            except (OSError, cv2.error) as e:
+                logger.error(f'Failed to save screenshot to disk: {e}')
+
+    def __write(self, path: str, image: ndarray) -> None:
+        if self.format == 'npy':
+            np.save(path, image)
+        elif self.format == 'jpg':
+            if not cv2.imwrite(path, image, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]):
+                raise OSError(f'cv2 failed to write {path}')
+        elif not cv2.imwrite(path, image):
+            raise OSError(f'cv2 failed to write {path}')
+
+    def __track(self, path: str, size: int) -> None:
+        self.__files.append((path, size))
+        self.__bytes_written += size
+
+        # Rotate out the oldest files until we are back within the quota
+        while 0 < self.quota < self.__bytes_written and len(self.__files) > 1:
+            oldest_path, oldest_size = self.__files.popleft()
+            self.__bytes_written -= oldest_size
+            try:
+                os.remove(oldest_path)
+            except OSError as e:
+                logger.error(f'Failed to remove old screenshot from disk: {e}')
+
+    def __scan_existing_files(self) -> None:
+        # Screenshots from previous runs count towards the quota, too
+        self.__files.clear()
+        self.__bytes_written = 0
+        if self.directory is None or not os.path.isdir(self.directory):
+            return
+
+        files = []
+        for filename in os.listdir(self.directory):
+            if filename.startswith(self.FILE_PREFIX):
+                path = os.path.join(self.directory, filename)
+                files.append((path, os.path.getsize(path)))
+
+        # File names start with a timestamp, so sorting by name sorts oldest first
+        for path, size in sorted(files):
+            self.__files.append((path, size))
+            self.__bytes_written += size
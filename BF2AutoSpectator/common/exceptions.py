@@ -8,3 +8,7 @@ class SpawnCoordinatesNotAvailableException(SpectatorException):
 
 class ClientNotConnectedException(SpectatorException):
     pass
+
+
+class ClockStoppedException(SpectatorException):
+    pass
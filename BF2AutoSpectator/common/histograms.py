@@ -0,0 +1,105 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from numpy import ndarray
+
+
+class ReferenceHistograms:
+    """
+    Stack of named reference histograms, pre-normalized such that the Bhattacharyya distance of a histogram to all
+    references can be computed in a single matrix-vector product. Distances are equal to those of
+    cv2.compareHist(..., cv2.HISTCMP_BHATTACHARYYA).
+    """
+    names: List[str]
+    matrix: ndarray
+
+    __indices: Dict[str, int]
+
+    def __init__(self, names: List[str], histograms: List[ndarray]):
+        self.names = names
+        self.matrix = np.stack([normalize_histogram(histogram) for histogram in histograms]) \
+            if len(histograms) > 0 else np.empty((0, 256))
+        self.__indices = {name: index for index, name in enumerate(names)}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.__indices
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def distances(self, histogram: ndarray) -> ndarray:
+        """
+        Compute the distance of a histogram to every reference
+        :param histogram: histogram as returned by cv2.calcHist
+        :return: distance to each reference (same order as names)
+        """
+        return coefficients_to_distances(self.matrix @ normalize_histogram(histogram))
+
+    def distance(self, histogram: ndarray, name: str) -> float:
+        return float(coefficients_to_distances(self.matrix[self.__indices[name]] @ normalize_histogram(histogram)))
+
+    def distances_to(self, histograms: List[ndarray], names: List[str]) -> ndarray:
+        """
+        Compute the distance of each histogram to its own reference
+        :param histograms: histograms as returned by cv2.calcHist
+        :param names: name of the reference to compare each histogram to
+        :return: distance of each histogram to its reference
+        """
+        queries = np.stack([normalize_histogram(histogram) for histogram in histograms])
+        references = self.matrix[[self.__indices[name] for name in names]]
+        return coefficients_to_distances(np.einsum('ij,ij->i', queries, references))
+
+    def best_match(self, histogram: ndarray, names: Optional[List[str]] = None) -> Tuple[Optional[str], float]:
+        """
+        Find the reference closest to a histogram
+        :param histogram: histogram as returned by cv2.calcHist
+        :param names: names of references to consider (None = all)
+        :return: name of and distance to the closest reference (None and 1.0 if there are no references)
+        """
+        if names is None:
+            indices = np.arange(len(self.names))
+        else:
+            indices = np.array([self.__indices[name] for name in names if name in self.__indices], dtype=int)
+
+        if len(indices) == 0:
+            return None, 1.0
+
+        distances = coefficients_to_distances(self.matrix[indices] @ normalize_histogram(histogram))
+        best = int(np.argmin(distances))
+        return self.names[indices[best]], float(distances[best])
+
+
+def normalize_histogram(histogram: ndarray) -> ndarray:
+    # Bhattacharyya coefficient = sum(sqrt(a / sum(a) * b / sum(b))), so we can take the square roots upfront
+    histogram = np.asarray(histogram, dtype=np.float64).ravel()
+    total = histogram.sum()
+    if total <= 0:
+        return np.zeros_like(histogram)
+
+    return np.sqrt(histogram / total)
+
+
+def coefficients_to_distances(coefficients: ndarray) -> ndarray:
+    return np.sqrt(np.clip(1.0 - coefficients, 0.0, None))
+
+
+def build_reference_histograms(histograms: dict) -> Dict[str, ReferenceHistograms]:
+    """
+    Build stacked reference histograms for the categories that are compared against multiple references
+    :param histograms: histograms of a single resolution
+    :return: reference histograms per category (teams, eor and menu use the "active" variant)
+    """
+    references = {}
+    for category in ['teams', 'eor', 'menu']:
+        # Skip plain histograms (e.g. eor/loading-bar), only items with variants are relevant here
+        items = {name: variants['active'] for name, variants in histograms.get(category, {}).items()
+                 if isinstance(variants, dict) and 'active' in variants}
+        references[category] = ReferenceHistograms(list(items.keys()), list(items.values()))
+
+    default_camera_views = histograms.get('maps', {}).get('default-camera-view', {})
+    references['maps/default-camera-view'] = ReferenceHistograms(
+        list(default_camera_views.keys()),
+        list(default_camera_views.values())
+    )
+
+    return references
@@ -0,0 +1,284 @@
+import os
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from BF2AutoSpectator.common.classes import Singleton
+from BF2AutoSpectator.common.logger import logger
+
+
+class LabelMatcher(metaclass=Singleton):
+    """
+    Detects fixed labels (menu items, buttons, headers) by matching (preprocessed) screenshots against glyph templates.
+    Templates are stored as grayscale images per resolution, format: <directory>/<resolution>/<region key>.<label>.png
+    (spaces in labels replaced by underscores). Templates can be learned at runtime from crops OCR found the label in.
+    Learned templates are only saved once consecutive OCR reads agree on them. Their mismatches only rule a label out once
+    OCR has agreed with several of them (and OCR still spot checks every so often). If OCR does find the label in a crop
+    a learned template did not match, the template is discarded.
+    """
+    FILE_EXTENSION = '.png'
+    # Padding to keep around the text of learned templates, allowing for a few pixels of offset when matching
+    TEMPLATE_PADDING = 3
+    # Number of agreeing OCR reads required before saving a learned template
+    LEARN_CONFIRMATIONS = 2
+    # Number of mismatches OCR needs to agree with before a learned template's mismatches rule the label out
+    MISMATCH_CONFIRMATIONS = 3
+    # Still run OCR on every nth mismatch of a learned template, so a bad template cannot cause false negatives for long
+    MISMATCH_SPOT_CHECK_INTERVAL = 25
+
+    enabled: bool
+    directories: List[str]
+    learn_directory: Optional[str]
+    match_threshold: float
+    mismatch_threshold: float
+    matches: int
+    mismatches: int
+    fallbacks: int
+
+    __templates: Dict[Tuple[str, str, str], Optional[ndarray]]
+    __learned: Set[Tuple[str, str, str]]
+    __candidates: Dict[Tuple[str, str, str], Tuple[ndarray, int]]
+    __confirmed_mismatches: Dict[Tuple[str, str, str], int]
+    __trusted_mismatches: Dict[Tuple[str, str, str], int]
+    __unverified_mismatches: Set[Tuple[str, str, str]]
+
+    def __init__(self):
+        self.enabled = False
+        self.directories = []
+        self.learn_directory = None
+        self.match_threshold = .9
+        self.mismatch_threshold = .5
+        self.matches = 0
+        self.mismatches = 0
+        self.fallbacks = 0
+
+        self.__templates = {}
+        self.__learned = set()
+        self.__candidates = {}
+        self.__confirmed_mismatches = {}
+        self.__trusted_mismatches = {}
+        self.__unverified_mismatches = set()
+        self.__lock = threading.Lock()
+
+    def configure(self, directories: List[str], learn_directory: Optional[str] = None, match_threshold: float = .9,
+                  mismatch_threshold: float = .5) -> None:
+        """
+        Configure the matcher (and enable it)
+        :param directories: directories to load templates from (first match wins)
+        :param learn_directory: directory to save learned templates to (None = do not learn templates)
+        :param match_threshold: min. match score to consider the label present without running OCR
+        :param mismatch_threshold: max. match score to consider the label absent without running OCR
+        :return:
+        """
+        with self.__lock:
+            self.enabled = True
+            self.directories = directories if learn_directory is None else [*directories, learn_directory]
+            self.learn_directory = learn_directory
+            self.match_threshold = match_threshold
+            self.mismatch_threshold = mismatch_threshold
+            self.__templates.clear()
+            self.__learned.clear()
+            self.__candidates.clear()
+            self.__confirmed_mismatches.clear()
+            self.__trusted_mismatches.clear()
+            self.__unverified_mismatches.clear()
+
+    def match(self, resolution: str, key: str, label: str, image: ndarray) -> Optional[bool]:
+        """
+        Check whether an image of a region shows the given label
+        :param resolution: resolution the image was taken at
+        :param key: key of the image's region in coordinates dict
+        :param label: label to check for
+        :param image: (preprocessed) image of the region
+        :return: whether the label is shown, None if no template exists or the match is inconclusive
+                 (or a learned template does not match, but OCR has yet to confirm its mismatches)
+        """
+        if not self.enabled:
+            return None
+
+        template = self.__get_template(resolution, key, label)
+        if template is None:
+            return None
+
+        with self.__lock:
+            # Any OCR result reported from now on refers to this match, not to a previous one
+            self.__unverified_mismatches.discard((resolution, key, label))
+
+        score = self.score(to_grayscale(image), template)
+        if score >= self.match_threshold:
+            self.matches += 1
+            return True
+        elif score <= self.mismatch_threshold and self.__rules_out(resolution, key, label):
+            self.mismatches += 1
+            return False
+
+        self.fallbacks += 1
+        return None
+
+    def confirm_mismatch(self, resolution: str, key: str, label: str) -> None:
+        """
+        Record that OCR did not find the label in the image of the last match (confirming a learned template's mismatch)
+        :param resolution: resolution the image was taken at
+        :param key: key of the image's region in coordinates dict
+        :param label: label OCR did not find in the image
+        :return:
+        """
+        with self.__lock:
+            if (resolution, key, label) not in self.__unverified_mismatches:
+                return
+
+            self.__unverified_mismatches.discard((resolution, key, label))
+            confirmations = self.__confirmed_mismatches.get((resolution, key, label), 0) + 1
+            self.__confirmed_mismatches[(resolution, key, label)] = confirmations
+
+        if confirmations == self.MISMATCH_CONFIRMATIONS:
+            logger.debug(f'Learned template for "{label}" in {key} ({resolution}) now rules the label out')
+
+    @staticmethod
+    def agree(template: ndarray, other: ndarray, threshold: float) -> bool:
+        # Templates are trimmed with padding, so either one may be slightly larger than the other
+        return max(LabelMatcher.score(template, other), LabelMatcher.score(other, template)) >= threshold
+
+    @staticmethod
+    def score(image: ndarray, template: ndarray) -> float:
+        height, width = template.shape[:2]
+        if image.shape[0] < height or image.shape[1] < width:
+            return 0.0
+
+        # Uniform images/windows have no variance, which results in NaN instead of a score
+        result = np.nan_to_num(cv2.matchTemplate(image, template, cv2.TM_CCOEFF_NORMED), nan=0.0)
+        return float(result.max())
+
+    def learn(self, resolution: str, key: str, label: str, image: ndarray) -> None:
+        """
+        Confirm an image of a region OCR found the label in as the label's template (unless a shipped template exists).
+        The template is saved once LEARN_CONFIRMATIONS consecutive reads agree on it. A learned template
+        that does not match the image disagrees with OCR and is discarded.
+        :param resolution: resolution the image was taken at
+        :param key: key of the image's region in coordinates dict
+        :param label: label OCR found in the image
+        :param image: (preprocessed) image of the region
+        :return:
+        """
+        if not self.enabled or self.learn_directory is None:
+            return
+
+        template = trim_to_text(to_grayscale(image), self.TEMPLATE_PADDING)
+        existing = self.__get_template(resolution, key, label)
+        if existing is not None:
+            if not self.__is_learned(resolution, key, label) or \
+                    (template is not None and self.agree(existing, template, self.match_threshold)):
+                return
+            self.__discard(resolution, key, label)
+
+        if template is None:
+            return
+
+        with self.__lock:
+            candidate = self.__candidates.get((resolution, key, label))
+            if candidate is not None and self.agree(candidate[0], template, self.match_threshold):
+                confirmations = candidate[1] + 1
+            else:
+                confirmations = 1
+
+            if confirmations < self.LEARN_CONFIRMATIONS:
+                self.__candidates[(resolution, key, label)] = (template, confirmations)
+                return
+
+            self.__candidates.pop((resolution, key, label), None)
+
+        directory = os.path.join(self.learn_directory, resolution)
+        path = os.path.join(directory, get_template_filename(key, label))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            if not cv2.imwrite(path, template):
+                raise OSError(f'cv2 failed to write {path}')
+        except OSError as e:
+            logger.error(f'Failed to save label template to disk: {e}')
+            return
+
+        logger.debug(f'Learned template for "{label}" in {key} ({resolution})')
+        with self.__lock:
+            self.__templates[(resolution, key, label)] = template
+            self.__learned.add((resolution, key, label))
+
+    def __discard(self, resolution: str, key: str, label: str) -> None:
+        logger.warning(f'Learned template for "{label}" in {key} ({resolution}) disagrees with OCR, discarding it')
+        path = os.path.join(self.learn_directory, resolution, get_template_filename(key, label))
+        try:
+            if os.path.isfile(path):
+                os.remove(path)
+        except OSError as e:
+            logger.error(f'Failed to remove label template from disk: {e}')
+
+        with self.__lock:
+            self.__templates[(resolution, key, label)] = None
+            self.__learned.discard((resolution, key, label))
+            self.__confirmed_mismatches.pop((resolution, key, label), None)
+            self.__trusted_mismatches.pop((resolution, key, label), None)
+            self.__unverified_mismatches.discard((resolution, key, label))
+
+    def __rules_out(self, resolution: str, key: str, label: str) -> bool:
+        with self.__lock:
+            if (resolution, key, label) not in self.__learned:
+                return True
+
+            if self.__confirmed_mismatches.get((resolution, key, label), 0) >= self.MISMATCH_CONFIRMATIONS:
+                uses = self.__trusted_mismatches.get((resolution, key, label), 0) + 1
+                self.__trusted_mismatches[(resolution, key, label)] = uses
+                if uses % self.MISMATCH_SPOT_CHECK_INTERVAL != 0:
+                    return True
+
+            # Let OCR decide and report back whether it agrees with the mismatch
+            self.__unverified_mismatches.add((resolution, key, label))
+            return False
+
+    def __is_learned(self, resolution: str, key: str, label: str) -> bool:
+        with self.__lock:
+            return (resolution, key, label) in self.__learned
+
+    def __get_template(self, resolution: str, key: str, label: str) -> Optional[ndarray]:
+        with self.__lock:
+            if (resolution, key, label) not in self.__templates:
+                template, directory = self.__load_template(resolution, key, label)
+                self.__templates[(resolution, key, label)] = template
+                if template is not None and directory == self.learn_directory:
+                    self.__learned.add((resolution, key, label))
+
+            return self.__templates[(resolution, key, label)]
+
+    def __load_template(self, resolution: str, key: str, label: str) -> Tuple[Optional[ndarray], Optional[str]]:
+        for directory in self.directories:
+            path = os.path.join(directory, resolution, get_template_filename(key, label))
+            if os.path.isfile(path):
+                return cv2.imread(path, cv2.IMREAD_GRAYSCALE), directory
+
+        return None, None
+
+
+def get_template_filename(key: str, label: str) -> str:
+    return f'{key}.{label.replace(" ", "_")}{LabelMatcher.FILE_EXTENSION}'
+
+
+def to_grayscale(image: ndarray) -> ndarray:
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+
+
+def trim_to_text(image: ndarray, padding: int) -> Optional[ndarray]:
+    """
+    Trim an image to the bounding box of any pixels which differ from the background (median of the border pixels)
+    :param image: grayscale image
+    :param padding: pixels to keep around the bounding box
+    :return: trimmed image, None if the image is uniform
+    """
+    border = np.concatenate([image[0, :], image[-1, :], image[:, 0], image[:, -1]])
+    ys, xs = np.nonzero(np.abs(image.astype(np.int16) - int(np.median(border))) > 32)
+    if len(ys) == 0:
+        return None
+
+    top, bottom = max(ys.min() - padding, 0), min(ys.max() + padding + 1, image.shape[0])
+    left, right = max(xs.min() - padding, 0), min(xs.max() + padding + 1, image.shape[1])
+    return np.ascontiguousarray(image[top:bottom, left:right])
@@ -0,0 +1,256 @@
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+from BF2AutoSpectator.common.classes import Singleton
+from BF2AutoSpectator.common.logger import logger
+
+METRIC_PREFIX = 'bf2autospectator'
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed bucket upper bounds (in the way Prometheus expects them)
+    """
+    bounds: Tuple[float, ...]
+    counts: List[int]
+    count: int
+    sum: float
+    max: float
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.bounds, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def get_cumulative_counts(self) -> List[int]:
+        cumulative = []
+        total = 0
+        for count in self.counts:
+            total += count
+            cumulative.append(total)
+        return cumulative
+
+
+class StageTimer:
+    """
+    Context manager recording the time spent in a with block under a stage
+    """
+    metrics: 'Metrics'
+    stage: str
+    started_at: float
+
+    def __init__(self, metrics: 'Metrics', stage: str):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self) -> 'StageTimer':
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.metrics.observe(self.stage, time.perf_counter() - self.started_at)
+
+
+class Metrics(metaclass=Singleton):
+    """
+    Records main loop tick times, time spent per stage (capture, preprocessing, OCR, histogram, input, sleep) and
+    counters. Recording only takes a lock and a few additions, so metrics are always recorded. They can be exported
+    via a local HTTP endpoint (in Prometheus text format) and/or logged as a periodic JSON summary.
+    """
+    STAGES = ['capture', 'preprocessing', 'ocr', 'histogram', 'input', 'sleep']
+    STAGE_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0)
+    TICK_BUCKETS = (.1, .25, .5, 1.0, 2.0, 3.0, 5.0, 10.0, 30.0, 60.0)
+
+    ticks: Histogram
+    stages: Dict[str, Histogram]
+    counters: Dict[str, int]
+    collectors: Dict[str, Callable[[], int]]
+    last_tick: Dict[str, float]
+
+    def __init__(self):
+        self.ticks = Histogram(self.TICK_BUCKETS)
+        self.stages = {stage: Histogram(self.STAGE_BUCKETS) for stage in self.STAGES}
+        self.counters = {}
+        self.collectors = {}
+        self.last_tick = {}
+
+        self.__current_tick: Dict[str, float] = {}
+        self.__tick_started_at: Optional[float] = None
+        self.__lock = threading.Lock()
+        self.__server: Optional[ThreadingHTTPServer] = None
+        self.__log_thread: Optional[threading.Thread] = None
+
+    def timed(self, stage: str) -> StageTimer:
+        """
+        Time a with block under the given stage, e.g. with Metrics().timed('ocr'): ...
+        :param stage: stage to record the time under
+        :return:
+        """
+        return StageTimer(self, stage)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self.__lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram(self.STAGE_BUCKETS)
+            histogram.observe(seconds)
+            self.__current_tick[stage] = self.__current_tick.get(stage, 0.0) + seconds
+
+    def increment(self, counter: str, value: int = 1) -> None:
+        with self.__lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def register_collector(self, counter: str, collector: Callable[[], int]) -> None:
+        """
+        Register a counter whose value is kept elsewhere (only read when exporting)
+        :param counter: name of the counter
+        :param collector: returns the current value
+        :return:
+        """
+        with self.__lock:
+            self.collectors[counter] = collector
+
+    def tick(self) -> None:
+        """
+        Mark the start of a main loop iteration (ending the previous one)
+        :return:
+        """
+        now = time.perf_counter()
+        with self.__lock:
+            if self.__tick_started_at is not None:
+                duration = now - self.__tick_started_at
+                self.ticks.observe(duration)
+                self.last_tick = {'total': duration, **self.__current_tick}
+            self.__current_tick = {}
+            self.__tick_started_at = now
+
+    def get_counters(self) -> Dict[str, int]:
+        with self.__lock:
+            counters = dict(self.counters)
+            collectors = dict(self.collectors)
+
+        for counter, collector in collectors.items():
+            try:
+                counters[counter] = collector()
+            except Exception as e:
+                logger.debug(f'Failed to collect {counter} metric: {e}')
+
+        return counters
+
+    def summary(self) -> dict:
+        counters = self.get_counters()
+        with self.__lock:
+            ticks = self.ticks.count
+            return {
+                'ticks': ticks,
+                'tick': {
+                    'avg': self.ticks.sum / ticks if ticks > 0 else 0.0,
+                    'max': self.ticks.max
+                },
+                'last_tick': dict(self.last_tick),
+                'stages': {
+                    stage: {
+                        'count': histogram.count,
+                        'total': histogram.sum,
+                        'per_tick': histogram.sum / ticks if ticks > 0 else 0.0,
+                        'max': histogram.max
+                    } for stage, histogram in self.stages.items()
+                },
+                'counters': counters
+            }
+
+    def render_prometheus(self) -> str:
+        counters = self.get_counters()
+        lines = []
+        with self.__lock:
+            lines.append(f'# HELP {METRIC_PREFIX}_tick_seconds Wall time of main loop iterations')
+            lines.append(f'# TYPE {METRIC_PREFIX}_tick_seconds histogram')
+            lines.extend(self.__render_histogram(f'{METRIC_PREFIX}_tick_seconds', self.ticks))
+
+            lines.append(f'# HELP {METRIC_PREFIX}_stage_seconds Time spent per stage')
+            lines.append(f'# TYPE {METRIC_PREFIX}_stage_seconds histogram')
+            for stage, histogram in self.stages.items():
+                lines.extend(self.__render_histogram(f'{METRIC_PREFIX}_stage_seconds', histogram, f'stage="{stage}"'))
+
+        for counter, value in sorted(counters.items()):
+            name = f'{METRIC_PREFIX}_{counter}_total'
+            lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def __render_histogram(name: str, histogram: Histogram, labels: str = '') -> List[str]:
+        separator = ',' if labels else ''
+        lines = [
+            f'{name}_bucket{{{labels}{separator}le="{bound}"}} {count}'
+            for bound, count in zip(histogram.bounds, histogram.get_cumulative_counts())
+        ]
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {histogram.count}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {histogram.sum}')
+        lines.append(f'{name}_count{suffix} {histogram.count}')
+        return lines
+
+    def start_server(self, port: int, host: str = '127.0.0.1') -> None:
+        """
+        Serve metrics via HTTP on a background thread (Prometheus text format on /metrics, JSON on /metrics.json)
+        :param port: port to listen on
+        :param host: host to listen on (local only by default)
+        :return:
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = metrics.render_prometheus(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = json.dumps(metrics.summary()), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+
+                payload = body.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                # Don't spam the log with scrape requests
+                pass
+
+        self.__server = ThreadingHTTPServer((host, port), Handler)
+        self.__server.daemon_threads = True
+        threading.Thread(target=self.__server.serve_forever, name='MetricsServer', daemon=True).start()
+        logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+
+    def start_log(self, interval: float) -> None:
+        """
+        Log a JSON summary of all metrics on a background thread
+        :param interval: number of seconds between two summaries
+        :return:
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                logger.info(f'Metrics: {json.dumps(self.summary(), separators=(",", ":"))}')
+
+        self.__log_thread = threading.Thread(target=run, name='MetricsLog', daemon=True)
+        self.__log_thread.start()
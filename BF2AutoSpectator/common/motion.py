@@ -0,0 +1,166 @@
+import collections
+import threading
+import time
+from typing import Callable, Deque, Optional, Tuple
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from BF2AutoSpectator.common.capture import CaptureBackend
+from BF2AutoSpectator.common.classes import Singleton
+from BF2AutoSpectator.common.logger import logger
+
+
+class MotionSampler(metaclass=Singleton):
+    """
+    Continuously samples a screen region on a background thread, downsampling each sample to a small grayscale image.
+    Consecutive samples are differenced to keep a rolling motion score (mean absolute pixel difference, 0-1) over the
+    configured window, which can be read at any time without blocking.
+    """
+    backend: Optional[CaptureBackend]
+    region_provider: Optional[Callable[[], Optional[Tuple[int, int, int, int]]]]
+    rate: float
+    window: float
+    size: Tuple[int, int]
+    samples: int
+    errors: int
+
+    __frames: Deque[Tuple[float, ndarray]]
+    __deltas: Deque[Tuple[float, float]]
+
+    def __init__(self):
+        self.backend = None
+        self.region_provider = None
+        self.rate = 4.0
+        self.window = 1.5
+        self.size = (96, 54)
+        self.samples = 0
+        self.errors = 0
+
+        self.__frames = collections.deque(maxlen=8)
+        self.__deltas = collections.deque(maxlen=8)
+        self.__reset_at = time.monotonic()
+        self.__condition = threading.Condition()
+        self.__running = False
+        self.__thread = None
+
+    def configure(self, backend: CaptureBackend, region_provider: Callable[[], Optional[Tuple[int, int, int, int]]],
+                  rate: float = 4.0, window: float = 1.5, size: Tuple[int, int] = (96, 54)) -> None:
+        """
+        Configure the sampler
+        :param backend: backend to capture samples with
+        :param region_provider: returns the screen region to sample, format: (left, top, width, height)
+        (or None to pause sampling, e.g. if there is no game window)
+        :param rate: samples to take per second
+        :param window: number of seconds to compute the motion score over
+        :param size: size to downsample samples to, format: (width, height)
+        :return:
+        """
+        with self.__condition:
+            self.backend = backend
+            self.region_provider = region_provider
+            self.rate = rate
+            self.window = window
+            self.size = size
+            # Keep one extra frame, since n deltas require n + 1 frames
+            capacity = max(int(window * rate), 1) + 1
+            self.__frames = collections.deque(maxlen=capacity)
+            self.__deltas = collections.deque(maxlen=capacity)
+            self.__reset_at = time.monotonic()
+
+    def start(self) -> None:
+        with self.__condition:
+            self.__running = True
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__thread = threading.Thread(target=self.__run, name='MotionSampler', daemon=True)
+                self.__thread.start()
+
+    def stop(self) -> None:
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify_all()
+
+    def is_running(self) -> bool:
+        return self.__running
+
+    def reset(self) -> None:
+        """
+        Discard all samples, e.g. after the spectated view changed (any previous motion is not relevant anymore)
+        :return:
+        """
+        with self.__condition:
+            self.__frames.clear()
+            self.__deltas.clear()
+            self.__reset_at = time.monotonic()
+
+    def get_score(self, window: Optional[float] = None) -> Optional[float]:
+        """
+        Get the current motion score
+        :param window: number of seconds to compute the score over (defaults to the configured window)
+        :return: mean absolute difference between consecutive samples (0-1), None if there are not enough samples yet
+        """
+        window = window if window is not None else self.window
+        with self.__condition:
+            now = time.monotonic()
+            deltas = [delta for sampled_at, delta in self.__deltas if now - sampled_at <= window]
+            # Only score once samples cover at least half of the window since the last reset
+            if len(deltas) == 0 or now - self.__reset_at < window / 2:
+                return None
+
+            return float(np.mean(deltas))
+
+    def measure(self, duration: float) -> Optional[float]:
+        """
+        Discard all samples and wait for new ones, then return the motion score over the given duration
+        :param duration: number of seconds to sample for
+        :return: motion score, None if no samples were taken
+        """
+        self.reset()
+        deadline = time.monotonic() + duration
+        with self.__condition:
+            # Wait for the duration to pass (plus one interval to make sure the last sample is in)
+            while self.__running and time.monotonic() < deadline + 1 / self.rate:
+                self.__condition.wait(deadline + 1 / self.rate - time.monotonic())
+
+        return self.get_score(duration)
+
+    def __run(self) -> None:
+        while True:
+            started_at = time.monotonic()
+            with self.__condition:
+                if not self.__running:
+                    return
+                backend, region_provider, size = self.backend, self.region_provider, self.size
+
+            region = region_provider() if region_provider is not None else None
+            if backend is not None and region is not None:
+                try:
+                    self.__add_sample(started_at, self.__downsample(backend.grab(region), size))
+                except Exception as e:
+                    # Don't let a failed capture (e.g. of a window that just closed) kill the thread
+                    self.errors += 1
+                    logger.debug(f'Failed to take motion sample: {e}')
+
+            with self.__condition:
+                timeout = 1 / self.rate - (time.monotonic() - started_at)
+                if self.__running and timeout > 0:
+                    self.__condition.wait(timeout)
+
+    @staticmethod
+    def __downsample(image: ndarray, size: Tuple[int, int]) -> ndarray:
+        small = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY) if small.ndim == 3 else small
+
+    def __add_sample(self, sampled_at: float, frame: ndarray) -> None:
+        with self.__condition:
+            # Drop samples taken before the last reset, they may still show the previous view
+            if sampled_at < self.__reset_at:
+                return
+
+            if len(self.__frames) > 0:
+                previous = self.__frames[-1][1]
+                self.__deltas.append((sampled_at, float(cv2.absdiff(previous, frame).mean()) / 255))
+            self.__frames.append((sampled_at, frame))
+            self.samples += 1
+            self.__condition.notify_all()
@@ -0,0 +1,421 @@
+import collections
+import ctypes
+import ctypes.util
+import glob
+import hashlib
+import os
+import re
+import shlex
+import threading
+import time
+from typing import Dict, Optional, Tuple, List
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from BF2AutoSpectator.common import constants
+from BF2AutoSpectator.common.classes import Singleton
+from BF2AutoSpectator.common.logger import logger
+
+PSM_REGEX = re.compile(r'--psm\s+\d+')
+
+
+class OCREngine:
+    """
+    Extracts text from BGR or grayscale images
+    """
+    calls: int
+    seconds: float
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+
+    def image_to_string(self, image: ndarray, ocr_config: str) -> str:
+        """
+        Extract text from an image
+        :param image: BGR or grayscale image to extract text from
+        :param ocr_config: config/parameters for Tesseract OCR (see https://guides.nyu.edu/tesseract/usage)
+        :return: raw OCR result
+        """
+        started = time.perf_counter()
+        try:
+            return self.recognize(image, ocr_config)
+        finally:
+            self.calls += 1
+            self.seconds += time.perf_counter() - started
+
+    def recognize(self, image: ndarray, ocr_config: str) -> str:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class PytesseractOCREngine(OCREngine):
+    """
+    Runs the tesseract executable once per image (via pytesseract)
+    """
+    def __init__(self, tesseract_path: str):
+        super().__init__()
+        import pytesseract
+        self.__pytesseract = pytesseract
+        pytesseract.pytesseract.tesseract_cmd = os.path.join(tesseract_path, constants.TESSERACT_EXE)
+
+    def recognize(self, image: ndarray, ocr_config: str) -> str:
+        # pytesseract hands numpy arrays to PIL, which expects RGB channel order
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+        return self.__pytesseract.image_to_string(image, config=ocr_config)
+
+
+class TesseractAPIOCREngine(OCREngine):
+    """
+    Keeps one long-lived Tesseract instance per OCR config, using libtesseract's C API in-process
+    """
+    # Tesseract assumes 70 dpi for images without resolution information (such as the ones pytesseract writes)
+    SOURCE_RESOLUTION = 70
+
+    def __init__(self, tesseract_path: str, library_path: Optional[str] = None):
+        super().__init__()
+        self.tessdata_path = os.path.join(tesseract_path, 'tessdata')
+        self.lib = ctypes.CDLL(library_path if library_path is not None else self.find_library(tesseract_path))
+        self.__declare_functions()
+        self.__handles: Dict[str, Tuple[ctypes.c_void_p, threading.Lock, int]] = {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def find_library(tesseract_path: str) -> str:
+        # Windows installs ship the library as e.g. libtesseract-5.dll next to tesseract.exe
+        candidates = sorted(glob.glob(os.path.join(tesseract_path, 'libtesseract*.dll')), reverse=True)
+        if len(candidates) > 0:
+            return candidates[0]
+
+        library = ctypes.util.find_library('tesseract')
+        if library is None:
+            raise OSError(f'Could not find libtesseract in {tesseract_path} or system library paths')
+
+        return library
+
+    def __declare_functions(self) -> None:
+        lib = self.lib
+        lib.TessBaseAPICreate.restype = ctypes.c_void_p
+        lib.TessBaseAPICreate.argtypes = []
+        lib.TessBaseAPIInit2.restype = ctypes.c_int
+        lib.TessBaseAPIInit2.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int]
+        lib.TessBaseAPISetVariable.restype = ctypes.c_int
+        lib.TessBaseAPISetVariable.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+        lib.TessBaseAPISetPageSegMode.restype = None
+        lib.TessBaseAPISetPageSegMode.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        lib.TessBaseAPISetImage.restype = None
+        lib.TessBaseAPISetImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_int, ctypes.c_int,
+                                            ctypes.c_int, ctypes.c_int]
+        lib.TessBaseAPISetSourceResolution.restype = None
+        lib.TessBaseAPISetSourceResolution.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        lib.TessBaseAPIGetUTF8Text.restype = ctypes.c_void_p
+        lib.TessBaseAPIGetUTF8Text.argtypes = [ctypes.c_void_p]
+        lib.TessDeleteText.restype = None
+        lib.TessDeleteText.argtypes = [ctypes.c_void_p]
+        lib.TessBaseAPIClear.restype = None
+        lib.TessBaseAPIClear.argtypes = [ctypes.c_void_p]
+        lib.TessBaseAPIEnd.restype = None
+        lib.TessBaseAPIEnd.argtypes = [ctypes.c_void_p]
+        lib.TessBaseAPIDelete.restype = None
+        lib.TessBaseAPIDelete.argtypes = [ctypes.c_void_p]
+
+    @staticmethod
+    def parse_config(ocr_config: str) -> Tuple[str, int, Optional[int], Optional[int], Dict[str, str]]:
+        """
+        Parse a Tesseract command line config string
+        :param ocr_config: config/parameters for Tesseract OCR, e.g. "--oem 3 --psm 7 -c tessedit_char_whitelist=0123"
+        :return: language, engine mode, page segmentation mode, dpi and variables
+        """
+        language, oem, psm, dpi, variables = 'eng', 3, None, None, {}
+        args = shlex.split(ocr_config)
+        for index, arg in enumerate(args[:-1]):
+            value = args[index + 1]
+            if arg == '-l':
+                language = value
+            elif arg == '--oem':
+                oem = int(value)
+            elif arg == '--psm':
+                psm = int(value)
+            elif arg == '--dpi':
+                dpi = int(value)
+            elif arg == '-c' and '=' in value:
+                name, variable_value = value.split('=', 1)
+                variables[name] = variable_value
+
+        return language, oem, psm, dpi, variables
+
+    def __get_handle(self, ocr_config: str) -> Tuple[ctypes.c_void_p, threading.Lock, int]:
+        with self.__lock:
+            entry = self.__handles.get(ocr_config)
+            if entry is not None:
+                return entry
+
+            language, oem, psm, dpi, variables = self.parse_config(ocr_config)
+            handle = self.lib.TessBaseAPICreate()
+            if self.lib.TessBaseAPIInit2(handle, self.tessdata_path.encode(), language.encode(), oem) != 0:
+                self.lib.TessBaseAPIDelete(handle)
+                raise RuntimeError(f'Failed to initialize Tesseract for config "{ocr_config}"')
+
+            if psm is not None:
+                self.lib.TessBaseAPISetPageSegMode(handle, psm)
+            for name, value in variables.items():
+                self.lib.TessBaseAPISetVariable(handle, name.encode(), value.encode())
+
+            entry = handle, threading.Lock(), dpi if dpi is not None else self.SOURCE_RESOLUTION
+            self.__handles[ocr_config] = entry
+            return entry
+
+    def warm_up(self, ocr_config: str) -> None:
+        """
+        Initialize the Tesseract instance for the given config ahead of its first use
+        :param ocr_config: config/parameters for Tesseract OCR
+        :return:
+        """
+        self.__get_handle(ocr_config)
+
+    def recognize(self, image: ndarray, ocr_config: str) -> str:
+        handle, lock, resolution = self.__get_handle(ocr_config)
+        # Tesseract expects RGB channel order
+        if image.ndim == 3:
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        image = np.ascontiguousarray(image)
+        height, width = image.shape[:2]
+        bytes_per_pixel = 1 if image.ndim == 2 else image.shape[2]
+
+        with lock:
+            self.lib.TessBaseAPISetImage(handle, image.ctypes.data, width, height, bytes_per_pixel,
+                                         image.strides[0])
+            self.lib.TessBaseAPISetSourceResolution(handle, resolution)
+            text_pointer = self.lib.TessBaseAPIGetUTF8Text(handle)
+            try:
+                text = ctypes.string_at(text_pointer).decode('utf-8', errors='replace') if text_pointer else ''
+            finally:
+                if text_pointer:
+                    self.lib.TessDeleteText(text_pointer)
+                self.lib.TessBaseAPIClear(handle)
+
+        return text
+
+    def close(self) -> None:
+        with self.__lock:
+            for handle, lock, _ in self.__handles.values():
+                with lock:
+                    self.lib.TessBaseAPIEnd(handle)
+                    self.lib.TessBaseAPIDelete(handle)
+            self.__handles.clear()
+
+
+class OCRResultCache:
+    """
+    LRU cache of OCR results, keyed by a hash of the (preprocessed) image plus the OCR config. In perceptual mode, images
+    are keyed by a difference hash instead, so near-identical images (e.g. differing only by compression noise) share
+    a cache entry.
+    """
+    max_size: int
+    perceptual: bool
+    hash_size: int
+    hits: int
+    misses: int
+
+    __entries: collections.OrderedDict
+
+    def __init__(self, max_size: int = 256, perceptual: bool = False, hash_size: int = 16):
+        self.max_size = max_size
+        self.perceptual = perceptual
+        self.hash_size = hash_size
+        self.hits = 0
+        self.misses = 0
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+
+    def key(self, image: ndarray, ocr_config: str) -> Tuple[Tuple[int, ...], bytes, str]:
+        if self.perceptual:
+            digest = self.difference_hash(image)
+        else:
+            digest = hashlib.blake2b(np.ascontiguousarray(image).data, digest_size=16).digest()
+
+        return image.shape, digest, ocr_config
+
+    def difference_hash(self, image: ndarray) -> bytes:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+        resized = cv2.resize(gray, (self.hash_size + 1, self.hash_size), interpolation=cv2.INTER_AREA)
+        return np.packbits(resized[:, 1:] > resized[:, :-1]).tobytes()
+
+    def get(self, key: Tuple[Tuple[int, ...], bytes, str]) -> Optional[str]:
+        with self.__lock:
+            result = self.__entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.__entries.move_to_end(key)
+            return result
+
+    def put(self, key: Tuple[Tuple[int, ...], bytes, str], result: str) -> None:
+        with self.__lock:
+            self.__entries[key] = result
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+
+
+class OCR(metaclass=Singleton):
+    """
+    Holds the OCR engine (and optional result cache) used for any text extraction
+    """
+    engine: Optional[OCREngine]
+    cache: Optional[OCRResultCache]
+    batches: int
+    batch_fallbacks: int
+
+    def __init__(self):
+        self.engine = None
+        self.cache = None
+        self.batches = 0
+        self.batch_fallbacks = 0
+
+    def set_engine(self, engine: OCREngine) -> None:
+        if self.engine is not None:
+            self.engine.close()
+        self.engine = engine
+
+    def set_cache(self, cache: Optional[OCRResultCache]) -> None:
+        self.cache = cache
+
+    def image_to_string(self, image: ndarray, ocr_config: str) -> str:
+        return self.__image_to_string(image, ocr_config, self.__get_key(image, ocr_config))
+
+    def images_to_strings(self, images: List[ndarray], ocr_config: str, fallback: bool = True) -> List[str]:
+        """
+        Extract text from multiple single-line images with a single OCR run, by stacking them into one image and
+        splitting the result by line. Falls back to running OCR on each image if the number of lines does not match.
+        :param images: BGR or grayscale images to extract text from
+        :param ocr_config: config/parameters for Tesseract OCR (page segmentation mode gets replaced for the batch)
+        :param fallback: whether to fall back to one OCR run per image if the number of lines does not match (else,
+        the detected lines are returned as is, meaning they can no longer be mapped to the images)
+        :return: raw OCR result per image
+        """
+        batch_ocr_config = get_batch_ocr_config(ocr_config)
+        keys = [self.__get_key(image, ocr_config) for image in images]
+        # Lines of a batch were recognized with a different page segmentation mode than single images, so cache them
+        # separately (but use either result)
+        batch_keys = [(*key[:-1], batch_ocr_config) if key is not None else None for key in keys]
+        results = [self.__get_cached(key) for key in keys]
+        results = [result if result is not None else self.__get_cached(batch_key)
+                   for result, batch_key in zip(results, batch_keys)]
+        # Only run images through OCR which we don't have a cached result for
+        pending = [index for index, result in enumerate(results) if result is None]
+        if len(pending) < 2:
+            for index in pending:
+                results[index] = self.__image_to_string(images[index], ocr_config, keys[index])
+            return results
+
+        self.batches += 1
+        batch_result = self.__recognize(stack_images([images[index] for index in pending]), batch_ocr_config)
+        lines = [line.strip(' \x0c') for line in batch_result.splitlines() if line.strip(' \x0c') != '']
+        if len(lines) == len(pending):
+            for index, line in zip(pending, lines):
+                results[index] = line
+                self.__put_cached(batch_keys[index], line)
+            return results
+        elif not fallback:
+            return [result for result in results if result is not None] + lines
+
+        # At least one image did not result in exactly one line of text, so we cannot tell which line belongs to which
+        # image (e.g. if one image contains no detectable text at all)
+        self.batch_fallbacks += 1
+        for index in pending:
+            results[index] = self.__image_to_string(images[index], ocr_config, keys[index])
+
+        return results
+
+    def __image_to_string(self, image: ndarray, ocr_config: str, key: Optional[tuple]) -> str:
+        result = self.__get_cached(key)
+        if result is None:
+            result = self.__recognize(image, ocr_config)
+            self.__put_cached(key, result)
+
+        return result
+
+    def __recognize(self, image: ndarray, ocr_config: str) -> str:
+        if self.engine is None:
+            raise RuntimeError('No OCR engine has been set up')
+
+        return self.engine.image_to_string(image, ocr_config)
+
+    def __get_key(self, image: ndarray, ocr_config: str) -> Optional[tuple]:
+        return self.cache.key(image, ocr_config) if self.cache is not None else None
+
+    def __get_cached(self, key: Optional[tuple]) -> Optional[str]:
+        return self.cache.get(key) if self.cache is not None and key is not None else None
+
+    def __put_cached(self, key: Optional[tuple], result: str) -> None:
+        if self.cache is not None and key is not None:
+            self.cache.put(key, result)
+
+
+def get_batch_ocr_config(ocr_config: str) -> str:
+    # Stacked images need to be treated as a block of text instead of e.g. a single line
+    if PSM_REGEX.search(ocr_config) is None:
+        return f'{ocr_config} --psm 6'
+
+    return PSM_REGEX.sub('--psm 6', ocr_config)
+
+
+def get_background(image: ndarray) -> ndarray:
+    # Use the median of the border pixels as the background color
+    border = np.concatenate([image[0], image[-1], image[:, 0], image[:, -1]])
+    return np.median(border, axis=0).astype(np.uint8)
+
+
+def stack_images(images: List[ndarray]) -> ndarray:
+    """
+    Stack images vertically, left-aligned, with each image padded by its own background color
+    :param images: BGR or grayscale images to stack (all will be converted to BGR if any image is BGR)
+    :return:
+    """
+    color = any(image.ndim == 3 for image in images)
+    images = [cv2.cvtColor(image, cv2.COLOR_GRAY2BGR) if color and image.ndim == 2 else image for image in images]
+    # Leave enough space between images for Tesseract to not merge any lines
+    margin = max(8, max(image.shape[0] for image in images) // 2)
+    width = max(image.shape[1] for image in images) + 2 * margin
+
+    rows = []
+    for image in images:
+        height = image.shape[0]
+        padded = np.empty((height + 2 * margin, width, *image.shape[2:]), dtype=np.uint8)
+        padded[...] = get_background(image)
+        padded[margin:margin + height, margin:margin + image.shape[1]] = image
+        rows.append(padded)
+
+    return np.concatenate(rows)
+
+
+def create_ocr_engine(tesseract_path: str, engine: str = 'api', ocr_config: str = r'--oem 3 --psm 7') -> OCREngine:
+    """
+    Create an OCR engine, falling back to pytesseract if the Tesseract API cannot be used
+    :param tesseract_path: path to Tesseract install folder
+    :param engine: engine to use (api or pytesseract)
+    :param ocr_config: config to initialize the engine for right away
+    :return:
+    """
+    if engine == 'api':
+        try:
+            api_engine = TesseractAPIOCREngine(tesseract_path)
+            api_engine.warm_up(ocr_config)
+            return api_engine
+        except (OSError, AttributeError, RuntimeError) as e:
+            logger.warning(f'Failed to load Tesseract API, falling back to pytesseract ({e})')
+
+    return PytesseractOCREngine(tesseract_path)
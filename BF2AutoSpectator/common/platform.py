@@ -0,0 +1,646 @@
+import collections
+import ctypes
+import itertools
+import subprocess
+import threading
+from typing import Counter, Dict, List, Optional, Tuple
+
+from BF2AutoSpectator.common import constants
+from BF2AutoSpectator.common.classes import Singleton
+from BF2AutoSpectator.common.clock import Clock
+
+# C struct redefinitions
+PUL = ctypes.POINTER(ctypes.c_ulong)
+
+INPUT_MOUSE = 0
+INPUT_KEYBOARD = 1
+KEYEVENTF_EXTENDEDKEY = 0x0001
+KEYEVENTF_KEYUP = 0x0002
+KEYEVENTF_SCANCODE = 0x0008
+MOUSEEVENTF_MOVE = 0x0001
+MOUSEEVENTF_LEFTDOWN = 0x0002
+MOUSEEVENTF_LEFTUP = 0x0004
+MOUSEEVENTF_VIRTUALDESK = 0x4000
+MOUSEEVENTF_ABSOLUTE = 0x8000
+SM_XVIRTUALSCREEN = 76
+SM_YVIRTUALSCREEN = 77
+SM_CXVIRTUALSCREEN = 78
+SM_CYVIRTUALSCREEN = 79
+
+# (DirectInput) scan codes of keys used for typing/editing text
+SCAN_CODE_SHIFT = 0x2a
+SCAN_CODE_HOME = 0x47
+SCAN_CODE_END = 0x4f
+SCAN_CODE_DELETE = 0x53
+
+# Scan codes of printable characters (US keyboard layout), format: character: (scan code, shift)
+SCAN_CODES: Dict[str, Tuple[int, bool]] = {
+    **{c: (code, False) for c, code in zip('1234567890-=', range(0x02, 0x0e))},
+    **{c: (code, True) for c, code in zip('!@#$%^&*()_+', range(0x02, 0x0e))},
+    **{c: (code, False) for c, code in zip('qwertyuiop[]', range(0x10, 0x1c))},
+    **{c: (code, True) for c, code in zip('QWERTYUIOP{}', range(0x10, 0x1c))},
+    **{c: (code, False) for c, code in zip('asdfghjkl;\'`', range(0x1e, 0x2a))},
+    **{c: (code, True) for c, code in zip('ASDFGHJKL:"~', range(0x1e, 0x2a))},
+    '\\': (0x2b, False),
+    '|': (0x2b, True),
+    **{c: (code, False) for c, code in zip('zxcvbnm,./', range(0x2c, 0x36))},
+    **{c: (code, True) for c, code in zip('ZXCVBNM<>?', range(0x2c, 0x36))},
+    ' ': (0x39, False),
+}
+
+
+def get_key_press_events(scan_code: int, extended: bool = False, shift: bool = False) -> List[Tuple[int, int]]:
+    """
+    Get the key events of pressing and releasing a key
+    :param scan_code: scan code of the key
+    :param extended: whether the key is an extended key (e.g. home, end, delete)
+    :param shift: whether to hold shift while pressing the key
+    :return: key events, format: (scan code, flags)
+    """
+    flags = KEYEVENTF_SCANCODE | KEYEVENTF_EXTENDEDKEY if extended else KEYEVENTF_SCANCODE
+    events = [(scan_code, flags), (scan_code, flags | KEYEVENTF_KEYUP)]
+    if shift:
+        return [(SCAN_CODE_SHIFT, KEYEVENTF_SCANCODE), *events, (SCAN_CODE_SHIFT, KEYEVENTF_SCANCODE | KEYEVENTF_KEYUP)]
+
+    return events
+
+
+def get_text_key_events(text: str) -> Optional[List[List[Tuple[int, int]]]]:
+    """
+    Get the key events of typing text
+    :param text: text to type
+    :return: key events of each character, format: (scan code, flags), None if any character has no known scan code
+    """
+    if any(c not in SCAN_CODES for c in text):
+        return None
+
+    return [get_key_press_events(SCAN_CODES[c][0], shift=SCAN_CODES[c][1]) for c in text]
+
+
+def get_clear_text_input_key_events() -> List[Tuple[int, int]]:
+    # Select everything from the end of the input to the start and delete it. Ctrl+A cannot be used, since ctrl toggles
+    # the console. Move back to the end afterwards, so backspaces still work if the input does not support selecting.
+    return [
+        *get_key_press_events(SCAN_CODE_END, extended=True),
+        *get_key_press_events(SCAN_CODE_HOME, extended=True, shift=True),
+        *get_key_press_events(SCAN_CODE_DELETE, extended=True),
+        *get_key_press_events(SCAN_CODE_END, extended=True)
+    ]
+
+
+class Window:
+    handle: int
+    title: str
+    rect: Tuple[int, int, int, int]
+    class_name: str
+    pid: int
+
+    def __init__(self, handle: int, title: str, rect: Tuple[int, int, int, int], class_name: str, pid: int):
+        self.handle = handle
+        self.title = title
+        self.rect = rect
+        self.class_name = class_name
+        self.pid = pid
+
+    def get_size(self) -> Tuple[int, int]:
+        # Size on Windows contains the window header and the halo/shadow around the window,
+        # which needs to be subtracted to get the real size
+        left, top, right, bottom = self.rect
+        return right - constants.WINDOW_SHADOW_SIZE - left - constants.WINDOW_SHADOW_SIZE, \
+            bottom - constants.WINDOW_SHADOW_SIZE - top - constants.WINDOW_TITLE_BAR_HEIGHT
+
+
+class KeyBdInput(ctypes.Structure):
+    _fields_ = [("wVk", ctypes.c_ushort),
+                ("wScan", ctypes.c_ushort),
+                ("dwFlags", ctypes.c_ulong),
+                ("time", ctypes.c_ulong),
+                ("dwExtraInfo", PUL)]
+
+
+class HardwareInput(ctypes.Structure):
+    _fields_ = [("uMsg", ctypes.c_ulong),
+                ("wParamL", ctypes.c_short),
+                ("wParamH", ctypes.c_ushort)]
+
+
+class MouseInput(ctypes.Structure):
+    _fields_ = [("dx", ctypes.c_long),
+                ("dy", ctypes.c_long),
+                ("mouseData", ctypes.c_ulong),
+                ("dwFlags", ctypes.c_ulong),
+                ("time", ctypes.c_ulong),
+                ("dwExtraInfo", PUL)]
+
+
+class Input_I(ctypes.Union):
+    _fields_ = [("ki", KeyBdInput),
+                ("mi", MouseInput),
+                ("hi", HardwareInput)]
+
+
+class Input(ctypes.Structure):
+    _fields_ = [("type", ctypes.c_ulong),
+                ("ii", Input_I)]
+
+
+class Process:
+    """
+    Handle of a launched process
+    """
+    def poll(self) -> Optional[int]:
+        """
+        Check whether the process is still running
+        :return: None if the process is running, else its exit code
+        """
+        raise NotImplementedError
+
+
+class PlatformBackend:
+    """
+    Window, process and input primitives of the platform the game runs on. Screen coordinates are absolute, window
+    rects use the format (left, top, right, bottom) and include the title bar and the shadow around the window.
+    """
+    def find_windows(self) -> List[Window]:
+        """
+        Get all top level windows
+        :return:
+        """
+        raise NotImplementedError
+
+    def get_window_rect(self, handle: int) -> Optional[Tuple[int, int, int, int]]:
+        """
+        Get the current rect of a window
+        :param handle: handle of the window
+        :return: rect of the window, None if the window does not exist (anymore)
+        """
+        raise NotImplementedError
+
+    def bring_window_to_foreground(self, handle: int) -> None:
+        raise NotImplementedError
+
+    def get_cursor_state(self) -> Tuple[bool, Tuple[int, int]]:
+        """
+        Get whether the mouse cursor is shown and its position
+        :return: tuple of whether the cursor is shown and its position, format: (x, y)
+        """
+        raise NotImplementedError
+
+    def send_key(self, key_code: int, release: bool = False) -> None:
+        """
+        Press or release a key by its (DirectInput) scan code
+        :param key_code: scan code of the key
+        :param release: whether to release instead of press the key
+        :return:
+        """
+        raise NotImplementedError
+
+    def press_named_key(self, key: str, presses: int = 1, interval: float = 0.0) -> None:
+        """
+        Press (and release) a key by its name
+        :param key: name of the key (e.g. enter, tab, backspace)
+        :param presses: number of times to press the key
+        :param interval: number of seconds to wait between presses
+        :return:
+        """
+        raise NotImplementedError
+
+    def write_text(self, text: str, interval: float = 0.0) -> None:
+        """
+        Type text
+        :param text: text to type
+        :param interval: number of seconds to wait between characters
+        :return:
+        """
+        raise NotImplementedError
+
+    def type_text(self, text: str, interval: float = 0.0) -> None:
+        """
+        Type text via scan codes, sending the key events of all characters at once (or one character at a time if an
+        interval is given), which is much faster than typing character by character
+        :param text: text to type
+        :param interval: min. number of seconds to wait between characters
+        :return:
+        """
+        raise NotImplementedError
+
+    def clear_text_input(self) -> None:
+        """
+        Clear the focused text input by selecting all of its text and deleting it
+        :return:
+        """
+        raise NotImplementedError
+
+    def mouse_move_relative(self, dx: int, dy: int) -> None:
+        """
+        Move the mouse relative to its current position (by "mickeys", which is what the game uses outside menus)
+        :param dx: horizontal distance
+        :param dy: vertical distance
+        :return:
+        """
+        raise NotImplementedError
+
+    def mouse_move_to(self, x: int, y: int) -> None:
+        """
+        Move the mouse cursor to an absolute screen position
+        :param x: horizontal screen position
+        :param y: vertical screen position
+        :return:
+        """
+        raise NotImplementedError
+
+    def mouse_click(self) -> None:
+        """
+        Click the left mouse button at the cursor position
+        :return:
+        """
+        raise NotImplementedError
+
+    def mouse_button(self, release: bool = False) -> None:
+        """
+        Press or release the left mouse button via a raw mouse event
+        :param release: whether to release instead of press the button
+        :return:
+        """
+        raise NotImplementedError
+
+    def mouse_click_at(self, x: int, y: int) -> None:
+        """
+        Move the mouse cursor to an absolute screen position and click the left mouse button there, sent as one input
+        :param x: horizontal screen position
+        :param y: vertical screen position
+        :return:
+        """
+        raise NotImplementedError
+
+    def is_process_responding(self, pid: int) -> bool:
+        raise NotImplementedError
+
+    def is_process_running(self, pid: int) -> bool:
+        """
+        Check whether a process still exists (regardless of whether it responds)
+        :param pid: id of the process
+        :return:
+        """
+        raise NotImplementedError
+
+    def kill_process(self, pid: int) -> bool:
+        """
+        Kill a process and wait for it to exit
+        :param pid: id of the process
+        :return: True if the process is not running (anymore), else False
+        """
+        raise NotImplementedError
+
+    def get_process_command_line(self, pid: int) -> Optional[List[str]]:
+        raise NotImplementedError
+
+    def launch_process(self, command: List[str], cwd: str) -> Process:
+        raise NotImplementedError
+
+    def run_process(self, command: List[str], timeout: float) -> None:
+        """
+        Run a process to completion
+        :param command: command line to run
+        :param timeout: max. number of seconds to wait for the process to exit
+        :return:
+        :raises subprocess.SubprocessError: if the process times out or exits with a non-zero code
+        """
+        raise NotImplementedError
+
+
+class Win32PlatformBackend(PlatformBackend):
+    """
+    Primitives via the Win32 API (pywin32 and SendInput), pyautogui and psutil
+    """
+    def __init__(self):
+        import psutil
+        import pyautogui
+        import win32api
+        import win32con
+        import win32gui
+        import win32process
+        self.__psutil = psutil
+        self.__pyautogui = pyautogui
+        self.__win32api = win32api
+        self.__win32con = win32con
+        self.__win32gui = win32gui
+        self.__win32process = win32process
+
+        # Remove the top left corner from pyautogui failsafe points
+        # (avoid triggering failsafe exception due to mouse moving to top left during spawn)
+        if (0, 0) in pyautogui.FAILSAFE_POINTS:
+            pyautogui.FAILSAFE_POINTS.remove((0, 0))
+
+    def find_windows(self) -> List[Window]:
+        def window_enumeration_handler(hwnd: int, top_windows: list):
+            """Add window title and ID to array."""
+            tid, pid = self.__win32process.GetWindowThreadProcessId(hwnd)
+            window = Window(
+                hwnd,
+                self.__win32gui.GetWindowText(hwnd),
+                self.__win32gui.GetWindowRect(hwnd),
+                self.__win32gui.GetClassName(hwnd),
+                pid
+            )
+
+            top_windows.append(window)
+
+        windows = []
+        self.__win32gui.EnumWindows(window_enumeration_handler, windows)
+        return windows
+
+    def get_window_rect(self, handle: int) -> Optional[Tuple[int, int, int, int]]:
+        try:
+            return self.__win32gui.GetWindowRect(handle)
+        except self.__win32gui.error:  # PyCharm claims win32gui.error does not exist, but it does
+            return None
+
+    def bring_window_to_foreground(self, handle: int) -> None:
+        self.__win32gui.ShowWindow(handle, self.__win32con.SW_SHOW)
+        self.__win32gui.SetForegroundWindow(handle)
+
+    def get_cursor_state(self) -> Tuple[bool, Tuple[int, int]]:
+        # https://learn.microsoft.com/en-us/windows/win32/api/winuser/ns-winuser-cursorinfo
+        # Windows flags a hidden cursor with 0 and returns the handle as 0
+        flags, handle, position = self.__win32gui.GetCursorInfo()
+        return not (flags == 0 and handle == 0), position
+
+    def send_key(self, key_code: int, release: bool = False) -> None:
+        extra = ctypes.c_ulong(0)
+        ii_ = Input_I()
+        ii_.ki = KeyBdInput(0, key_code, 0x0008 | 0x0002 if release else 0x0008, 0, ctypes.pointer(extra))
+        x = Input(ctypes.c_ulong(1), ii_)
+        ctypes.windll.user32.SendInput(1, ctypes.pointer(x), ctypes.sizeof(x))
+
+    @staticmethod
+    def send_key_events(events: List[Tuple[int, int]]) -> None:
+        """
+        Send multiple key events with a single SendInput call
+        :param events: key events to send, format: (scan code, flags)
+        :return:
+        """
+        extra = ctypes.c_ulong(0)
+        inputs = (Input * len(events))()
+        for i, (scan_code, flags) in enumerate(events):
+            inputs[i].type = INPUT_KEYBOARD
+            inputs[i].ii.ki = KeyBdInput(0, scan_code, flags, 0, ctypes.pointer(extra))
+        ctypes.windll.user32.SendInput(len(events), inputs, ctypes.sizeof(Input))
+
+    def press_named_key(self, key: str, presses: int = 1, interval: float = 0.0) -> None:
+        self.__pyautogui.press(key, presses=presses, interval=interval)
+
+    def write_text(self, text: str, interval: float = 0.0) -> None:
+        self.__pyautogui.write(text, interval=interval)
+
+    def type_text(self, text: str, interval: float = 0.0) -> None:
+        key_events = get_text_key_events(text)
+        if key_events is None:
+            # Text contains characters we don't know the scan code of, so type it via virtual keys instead
+            self.__pyautogui.write(text, interval=interval)
+        elif interval <= 0:
+            self.send_key_events([event for events in key_events for event in events])
+        else:
+            for i, events in enumerate(key_events):
+                if i > 0:
+                    Clock().sleep(interval)
+                self.send_key_events(events)
+
+    def clear_text_input(self) -> None:
+        self.send_key_events(get_clear_text_input_key_events())
+
+    def mouse_move_relative(self, dx: int, dy: int) -> None:
+        self.__win32api.mouse_event(self.__win32con.MOUSEEVENTF_MOVE, dx, dy)
+
+    def mouse_move_to(self, x: int, y: int) -> None:
+        self.__pyautogui.moveTo(x, y)
+
+    def mouse_click(self) -> None:
+        self.__pyautogui.leftClick()
+
+    def mouse_button(self, release: bool = False) -> None:
+        flag = self.__win32con.MOUSEEVENTF_LEFTUP if release else self.__win32con.MOUSEEVENTF_LEFTDOWN
+        self.__win32api.mouse_event(flag, 0, 0, 0, 0)
+
+    def mouse_click_at(self, x: int, y: int) -> None:
+        # Absolute coordinates are normalized to 0-65535 across the virtual desktop (all monitors)
+        left = self.__win32api.GetSystemMetrics(SM_XVIRTUALSCREEN)
+        top = self.__win32api.GetSystemMetrics(SM_YVIRTUALSCREEN)
+        width = self.__win32api.GetSystemMetrics(SM_CXVIRTUALSCREEN)
+        height = self.__win32api.GetSystemMetrics(SM_CYVIRTUALSCREEN)
+        dx = round((x - left) * 65535 / max(width - 1, 1))
+        dy = round((y - top) * 65535 / max(height - 1, 1))
+
+        extra = ctypes.c_ulong(0)
+        events = [
+            (dx, dy, MOUSEEVENTF_MOVE | MOUSEEVENTF_ABSOLUTE | MOUSEEVENTF_VIRTUALDESK),
+            (0, 0, MOUSEEVENTF_LEFTDOWN),
+            (0, 0, MOUSEEVENTF_LEFTUP)
+        ]
+        inputs = (Input * len(events))()
+        for i, (event_dx, event_dy, flags) in enumerate(events):
+            inputs[i].type = INPUT_MOUSE
+            inputs[i].ii.mi = MouseInput(event_dx, event_dy, 0, flags, 0, ctypes.pointer(extra))
+        ctypes.windll.user32.SendInput(len(events), inputs, ctypes.sizeof(Input))
+
+    def is_process_responding(self, pid: int) -> bool:
+        try:
+            return self.__psutil.Process(pid=pid).status() == self.__psutil.STATUS_RUNNING
+        except (self.__psutil.NoSuchProcess, self.__psutil.AccessDenied):
+            return False
+
+    def is_process_running(self, pid: int) -> bool:
+        try:
+            return self.__psutil.Process(pid=pid).status() != self.__psutil.STATUS_ZOMBIE
+        except self.__psutil.NoSuchProcess:
+            return False
+        except self.__psutil.AccessDenied:
+            # Process exists, but belongs to someone else
+            return True
+
+    def kill_process(self, pid: int) -> bool:
+        try:
+            process = self.__psutil.Process(pid=pid)
+            process.kill()
+            process.wait(5)
+            return not process.is_running()
+        except self.__psutil.NoSuchProcess:
+            return True
+        except self.__psutil.AccessDenied:
+            return False
+
+    def get_process_command_line(self, pid: int) -> Optional[List[str]]:
+        try:
+            return self.__psutil.Process(pid=pid).cmdline()
+        except (self.__psutil.NoSuchProcess, self.__psutil.AccessDenied):
+            return None
+
+    def launch_process(self, command: List[str], cwd: str) -> subprocess.Popen:
+        return subprocess.Popen(
+            command,
+            close_fds=True, cwd=cwd,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+
+    def run_process(self, command: List[str], timeout: float) -> None:
+        p = subprocess.run(command, timeout=timeout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        p.check_returncode()
+
+
+class SimulatedProcess(Process):
+    pid: int
+    command_line: List[str]
+    running: bool
+    responding: bool
+
+    def __init__(self, pid: int, command_line: List[str]):
+        self.pid = pid
+        self.command_line = command_line
+        self.running = True
+        self.responding = True
+
+    def poll(self) -> Optional[int]:
+        return None if self.running else 0
+
+
+class SimulatedPlatformBackend(PlatformBackend):
+    """
+    In-memory platform for running the spectator off Windows (replays, benchmarks, tests). Windows and processes are
+    plain data that can be set up/changed as needed, input does nothing but move the simulated cursor and get counted.
+    Waits between key presses/characters still pass on the clock, so timing matches real input.
+    """
+    windows: List[Window]
+    processes: Dict[int, SimulatedProcess]
+    cursor: Tuple[int, int]
+    cursor_shown: bool
+    foreground: Optional[int]
+    inputs: Counter[str]
+
+    def __init__(self):
+        self.windows = []
+        self.processes = {}
+        self.cursor = (0, 0)
+        self.cursor_shown = True
+        self.foreground = None
+        self.inputs = collections.Counter()
+
+        self.__pids = itertools.count(1000)
+        self.__lock = threading.Lock()
+
+    def add_process(self, command_line: List[str]) -> SimulatedProcess:
+        with self.__lock:
+            process = SimulatedProcess(next(self.__pids), command_line)
+            self.processes[process.pid] = process
+            return process
+
+    def add_window(self, title: str, rect: Tuple[int, int, int, int], class_name: str, pid: int) -> Window:
+        with self.__lock:
+            window = Window(len(self.windows) + 1, title, rect, class_name, pid)
+            self.windows.append(window)
+            return window
+
+    def __count(self, name: str, count: int = 1) -> None:
+        with self.__lock:
+            self.inputs[name] += count
+
+    def find_windows(self) -> List[Window]:
+        with self.__lock:
+            return [window for window in self.windows if window.pid not in self.processes or
+                    self.processes[window.pid].running]
+
+    def get_window_rect(self, handle: int) -> Optional[Tuple[int, int, int, int]]:
+        return next((window.rect for window in self.find_windows() if window.handle == handle), None)
+
+    def bring_window_to_foreground(self, handle: int) -> None:
+        self.__count('bring_window_to_foreground')
+        self.foreground = handle
+
+    def get_cursor_state(self) -> Tuple[bool, Tuple[int, int]]:
+        return self.cursor_shown, self.cursor
+
+    def send_key(self, key_code: int, release: bool = False) -> None:
+        self.__count('release_key' if release else 'press_key')
+
+    def press_named_key(self, key: str, presses: int = 1, interval: float = 0.0) -> None:
+        self.__count('press_named_key', presses)
+        if presses > 1 and interval > 0:
+            Clock().sleep((presses - 1) * interval)
+
+    def write_text(self, text: str, interval: float = 0.0) -> None:
+        self.__count('write_text_characters', len(text))
+        if len(text) > 1 and interval > 0:
+            Clock().sleep((len(text) - 1) * interval)
+
+    def type_text(self, text: str, interval: float = 0.0) -> None:
+        self.__count('type_text_characters', len(text))
+        if len(text) > 1 and interval > 0:
+            Clock().sleep((len(text) - 1) * interval)
+
+    def clear_text_input(self) -> None:
+        self.__count('clear_text_input')
+
+    def mouse_move_relative(self, dx: int, dy: int) -> None:
+        self.__count('mouse_move_relative')
+        self.cursor = self.cursor[0] + dx, self.cursor[1] + dy
+
+    def mouse_move_to(self, x: int, y: int) -> None:
+        self.__count('mouse_move_to')
+        self.cursor = x, y
+
+    def mouse_click(self) -> None:
+        self.__count('mouse_click')
+
+    def mouse_button(self, release: bool = False) -> None:
+        self.__count('mouse_button_release' if release else 'mouse_button_press')
+
+    def mouse_click_at(self, x: int, y: int) -> None:
+        self.__count('mouse_click_at')
+        self.cursor = x, y
+
+    def is_process_responding(self, pid: int) -> bool:
+        process = self.processes.get(pid)
+        return process is not None and process.running and process.responding
+
+    def is_process_running(self, pid: int) -> bool:
+        process = self.processes.get(pid)
+        return process is not None and process.running
+
+    def kill_process(self, pid: int) -> bool:
+        self.__count('kill_process')
+        process = self.processes.get(pid)
+        if process is not None:
+            process.running = False
+        return True
+
+    def get_process_command_line(self, pid: int) -> Optional[List[str]]:
+        process = self.processes.get(pid)
+        return process.command_line if process is not None and process.running else None
+
+    def launch_process(self, command: List[str], cwd: str) -> SimulatedProcess:
+        self.__count('launch_process')
+        return self.add_process(command)
+
+    def run_process(self, command: List[str], timeout: float) -> None:
+        self.__count('run_process')
+
+
+class Platform(metaclass=Singleton):
+    """
+    Holds the backend used for all window, process and input primitives (Win32, unless set otherwise)
+    """
+    backend: Optional[PlatformBackend]
+
+    def __init__(self):
+        self.backend = None
+        self.__lock = threading.Lock()
+
+    def set_backend(self, backend: PlatformBackend) -> None:
+        with self.__lock:
+            self.backend = backend
+
+    def get_backend(self) -> PlatformBackend:
+        with self.__lock:
+            # Only load the Win32 modules once they are actually needed
+            if self.backend is None:
+                self.backend = Win32PlatformBackend()
+            return self.backend
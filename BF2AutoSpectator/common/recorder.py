@@ -0,0 +1,368 @@
+import atexit
+import collections
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+import zipfile
+from datetime import datetime
+from typing import Any, Callable, Deque, Dict, List, Optional, Set, Tuple, TypeVar
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from BF2AutoSpectator.common.classes import Singleton
+from BF2AutoSpectator.common.logger import logger
+
+F = TypeVar('F', bound=Callable)
+
+ARCHIVE_VERSION = 1
+INDEX_FILE = 'index.json'
+CHUNK_EVENTS_FILE = 'events.jsonl'
+
+
+def get_frame_hash(frame: ndarray) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str(frame.shape).encode())
+    digest.update(frame.tobytes())
+    return digest.hexdigest()
+
+
+def get_frame_path(frame_hash: str) -> str:
+    return f'frames/{frame_hash}.png'
+
+
+def get_event_size(event: dict) -> int:
+    frame = event.get('frame')
+    return frame.nbytes if frame is not None else 0
+
+
+def to_record_value(value: Any) -> Any:
+    # Only keep values that can be written as JSON (and replayed), describe anything else by its type
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    elif isinstance(value, (list, tuple)):
+        return [to_record_value(item) for item in value]
+    elif isinstance(value, dict):
+        return {str(key): to_record_value(item) for key, item in value.items()}
+    elif hasattr(value, '__dict__'):
+        return {'type': type(value).__name__, **{
+            key: to_record_value(item) for key, item in vars(value).items() if not key.startswith('_')
+        }}
+
+    return type(value).__name__
+
+
+class SessionRecorder(metaclass=Singleton):
+    """
+    Records a session (captured frames, detector results, input actions, environment queries and controller commands)
+    to a chunked archive for offline analysis/replay. Events are timestamped on the calling thread but hashed, compressed
+    and written on a background thread, fed by a queue bounded by number of events and by size of the queued frames
+    (the oldest queued events get dropped if the writer cannot keep up). Frames identical to the previous frame of the
+    same region are not queued again, only referenced. A session is a directory holding an index and one zip file per
+    chunk. Each chunk contains its events as JSON lines and every distinct frame referenced by them as PNG, so chunks can
+    be rotated out (oldest first) to stay within the size cap.
+    """
+    CHUNK_PREFIX = 'chunk-'
+    # Max. number of regions to remember the previous frame of (regions change whenever the game window moves)
+    MAX_PREVIOUS_FRAMES = 64
+
+    enabled: bool
+    directory: Optional[str]
+    chunk_size: int
+    chunk_duration: float
+    quota: int
+    queue_size: int
+    queue_bytes: int
+    dropped: int
+
+    __queue: Deque[dict]
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.chunk_size = 16 * 1000 * 1000
+        self.chunk_duration = 60.0
+        self.quota = 0
+        self.queue_size = 256
+        self.queue_bytes = 64 * 1000 * 1000
+        self.dropped = 0
+
+        self.__queue = collections.deque()
+        self.__queued_bytes = 0
+        self.__previous_frames: Dict[Tuple[int, int, int, int], ndarray] = {}
+        self.__started_at = time.monotonic()
+        self.__condition = threading.Condition()
+        self.__thread = None
+
+        # Writer thread state
+        self.__index = {}
+        self.__chunk: Optional[zipfile.ZipFile] = None
+        self.__chunk_info = {}
+        self.__chunk_events: List[str] = []
+        self.__chunk_frames: Set[str] = set()
+        self.__chunk_opened_at = 0.0
+        self.__chunk_num = 0
+        # Hash, shape and PNG of the last frame written per region, format: region: (hash, shape, encoded)
+        self.__written_frames: Dict[Tuple[int, ...], Tuple[str, List[int], bytes]] = {}
+
+    def configure(self, directory: str, meta: dict, chunk_size_mb: int = 16, chunk_duration: float = 60.0,
+                  quota_mb: int = 0, queue_size: int = 256, queue_size_mb: int = 64) -> None:
+        """
+        Configure the recorder and start recording a new session
+        :param directory: directory to create the session directory in
+        :param meta: details of the session to add to the index (e.g. resolution)
+        :param chunk_size_mb: max. size of a chunk in megabytes before starting a new one
+        :param chunk_duration: max. number of seconds a chunk covers before starting a new one (limits what is lost if
+        the process dies, since a chunk's events are only written when it is closed)
+        :param quota_mb: max. size of all chunks of the session in megabytes, older chunks get deleted (0 = no limit)
+        :param queue_size: max. number of events waiting to be written
+        :param queue_size_mb: max. size of frames waiting to be written in megabytes
+        :return:
+        """
+        started_at = datetime.now()
+        session_directory = os.path.join(directory, f'session-{started_at.strftime("%Y-%m-%d-%H-%M-%S")}')
+        os.makedirs(session_directory, exist_ok=True)
+
+        with self.__condition:
+            self.directory = session_directory
+            self.chunk_size = chunk_size_mb * 1000 * 1000
+            self.chunk_duration = chunk_duration
+            self.quota = quota_mb * 1000 * 1000
+            self.queue_size = queue_size
+            self.queue_bytes = queue_size_mb * 1000 * 1000
+            self.__queue = collections.deque()
+            self.__queued_bytes = 0
+            self.__previous_frames = {}
+            self.__started_at = time.monotonic()
+            self.__index = {
+                'version': ARCHIVE_VERSION,
+                'started_at': started_at.isoformat(),
+                'meta': to_record_value(meta),
+                'chunks': []
+            }
+            self.enabled = True
+            self.__ensure_thread()
+
+        # Close the current chunk when exiting, else its events are lost
+        atexit.register(self.stop)
+
+        logger.info(f'Recording session to {session_directory}')
+
+    def stop(self) -> None:
+        """
+        Stop recording, writing any queued events and closing the current chunk
+        :return:
+        """
+        with self.__condition:
+            if not self.enabled:
+                return
+            self.enabled = False
+            self.__queue.append({'type': 'stop'})
+            self.__condition.notify()
+            thread = self.__thread
+
+        if thread is not None:
+            thread.join(10)
+
+    def record_frame(self, region: Tuple[int, int, int, int], frame: ndarray) -> None:
+        if not self.enabled:
+            return
+
+        # Frames are not modified once captured, so queue them as is and hash them on the writer thread. If the region
+        # still shows the same as last time, only queue a reference to the previous frame (costs no queue space).
+        previous = self.__previous_frames.get(region)
+        if previous is not None and previous.shape == frame.shape and np.array_equal(previous, frame):
+            self.__submit({'type': 'frame', 'region': list(region), 'repeat': True})
+            return
+
+        if len(self.__previous_frames) >= self.MAX_PREVIOUS_FRAMES and region not in self.__previous_frames:
+            self.__previous_frames.clear()
+        self.__previous_frames[region] = frame
+        self.__submit({'type': 'frame', 'region': list(region)}, frame)
+
+    def record_detector(self, name: str, result: bool, reused: bool) -> None:
+        self.__submit({'type': 'detector', 'name': name, 'result': result, 'reused': reused})
+
+    def record_input(self, name: str, args: Any) -> None:
+        self.__submit({'type': 'input', 'name': name, 'args': to_record_value(args)})
+
+    def record_query(self, name: str, args: Any, result: Any) -> None:
+        self.__submit({'type': 'query', 'name': name, 'args': to_record_value(args), 'result': to_record_value(result)})
+
+    def record_sleep(self, seconds: float) -> None:
+        self.__submit({'type': 'sleep', 'seconds': seconds})
+
+    def record_command(self, name: str, args: Any) -> None:
+        self.__submit({'type': 'command', 'name': name, 'args': to_record_value(args)})
+
+    def record_phase(self, phase: str) -> None:
+        self.__submit({'type': 'phase', 'phase': phase})
+
+    def __submit(self, event: dict, frame: Optional[ndarray] = None) -> None:
+        if not self.enabled:
+            return
+
+        event['t'] = time.monotonic() - self.__started_at
+        if frame is not None:
+            event['frame'] = frame
+        with self.__condition:
+            self.__queue.append(event)
+            self.__queued_bytes += get_event_size(event)
+            # Make room by dropping the oldest events, the newest one is kept in any case
+            while len(self.__queue) > 1 and (
+                    len(self.__queue) > self.queue_size or self.__queued_bytes > self.queue_bytes
+            ):
+                self.__queued_bytes -= get_event_size(self.__queue.popleft())
+                self.dropped += 1
+                if self.dropped % 100 == 1:
+                    logger.warning(f'Session recorder cannot keep up, dropped {self.dropped} events so far')
+            self.__condition.notify()
+
+    def __ensure_thread(self) -> None:
+        if self.__thread is None or not self.__thread.is_alive():
+            self.__thread = threading.Thread(target=self.__run, name='SessionRecorder', daemon=True)
+            self.__thread.start()
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                while len(self.__queue) == 0:
+                    # Wake up regularly to close chunks that have been open for too long
+                    if not self.__condition.wait(self.chunk_duration):
+                        break
+                event = self.__queue.popleft() if len(self.__queue) > 0 else None
+                if event is not None:
+                    self.__queued_bytes -= get_event_size(event)
+
+            try:
+                if event is not None and event['type'] == 'stop':
+                    self.__close_chunk()
+                    return
+                elif event is not None:
+                    self.__write(event)
+
+                if self.__chunk is not None and (
+                        self.__chunk_info['bytes'] >= self.chunk_size or
+                        time.monotonic() - self.__chunk_opened_at >= self.chunk_duration
+                ):
+                    self.__close_chunk()
+            except (OSError, cv2.error, zipfile.BadZipFile) as e:
+                logger.error(f'Failed to write session recording: {e}')
+
+    def __write(self, event: dict) -> None:
+        if self.__chunk is None:
+            self.__open_chunk()
+
+        if event['type'] == 'frame' and not self.__write_frame(event):
+            return
+
+        line = json.dumps(event, separators=(',', ':'))
+        self.__chunk_events.append(line)
+        self.__chunk_info['events'] += 1
+        self.__chunk_info['bytes'] += len(line)
+        self.__chunk_info['start'] = min(self.__chunk_info['start'], event['t'])
+        self.__chunk_info['end'] = max(self.__chunk_info['end'], event['t'])
+
+    def __write_frame(self, event: dict) -> bool:
+        region = tuple(event['region'])
+        frame = event.pop('frame', None)
+        written = self.__written_frames.get(region)
+        if event.pop('repeat', False):
+            # Repeat of the region's previous frame, which may have been dropped from the queue
+            if written is None:
+                return False
+            frame_hash, shape, encoded = written
+        else:
+            frame_hash, shape = get_frame_hash(frame), list(frame.shape)
+            if written is not None and written[0] == frame_hash:
+                encoded = written[2]
+            else:
+                ok, png = cv2.imencode('.png', frame, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+                if not ok:
+                    raise OSError('cv2 failed to encode frame')
+                encoded = png.tobytes()
+            if len(self.__written_frames) >= self.MAX_PREVIOUS_FRAMES and region not in self.__written_frames:
+                self.__written_frames.clear()
+            self.__written_frames[region] = frame_hash, shape, encoded
+
+        event['hash'] = frame_hash
+        event['shape'] = shape
+        # Frames only need to be written once per chunk
+        if frame_hash not in self.__chunk_frames:
+            self.__chunk.writestr(get_frame_path(frame_hash), encoded)
+            self.__chunk_frames.add(frame_hash)
+            self.__chunk_info['frames'] += 1
+            self.__chunk_info['bytes'] += len(encoded)
+
+        return True
+
+    def __open_chunk(self) -> None:
+        self.__chunk_num += 1
+        filename = f'{self.CHUNK_PREFIX}{self.__chunk_num:05d}.zip'
+        # Frames are compressed as PNG already, so store them as they are
+        self.__chunk = zipfile.ZipFile(os.path.join(self.directory, filename), 'w', zipfile.ZIP_STORED)
+        self.__chunk_info = {'file': filename, 'start': float('inf'), 'end': 0.0, 'events': 0, 'frames': 0, 'bytes': 0}
+        self.__chunk_events = []
+        self.__chunk_frames = set()
+        self.__chunk_opened_at = time.monotonic()
+
+    def __close_chunk(self) -> None:
+        if self.__chunk is None:
+            return
+
+        self.__chunk.writestr(CHUNK_EVENTS_FILE, '\n'.join(self.__chunk_events), zipfile.ZIP_DEFLATED)
+        self.__chunk.close()
+        self.__chunk = None
+        self.__chunk_info['bytes'] = os.path.getsize(os.path.join(self.directory, self.__chunk_info['file']))
+        self.__index['chunks'].append(self.__chunk_info)
+        self.__index['dropped'] = self.dropped
+
+        # Rotate out the oldest chunks until we are back within the quota
+        chunks = self.__index['chunks']
+        while 0 < self.quota < sum(chunk['bytes'] for chunk in chunks) and len(chunks) > 1:
+            oldest = chunks.pop(0)
+            try:
+                os.remove(os.path.join(self.directory, oldest['file']))
+            except OSError as e:
+                logger.error(f'Failed to remove old session recording chunk: {e}')
+
+        with open(os.path.join(self.directory, INDEX_FILE), 'w') as f:
+            json.dump(self.__index, f, indent=2)
+
+
+def recorded_input(func: F) -> F:
+    """
+    Record each call of the decorated input function (while recording is enabled)
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        recorder = SessionRecorder()
+        if recorder.enabled:
+            recorder.record_input(name, {'args': args, 'kwargs': kwargs})
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def recorded_query(func: F) -> F:
+    """
+    Record each call of the decorated function querying the environment, along with its result (while recording is
+    enabled), so it can be answered the same way when replaying
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        result = func(*args, **kwargs)
+        recorder = SessionRecorder()
+        if recorder.enabled:
+            recorder.record_query(name, {'args': args, 'kwargs': kwargs}, result)
+        return result
+
+    return wrapper
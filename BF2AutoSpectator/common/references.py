@@ -0,0 +1,182 @@
+import argparse
+import json
+import os
+import pickle
+import threading
+from typing import Dict, Iterator, List, Mapping, Optional, Tuple
+
+import numpy as np
+from numpy import ndarray
+
+from BF2AutoSpectator.common.exceptions import SpectatorException
+
+
+class ReferenceStoreException(SpectatorException):
+    pass
+
+
+class ReferenceStore:
+    """
+    Reference histograms stored as a flat binary file of float32 rows (one histogram per row) plus a JSON index mapping
+    resolution/category/name paths to row indices. The binary file is memory-mapped, so histograms are only read from
+    disk once they are accessed.
+    """
+    SCHEMA_VERSION = 1
+    INDEX_FILENAME = 'histograms.json'
+    DATA_FILENAME = 'histograms.bin'
+
+    directory: str
+    index: dict
+
+    __data: Optional[np.memmap]
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, self.INDEX_FILENAME), 'r') as index_file:
+            self.index = json.load(index_file)
+
+        schema_version = self.index.get('schema_version')
+        if schema_version != self.SCHEMA_VERSION:
+            raise ReferenceStoreException(f'Unsupported reference store schema version: {schema_version} '
+                                          f'(expected {self.SCHEMA_VERSION})')
+
+        self.__data = None
+        self.__lock = threading.Lock()
+
+    def get_resolutions(self) -> List[str]:
+        return list(self.index['entries'].keys())
+
+    def load(self, resolution: str) -> 'LazyHistograms':
+        """
+        Get the histograms of a resolution (categories are loaded on first access)
+        :param resolution: resolution to get histograms of
+        :return:
+        """
+        if resolution not in self.index['entries']:
+            raise ReferenceStoreException(f'No reference histograms found for resolution: {resolution}')
+
+        return LazyHistograms(self, resolution)
+
+    def load_category(self, resolution: str, category: str) -> dict:
+        """
+        Get the histograms of a single category of a resolution as a nested dict (same layout as the original pickle)
+        :param resolution: resolution to get histograms of
+        :param category: category to get histograms of, e.g. "teams"
+        :return:
+        """
+        data = self.__get_data()
+        histograms = {}
+        for path, row in self.index['entries'][resolution][category].items():
+            *parents, name = path.split('/')
+            node = histograms
+            for parent in parents:
+                node = node.setdefault(parent, {})
+            # cv2 expects histograms of shape (bins, 1)
+            node[name] = data[row].reshape((-1, 1))
+
+        # Categories consisting of a single histogram (rather than a dict of histograms) are stored under an empty path
+        return histograms[''] if '' in histograms else histograms
+
+    def __get_data(self) -> np.memmap:
+        with self.__lock:
+            if self.__data is None:
+                self.__data = np.memmap(
+                    os.path.join(self.directory, self.index['data']),
+                    dtype=np.dtype(self.index['dtype']),
+                    mode='r',
+                    shape=(self.index['rows'], self.index['bins'])
+                )
+
+            return self.__data
+
+
+class LazyHistograms(Mapping):
+    """
+    Read-only mapping of category to histograms for a single resolution, loading each category on first access
+    """
+    store: ReferenceStore
+    resolution: str
+
+    __categories: Dict[str, dict]
+
+    def __init__(self, store: ReferenceStore, resolution: str):
+        self.store = store
+        self.resolution = resolution
+        self.__categories = {}
+
+    def __getitem__(self, category: str) -> dict:
+        if category not in self.store.index['entries'][self.resolution]:
+            raise KeyError(category)
+
+        if category not in self.__categories:
+            self.__categories[category] = self.store.load_category(self.resolution, category)
+
+        return self.__categories[category]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.store.index['entries'][self.resolution])
+
+    def __len__(self) -> int:
+        return len(self.store.index['entries'][self.resolution])
+
+
+def flatten_histograms(histograms: dict, prefix: str = '') -> Iterator[Tuple[str, ndarray]]:
+    for key, value in histograms.items():
+        path = f'{prefix}/{key}' if prefix != '' else key
+        if isinstance(value, dict):
+            yield from flatten_histograms(value, path)
+        else:
+            yield path, value
+
+
+def write_store(histograms: dict, directory: str) -> None:
+    """
+    Write histograms to a reference store
+    :param histograms: histograms by resolution, category and name (layout of the original pickle)
+    :param directory: directory to write the store's index and data file to
+    :return:
+    """
+    entries = {}
+    rows = []
+    for resolution, categories in histograms.items():
+        entries[resolution] = {}
+        for category, items in categories.items():
+            paths = flatten_histograms(items) if isinstance(items, dict) else [('', items)]
+            entries[resolution][category] = {}
+            for path, histogram in paths:
+                entries[resolution][category][path] = len(rows)
+                rows.append(np.asarray(histogram, dtype='<f4').ravel())
+
+    bins = len(rows[0]) if len(rows) > 0 else 256
+    if any(len(row) != bins for row in rows):
+        raise ReferenceStoreException('All histograms must have the same number of bins')
+
+    os.makedirs(directory, exist_ok=True)
+    np.stack(rows).astype('<f4').tofile(os.path.join(directory, ReferenceStore.DATA_FILENAME))
+    index = {
+        'schema_version': ReferenceStore.SCHEMA_VERSION,
+        'data': ReferenceStore.DATA_FILENAME,
+        'dtype': '<f4',
+        'rows': len(rows),
+        'bins': bins,
+        'entries': entries
+    }
+    with open(os.path.join(directory, ReferenceStore.INDEX_FILENAME), 'w') as index_file:
+        json.dump(index, index_file, indent=2)
+        index_file.write('\n')
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        prog='BF2AutoSpectator reference store converter',
+        description='Convert a histograms pickle to a reference store'
+    )
+    parser.add_argument('pickle', help='Path to histograms pickle', type=str)
+    parser.add_argument('--output', help='Folder to write the reference store to', type=str, default='references')
+    args = parser.parse_args()
+
+    with open(args.pickle, 'rb') as histogram_file:
+        histograms = pickle.load(histogram_file)
+
+    write_store(histograms, args.output)
+    print(f'Wrote reference store to {args.output}')
@@ -0,0 +1,190 @@
+import collections
+import functools
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Deque, Optional, TypeVar
+
+from BF2AutoSpectator.common.classes import Singleton
+from BF2AutoSpectator.common.logger import logger
+
+F = TypeVar('F', bound=Callable)
+
+
+class Span:
+    """
+    Context manager recording the with block as a complete ("X") trace event
+    """
+    tracer: 'Tracer'
+    name: str
+    category: str
+    args: Optional[dict]
+    started_at: float
+
+    def __init__(self, tracer: 'Tracer', name: str, category: str, args: Optional[dict]):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self) -> 'Span':
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.tracer.add_complete(self.name, self.category, self.started_at, time.perf_counter(), self.args)
+
+
+class NullSpan:
+    def __enter__(self) -> 'NullSpan':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer(metaclass=Singleton):
+    """
+    Buffers spans (of screenshots, OCR, histograms, input and sleeps) in memory while enabled and writes them to disk as
+    Chrome Trace Event JSON (viewable in chrome://tracing or https://ui.perfetto.dev). The buffer is bounded, dropping
+    the oldest events if it is not flushed in time.
+    """
+    FILE_PREFIX = 'trace-'
+
+    enabled: bool
+    directory: Optional[str]
+    flush_ticks: int
+    dropped: int
+
+    __events: Deque[dict]
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.flush_ticks = 0
+        self.dropped = 0
+
+        self.__events = collections.deque(maxlen=200000)
+        self.__ticks = 0
+        self.__started_at = time.perf_counter()
+        self.__pid = os.getpid()
+        self.__lock = threading.Lock()
+
+    def configure(self, directory: str, flush_ticks: int = 0, max_events: int = 200000) -> None:
+        """
+        Configure and enable the tracer
+        :param directory: directory to write trace files to
+        :param flush_ticks: write a trace file every n main loop iterations (0 = only write when flushed explicitly)
+        :param max_events: max. number of events to buffer
+        :return:
+        """
+        with self.__lock:
+            self.directory = directory
+            self.flush_ticks = flush_ticks
+            self.__events = collections.deque(self.__events, maxlen=max_events)
+            self.enabled = True
+
+    def span(self, name: str, category: str, args: Optional[dict] = None):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, category, args)
+
+    def add_complete(self, name: str, category: str, started_at: float, ended_at: float,
+                     args: Optional[dict] = None) -> None:
+        self.__add({
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (started_at - self.__started_at) * 1e6,
+            'dur': (ended_at - started_at) * 1e6,
+            'pid': self.__pid,
+            'tid': threading.get_ident(),
+            **({'args': args} if args is not None else {})
+        })
+
+    def instant(self, name: str, category: str, args: Optional[dict] = None) -> None:
+        if not self.enabled:
+            return
+        self.__add({
+            'name': name,
+            'cat': category,
+            'ph': 'i',
+            's': 'p',
+            'ts': (time.perf_counter() - self.__started_at) * 1e6,
+            'pid': self.__pid,
+            'tid': threading.get_ident(),
+            **({'args': args} if args is not None else {})
+        })
+
+    def __add(self, event: dict) -> None:
+        with self.__lock:
+            if len(self.__events) == self.__events.maxlen:
+                self.dropped += 1
+            self.__events.append(event)
+
+    def tick(self) -> None:
+        """
+        Mark the start of a main loop iteration, writing a trace file every n iterations if configured
+        :return:
+        """
+        if not self.enabled:
+            return
+
+        self.instant('tick', 'loop')
+        self.__ticks += 1
+        if self.flush_ticks > 0 and self.__ticks % self.flush_ticks == 0:
+            self.flush()
+
+    def flush(self) -> Optional[str]:
+        """
+        Write all buffered events to a new trace file (and clear the buffer)
+        :return: path of the written file, None if there was nothing to write
+        """
+        with self.__lock:
+            events = list(self.__events)
+            self.__events.clear()
+
+        if len(events) == 0 or self.directory is None:
+            return None
+
+        path = os.path.join(self.directory, f'{self.FILE_PREFIX}{datetime.now().strftime("%Y-%m-%d-%H-%M-%S-%f")}.json')
+        try:
+            with open(path, 'w') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, separators=(',', ':'))
+        except OSError as e:
+            logger.error(f'Failed to write trace file ({e})')
+            return None
+
+        logger.debug(f'Wrote {len(events)} trace events to {path}')
+        return path
+
+
+def traced(category: str) -> Callable[[F], F]:
+    """
+    Record each call of the decorated function as a span (while tracing is enabled)
+    :param category: category to record the spans under
+    :return:
+    """
+    def decorator(func: F) -> F:
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = Tracer()
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+
+            started_at = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                tracer.add_complete(name, category, started_at, time.perf_counter())
+
+        return wrapper
+
+    return decorator
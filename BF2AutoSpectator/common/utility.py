@@ -1,159 +1,296 @@
-import ctypes
+import functools
 import os
-import subprocess
-import time
-from datetime import datetime
+import threading
 from enum import Enum
-from typing import Optional, Tuple, List, Union
+from typing import Optional, Tuple, List, Union, Dict, Set
 
 import cv2
 import jellyfish
 import numpy as np
-import psutil
-import pyautogui
-import pytesseract
-import win32api
-import win32con
-import win32gui
-import win32process
 from PIL import Image, ImageOps
 from numpy import ndarray
 
 from BF2AutoSpectator.common import constants
+from BF2AutoSpectator.common.capture import CaptureBackend, DesktopCaptureBackend, CapturePlan, build_capture_plan
+from BF2AutoSpectator.common.classes import Singleton
+from BF2AutoSpectator.common.clock import Clock
 from BF2AutoSpectator.common.config import Config
+from BF2AutoSpectator.common.debug import DebugScreenshotWriter
+from BF2AutoSpectator.common.labels import LabelMatcher
 from BF2AutoSpectator.common.logger import logger
+from BF2AutoSpectator.common.metrics import Metrics
+from BF2AutoSpectator.common.ocr import OCR
+from BF2AutoSpectator.common.platform import Platform, PlatformBackend, Process, Window
+from BF2AutoSpectator.common.recorder import SessionRecorder, recorded_input, recorded_query
+from BF2AutoSpectator.common.tracing import Tracer, traced
 
-SendInput = ctypes.windll.user32.SendInput
-# C struct redefinitions
-PUL = ctypes.POINTER(ctypes.c_ulong)
 
+class FrameCache(metaclass=Singleton):
+    """
+    Holds the most recent capture of every screen region, so that all crops taken from the same region between two
+    invalidations share a single screenshot. Must be invalidated whenever the screen content is expected to change,
+    meaning after sending any input, after waiting and at the start of each main loop iteration.
+    If a capture plan is set for a region, only the planned rects are captured as long as all requested crops are
+    covered by the plan. Anything else (crops outside the plan, the whole region) is served from a full capture.
+    """
+    backend: Optional[CaptureBackend]
+    frames: Dict[Tuple[int, int, int, int], ndarray]
+    planned: Dict[Tuple[int, int, int, int], Tuple[CapturePlan, List[Tuple[Tuple[int, int, int, int], ndarray]]]]
+    plans: Dict[Tuple[int, int, int, int], CapturePlan]
+    captures: int
+    hits: int
+
+    def __init__(self):
+        self.backend = None
+        self.frames = {}
+        self.planned = {}
+        self.plans = {}
+        self.captures = 0
+        self.hits = 0
+        self.__lock = threading.Lock()
+
+    def set_backend(self, backend: CaptureBackend) -> None:
+        with self.__lock:
+            if self.backend is not None:
+                self.backend.close()
+            self.backend = backend
+            self.frames.clear()
+            self.planned.clear()
+
+    def set_plan(self, region: Tuple[int, int, int, int], crops: List[Tuple[int, int, int, int]]) -> None:
+        with self.__lock:
+            self.plans[region] = build_capture_plan(region, tuple(crops))
+
+    def clear_plans(self) -> None:
+        with self.__lock:
+            self.plans.clear()
+
+    def get(self, region: Tuple[int, int, int, int]) -> ndarray:
+        """
+        Get a full capture of a region
+        :param region: region to get, format: (left, top, width, height)
+        :return:
+        """
+        with self.__lock:
+            return self.__get_frame(region)
+
+    def get_crops(self, region: Tuple[int, int, int, int],
+                  crops: List[Tuple[int, int, int, int]]) -> Tuple[List[ndarray], Optional[ndarray]]:
+        """
+        Get crops of a region, capturing only the planned rects if the region's plan covers all crops
+        :param region: region to get crops of, format: (left, top, width, height)
+        :param crops: crops to get, format: (left, top, right, bottom)
+        :return: cropped images and the full capture they were taken from (None if taken from a planned capture)
+        """
+        with self.__lock:
+            if region not in self.frames:
+                # Crops can be served from a planned capture if the plan covers them
+                planned = self.planned.get(region)
+                if planned is None or not planned[0].covers(crops):
+                    plan = self.plans.get(region)
+                    planned = (plan, self.__capture_plan(plan)) if plan is not None and plan.covers(crops) else None
+                    if planned is not None:
+                        self.planned[region] = planned
+                else:
+                    self.hits += 1
+
+                if planned is not None:
+                    plan, captures = planned
+                    return [plan.crop(captures, crop) for crop in crops], None
+
+            frame = self.__get_frame(region)
+            return [crop_image(frame, crop) for crop in crops], frame
+
+    def __get_frame(self, region: Tuple[int, int, int, int]) -> ndarray:
+        frame = self.frames.get(region)
+        if frame is not None:
+            self.hits += 1
+            return frame
+
+        with Metrics().timed('capture'):
+            frame = self.__get_backend().grab(region)
+
+        self.frames[region] = frame
+        self.captures += 1
+        SessionRecorder().record_frame(region, frame)
+
+        return frame
+
+    def __capture_plan(self, plan: CapturePlan) -> List[Tuple[Tuple[int, int, int, int], ndarray]]:
+        with Metrics().timed('capture'):
+            captures = plan.capture(self.__get_backend())
+
+        self.captures += 1
+        recorder = SessionRecorder()
+        for rect, image in captures:
+            recorder.record_frame(rect, image)
+
+        return captures
+
+    def __get_backend(self) -> CaptureBackend:
+        # Fall back to capturing via pyautogui if no backend was configured
+        if self.backend is None:
+            self.backend = DesktopCaptureBackend()
+
+        return self.backend
+
+    def invalidate(self) -> None:
+        with self.__lock:
+            self.frames.clear()
+            self.planned.clear()
 
-class Window:
-    handle: int
-    title: str
-    rect: Tuple[int, int, int, int]
-    class_name: str
-    pid: int
 
-    def __init__(self, handle: int, title: str, rect: Tuple[int, int, int, int], class_name: str, pid: int):
-        self.handle = handle
-        self.title = title
-        self.rect = rect
-        self.class_name = class_name
-        self.pid = pid
+class ImageOperation(Enum):
+    invert = 1
+    solarize = 2
+    grayscale = 3
+    colorize = 4
 
-    def get_size(self) -> Tuple[int, int]:
-        # Size on Windows contains the window header and the halo/shadow around the window,
-        # which needs to be subtracted to get the real size
-        left, top, right, bottom = self.rect
-        return right - constants.WINDOW_SHADOW_SIZE - left - constants.WINDOW_SHADOW_SIZE, \
-            bottom - constants.WINDOW_SHADOW_SIZE - top - constants.WINDOW_TITLE_BAR_HEIGHT
 
+@recorded_query
+def is_responding_pid(pid: int) -> bool:
+    return Platform().get_backend().is_process_responding(pid)
 
-class KeyBdInput(ctypes.Structure):
-    _fields_ = [("wVk", ctypes.c_ushort),
-                ("wScan", ctypes.c_ushort),
-                ("dwFlags", ctypes.c_ulong),
-                ("time", ctypes.c_ulong),
-                ("dwExtraInfo", PUL)]
 
+@recorded_query
+def is_running_pid(pid: int) -> bool:
+    return Platform().get_backend().is_process_running(pid)
 
-class HardwareInput(ctypes.Structure):
-    _fields_ = [("uMsg", ctypes.c_ulong),
-                ("wParamL", ctypes.c_short),
-                ("wParamH", ctypes.c_ushort)]
 
+@recorded_input
+def taskkill_pid(pid: int) -> bool:
+    return Platform().get_backend().kill_process(pid)
 
-class MouseInput(ctypes.Structure):
-    _fields_ = [("dx", ctypes.c_long),
-                ("dy", ctypes.c_long),
-                ("mouseData", ctypes.c_ulong),
-                ("dwFlags", ctypes.c_ulong),
-                ("time", ctypes.c_ulong),
-                ("dwExtraInfo", PUL)]
 
+def set_platform_backend(backend: PlatformBackend) -> None:
+    Platform().set_backend(backend)
 
-class Input_I(ctypes.Union):
-    _fields_ = [("ki", KeyBdInput),
-                ("mi", MouseInput),
-                ("hi", HardwareInput)]
 
+def set_capture_backend(backend: CaptureBackend) -> None:
+    FrameCache().set_backend(backend)
 
-class Input(ctypes.Structure):
-    _fields_ = [("type", ctypes.c_ulong),
-                ("ii", Input_I)]
 
+def invalidate_frame_cache() -> None:
+    FrameCache().invalidate()
 
-class ImageOperation(Enum):
-    invert = 1
-    solarize = 2
-    grayscale = 3
-    colorize = 4
+
+def set_game_window_capture_plan(game_window: Window, crops: List[Tuple[int, int, int, int]]) -> None:
+    """
+    Limit captures of the game window to the given crops (crops not covered by the plan trigger a full capture)
+    :param game_window: game window the crops will be taken from
+    :param crops: List of image crop tuples, format: (left, top, right, bottom)
+    :return:
+    """
+    FrameCache().set_plan(get_game_window_region(game_window), crops)
 
 
-def is_responding_pid(pid: int) -> bool:
-    try:
-        return psutil.Process(pid=pid).status() == psutil.STATUS_RUNNING
-    except (psutil.NoSuchProcess, psutil.AccessDenied):
-        return False
+def clear_capture_plans() -> None:
+    FrameCache().clear_plans()
 
 
-def taskkill_pid(pid: int) -> bool:
-    try:
-        process = psutil.Process(pid=pid)
-        process.kill()
-        process.wait(5)
-        return not process.is_running()
-    except psutil.NoSuchProcess:
-        return True
-    except psutil.AccessDenied:
-        return False
+def sleep(seconds: float) -> None:
+    """
+    Wait for the given number of seconds (wrapper for Clock().sleep, so waits pass instantly when replaying)
+    Invalidates the frame cache, since the game keeps rendering while we wait
+    :param seconds: number of seconds to wait for
+    :return:
+    """
+    SessionRecorder().record_sleep(seconds)
+    with Metrics().timed('sleep'), Tracer().span('sleep', 'sleep', {'seconds': seconds}):
+        Clock().sleep(seconds)
+    invalidate_frame_cache()
 
 
+@traced('input')
+@recorded_input
 def press_key(key_code: int) -> None:
-    extra = ctypes.c_ulong(0)
-    ii_ = Input_I()
-    ii_.ki = KeyBdInput(0, key_code, 0x0008, 0, ctypes.pointer(extra))
-    x = Input(ctypes.c_ulong(1), ii_)
-    ctypes.windll.user32.SendInput(1, ctypes.pointer(x), ctypes.sizeof(x))
+    with Metrics().timed('input'):
+        Platform().get_backend().send_key(key_code)
+    invalidate_frame_cache()
 
 
+@traced('input')
+@recorded_input
 def release_key(key_code: int) -> None:
-    extra = ctypes.c_ulong(0)
-    ii_ = Input_I()
-    ii_.ki = KeyBdInput(0, key_code, 0x0008 | 0x0002, 0, ctypes.pointer(extra))
-    x = Input(ctypes.c_ulong(1), ii_)
-    ctypes.windll.user32.SendInput(1, ctypes.pointer(x), ctypes.sizeof(x))
+    with Metrics().timed('input'):
+        Platform().get_backend().send_key(key_code, release=True)
+    invalidate_frame_cache()
 
 
+@traced('input')
 def auto_press_key(key_code: int) -> None:
     press_key(key_code)
-    time.sleep(.08)
+    sleep(.08)
     release_key(key_code)
 
 
-def window_enumeration_handler(hwnd: int, top_windows: list):
-    """Add window title and ID to array."""
-    tid, pid = win32process.GetWindowThreadProcessId(hwnd)
-    window = Window(
-        hwnd,
-        win32gui.GetWindowText(hwnd),
-        win32gui.GetWindowRect(hwnd),
-        win32gui.GetClassName(hwnd),
-        pid
-    )
+@traced('input')
+@recorded_input
+def press_named_key(key: str, presses: int = 1, interval: float = 0.0) -> None:
+    """
+    Press (and release) a key by its name (e.g. enter, tab, backspace)
+    :param key: name of the key
+    :param presses: number of times to press the key
+    :param interval: number of seconds to wait between presses
+    :return:
+    """
+    with Metrics().timed('input'):
+        Platform().get_backend().press_named_key(key, presses, interval)
+    invalidate_frame_cache()
+
+
+@traced('input')
+def write_text(text: str, interval: float = 0.0) -> None:
+    """
+    Type text, character by character
+    :param text: text to type
+    :param interval: number of seconds to wait between characters
+    :return:
+    """
+    # Text can be a password, so only record how much was typed
+    SessionRecorder().record_input('write_text', {'characters': len(text)})
+    with Metrics().timed('input'):
+        Platform().get_backend().write_text(text, interval)
+    invalidate_frame_cache()
 
-    top_windows.append(window)
 
+@traced('input')
+def type_text(text: str, interval: float = 0.0) -> None:
+    """
+    Type text via scan codes, sending all characters at once (much faster than write_text)
+    :param text: text to type
+    :param interval: min. number of seconds to wait between characters (sends each character on its own if > 0)
+    :return:
+    """
+    SessionRecorder().record_input('type_text', {'characters': len(text)})
+    with Metrics().timed('input'):
+        Platform().get_backend().type_text(text, interval)
+    invalidate_frame_cache()
 
-def find_window_by_title(search_title: str, search_class: str = None) -> Optional[Window]:
-    # Reset top windows array
-    top_windows = []
 
-    # Call window enumeration handler
-    win32gui.EnumWindows(window_enumeration_handler, top_windows)
+@traced('input')
+@recorded_input
+def clear_text_input() -> None:
+    """
+    Clear the focused text input (select all and delete)
+    :return:
+    """
+    with Metrics().timed('input'):
+        Platform().get_backend().clear_text_input()
+    invalidate_frame_cache()
+
+
+@traced('input')
+@recorded_input
+def bring_window_to_foreground(window: Window) -> None:
+    Platform().get_backend().bring_window_to_foreground(window.handle)
+    invalidate_frame_cache()
+
+
+@recorded_query
+def find_window_by_title(search_title: str, search_class: str = None) -> Optional[Window]:
     found_window = None
-    for window in top_windows:
+    for window in Platform().get_backend().find_windows():
         if search_title in window.title and \
                 (search_class is None or search_class in window.class_name):
             found_window = window
@@ -162,11 +299,16 @@ def find_window_by_title(search_title: str, search_class: str = None) -> Optiona
 
 
 # Move mouse using old mouse_event method (relative, by "mickeys)
+@traced('input')
+@recorded_input
 def mouse_move_legacy(dx: int, dy: int) -> None:
-    win32api.mouse_event(win32con.MOUSEEVENTF_MOVE, dx, dy)
-    time.sleep(.08)
+    with Metrics().timed('input'):
+        Platform().get_backend().mouse_move_relative(dx, dy)
+    sleep(.08)
 
 
+@traced('input')
+@recorded_input
 def mouse_move_to_game_window_coord(game_window: Window, resolution: str, key: str, legacy: bool = False) -> None:
     """
     Move mouse cursor to specified game window coordinates
@@ -180,27 +322,30 @@ def mouse_move_to_game_window_coord(game_window: Window, resolution: str, key: s
         mouse_move_legacy(constants.COORDINATES[resolution]['clicks'][key][0],
                           constants.COORDINATES[resolution]['clicks'][key][1])
     else:
-        pyautogui.moveTo(
-            game_window.rect[0] + constants.COORDINATES[resolution]['clicks'][key][0],
-            game_window.rect[1] + constants.COORDINATES[resolution]['clicks'][key][1]
-        )
+        with Metrics().timed('input'):
+            Platform().get_backend().mouse_move_to(
+                game_window.rect[0] + constants.COORDINATES[resolution]['clicks'][key][0],
+                game_window.rect[1] + constants.COORDINATES[resolution]['clicks'][key][1]
+            )
+        invalidate_frame_cache()
 
 
+@recorded_query
 def is_cursor_on_game_window(game_window: Window) -> bool:
-    # https://learn.microsoft.com/en-us/windows/win32/api/winuser/ns-winuser-cursorinfo
-    flags, handle, (px, py) = win32gui.GetCursorInfo()
+    backend = Platform().get_backend()
+    shown, (px, py) = backend.get_cursor_state()
     # Get current (!) game window rectangle
-    try:
-        left, top, right, bottom = win32gui.GetWindowRect(game_window.handle)
-    except win32gui.error:  # PyCharm claims win32gui.error does not exist, but it does
+    rect = backend.get_window_rect(game_window.handle)
+    if rect is None:
         return False
+    left, top, right, bottom = rect
 
     """
     Allow cursor to only be within the actual window "body", ignore the title bar and the shadow around it. If the game 
     is currently not in the menu (meaning we are controlling the mouse movement by mickeys), the cursor position is of
-    no use. However, Windows flags the cursor as hidden and returns the handle as 0.
+    no use. However, Windows flags the cursor as hidden then.
     """
-    if flags == 0 and handle == 0 or \
+    if not shown or \
             left + constants.WINDOW_SHADOW_SIZE <= px <= right - constants.WINDOW_SHADOW_SIZE and \
             top + constants.WINDOW_TITLE_BAR_HEIGHT <= py <= bottom - constants.WINDOW_SHADOW_SIZE:
         return True
@@ -208,6 +353,8 @@ def is_cursor_on_game_window(game_window: Window) -> bool:
     return False
 
 
+@traced('input')
+@recorded_input
 def mouse_click_in_game_window(game_window: Window, legacy: bool = False) -> None:
     if not is_cursor_on_game_window(game_window):
         logger.warning(f'Mouse cursor is not on game window, ignoring mouse click')
@@ -216,79 +363,328 @@ def mouse_click_in_game_window(game_window: Window, legacy: bool = False) -> Non
     if legacy:
         mouse_click_legacy()
     else:
-        pyautogui.leftClick()
+        with Metrics().timed('input'):
+            Platform().get_backend().mouse_click()
+        invalidate_frame_cache()
 
 
 # Mouse click using old mouse_event method
+@traced('input')
+@recorded_input
 def mouse_click_legacy() -> None:
-    win32api.mouse_event(win32con.MOUSEEVENTF_LEFTDOWN, 0, 0, 0, 0)
-    time.sleep(.08)
-    win32api.mouse_event(win32con.MOUSEEVENTF_LEFTUP, 0, 0, 0, 0)
+    with Metrics().timed('input'):
+        Platform().get_backend().mouse_button()
+    sleep(.08)
+    with Metrics().timed('input'):
+        Platform().get_backend().mouse_button(release=True)
+    invalidate_frame_cache()
 
 
+@traced('input')
+@recorded_input
 def mouse_reset_legacy() -> None:
-    win32api.mouse_event(win32con.MOUSEEVENTF_MOVE, -10000, -10000)
-    time.sleep(.2)
+    with Metrics().timed('input'):
+        Platform().get_backend().mouse_move_relative(-10000, -10000)
+    sleep(.2)
+
+
+class MouseCalibration(metaclass=Singleton):
+    """
+    Maps legacy mouse coordinates (spawn menu targets, given as offsets from the top left corner the legacy cursor reset
+    moves to) to absolute screen coordinates, so targets can be clicked via a single absolute move instead. A mapping is
+    an offset of that corner from the game window's top left corner. Candidate offsets are only accepted once an
+    absolute click using them selected the same target a legacy click selected (compared on screen around the target).
+    Confirmed offsets are kept per resolution and game window position. If no candidate offset selects the same target,
+    absolute clicks are considered unusable for the resolution (e.g. because the game ignores absolute moves).
+    """
+    # Top left corner of the window's body (below the title bar) or of the window itself
+    CANDIDATE_OFFSETS = [
+        (constants.WINDOW_SHADOW_SIZE, constants.WINDOW_TITLE_BAR_HEIGHT),
+        (0, 0)
+    ]
+    # Half the size of the area around a target to compare between the legacy and the absolute click's selection
+    MATCH_RADIUS = 24
+    # Min. grayscale difference for a pixel to count as changed and max. share of changed pixels (e.g. due to moving
+    # map icons) for both clicks to have selected the same target
+    MATCH_MIN_DELTA = 40
+    MATCH_MAX_CHANGED = .02
+
+    calibrations: Dict[Tuple[str, Tuple[int, int, int, int]], Tuple[int, int]]
+    unusable: Set[str]
+
+    def __init__(self):
+        self.calibrations = {}
+        self.unusable = set()
+        self.__lock = threading.Lock()
+
+    def get(self, game_window: Window, resolution: str) -> Optional[Tuple[int, int]]:
+        """
+        Get the confirmed offset for a resolution and game window position
+        :param game_window: game window the offset applies to
+        :param resolution: resolution the game is running at
+        :return: confirmed offset, None if no offset has been confirmed (yet)
+        """
+        with self.__lock:
+            return self.calibrations.get((resolution, game_window.rect))
+
+    def confirm(self, game_window: Window, resolution: str, offset: Tuple[int, int]) -> None:
+        with self.__lock:
+            if self.calibrations.get((resolution, game_window.rect)) != offset:
+                logger.debug(f'Confirmed mouse calibration for {resolution}: offset {offset[0]}/{offset[1]}')
+            self.calibrations[(resolution, game_window.rect)] = offset
+
+    def discard(self, game_window: Window, resolution: str) -> None:
+        with self.__lock:
+            if self.calibrations.pop((resolution, game_window.rect), None) is not None:
+                logger.warning(f'Discarded mouse calibration for {resolution}, absolute click did not hit the target')
+
+    def is_usable(self, resolution: str) -> bool:
+        with self.__lock:
+            return resolution not in self.unusable
+
+    def set_unusable(self, resolution: str) -> None:
+        with self.__lock:
+            self.unusable.add(resolution)
+        logger.warning(f'No absolute click selected the same target as a legacy click, using legacy clicks for '
+                       f'{resolution} from now on')
+
+    @staticmethod
+    def get_target_position(offset: Tuple[int, int], x: int, y: int) -> Tuple[int, int]:
+        """
+        Get the position of legacy mouse coordinates in a screenshot of the game window's body (given an offset)
+        :param offset: offset of the top left corner from the game window's top left corner
+        :param x: horizontal distance from the top left corner
+        :param y: vertical distance from the top left corner
+        :return:
+        """
+        return offset[0] - constants.WINDOW_SHADOW_SIZE + x, offset[1] - constants.WINDOW_TITLE_BAR_HEIGHT + y
+
+    @classmethod
+    def is_same_selection(cls, reference: ndarray, screenshot: ndarray, position: Tuple[int, int]) -> bool:
+        """
+        Check whether two screenshots of the game window's body show the same selection around a target
+        :param reference: screenshot taken after selecting the target via legacy click
+        :param screenshot: screenshot taken after selecting the target via absolute click
+        :param position: position of the target in the screenshots
+        :return:
+        """
+        if reference.shape != screenshot.shape:
+            return False
+
+        height, width = reference.shape[:2]
+        x, y = position
+        left, top = max(x - cls.MATCH_RADIUS, 0), max(y - cls.MATCH_RADIUS, 0)
+        right, bottom = min(x + cls.MATCH_RADIUS, width), min(y + cls.MATCH_RADIUS, height)
+        if left >= right or top >= bottom:
+            return False
+
+        delta = cv2.absdiff(
+            cv2.cvtColor(reference[top:bottom, left:right], cv2.COLOR_BGR2GRAY),
+            cv2.cvtColor(screenshot[top:bottom, left:right], cv2.COLOR_BGR2GRAY)
+        )
+        return np.count_nonzero(delta > cls.MATCH_MIN_DELTA) <= cls.MATCH_MAX_CHANGED * delta.size
 
 
+@traced('input')
+@recorded_input
+def mouse_click_at_legacy_coord(game_window: Window, x: int, y: int, offset: Tuple[int, int]) -> None:
+    """
+    Click legacy mouse coordinates via a single absolute move and click (no cursor reset or relative moves needed)
+    :param game_window: Game window to click in/on
+    :param x: horizontal distance from the top left corner (in mickeys, which legacy coordinates map 1:1 to pixels)
+    :param y: vertical distance from the top left corner (in mickeys, which legacy coordinates map 1:1 to pixels)
+    :param offset: offset of the top left corner from the game window's top left corner (see MouseCalibration)
+    :return:
+    """
+    left, top, _, _ = game_window.rect
+    with Metrics().timed('input'):
+        Platform().get_backend().mouse_click_at(left + offset[0] + x, top + offset[1] + y)
+    invalidate_frame_cache()
+
+
+@traced('input')
+@recorded_input
 def mouse_reset(game_window: Window) -> None:
     """
-    Reset mouse cursor to the center of the game window (via pyautogui)
+    Reset mouse cursor to the center of the game window (via absolute move)
     :param game_window: Game window to move mouse in/on
     :return:
     """
     left, top, right, bottom = game_window.rect
-    pyautogui.moveTo((right - left)/2 + left, (bottom - top - 40)/2 + top)
+    with Metrics().timed('input'):
+        Platform().get_backend().mouse_move_to((right - left)/2 + left, (bottom - top - 40)/2 + top)
+    invalidate_frame_cache()
 
 
+def get_game_window_region(game_window: Window) -> Tuple[int, int, int, int]:
+    """
+    Get the screen region of the game window's "body" (excluding the title bar and the shadow around the window)
+    :param game_window: game window to get region of
+    :return: region, format: (left, top, width, height)
+    """
+    left, top, right, bottom = game_window.rect
+    return (
+        left + constants.WINDOW_SHADOW_SIZE,
+        top + constants.WINDOW_TITLE_BAR_HEIGHT,
+        right - constants.WINDOW_SHADOW_SIZE - left - constants.WINDOW_SHADOW_SIZE,
+        bottom - constants.WINDOW_SHADOW_SIZE - top - constants.WINDOW_TITLE_BAR_HEIGHT
+    )
+
+
+def crop_image(image: ndarray, crop: Tuple[int, int, int, int]) -> ndarray:
+    """
+    Remove the given borders from an image (numpy equivalent of PIL.ImageOps.crop, returns a view)
+    :param image: image to crop
+    :param crop: number of pixels to remove from each side, format: (left, top, right, bottom)
+    :return:
+    """
+    left, top, right, bottom = crop
+    height, width = image.shape[:2]
+    return image[top:height - bottom, left:width - right]
+
+
+def colorize_lut(args: dict) -> ndarray:
+    """
+    Get the lookup table PIL.ImageOps.colorize would apply to a grayscale image, with columns ordered blue, green, red
+    :param args: arguments for PIL.ImageOps.colorize
+    :return: lookup table, shape: (256, 3)
+    """
+    gradient = Image.fromarray(np.arange(256, dtype=np.uint8).reshape((1, 256)), 'L')
+    return np.asarray(ImageOps.colorize(gradient, **args))[0, :, ::-1]
+
+
+def bgr_to_grayscale(image: ndarray) -> ndarray:
+    # Use PIL's fixed point ITU-R 601-2 luma transform (cv2.cvtColor rounds slightly differently)
+    blue, green, red = image[:, :, 0], image[:, :, 1], image[:, :, 2]
+    luma = red * np.uint32(19595) + green * np.uint32(38470) + blue * np.uint32(7471) + np.uint32(0x8000)
+    return (luma >> 16).astype(np.uint8)
+
+
+class ImagePipeline:
+    """
+    List of image operations compiled into as few passes over the image as possible. Any consecutive per-pixel
+    operations (invert, solarize, colorize) are fused into a single lookup table, so a list of operations costs at most
+    one grayscale conversion plus one lookup table pass. Results match applying the respective PIL.ImageOps functions.
+    """
+    # Stages are lookup tables of shape (256, 1) (same mapping for all channels) or (256, 3) (mapping per BGR output
+    # channel), None stands for a grayscale conversion
+    stages: List[Optional[ndarray]]
+
+    def __init__(self, image_ops: List[Tuple[ImageOperation, Optional[dict]]], channels: int):
+        self.stages = []
+        lut: Optional[ndarray] = None
+        for method, args in image_ops:
+            args = args if args is not None else {}
+            if method is ImageOperation.invert:
+                lut = 255 - (lut if lut is not None else self.__identity())
+            elif method is ImageOperation.solarize:
+                threshold = args.get('threshold', 128)
+                lut = lut if lut is not None else self.__identity()
+                lut = np.where(lut < threshold, lut, 255 - lut)
+            elif method is ImageOperation.grayscale and channels == 3:
+                if lut is not None and lut.shape[1] == 3 and np.array_equal(lut[:, 1:], lut[:, :2]):
+                    # Lookup table maps every value to gray already, so just keep one channel
+                    lut = lut[:, :1]
+                else:
+                    # Grayscale conversion does not commute with per-channel operations, so apply those first
+                    if lut is not None:
+                        self.stages.append(self.__finalize(lut))
+                    self.stages.append(None)
+                    lut = None
+                channels = 1
+            elif method is ImageOperation.colorize:
+                if channels != 1 or lut is not None and lut.shape[1] != 1:
+                    raise ValueError('colorize requires a grayscale image')
+                colorize = colorize_lut(args)
+                lut = colorize if lut is None else colorize[lut[:, 0]]
+                channels = 3
+
+        if lut is not None:
+            self.stages.append(self.__finalize(lut))
+
+    @staticmethod
+    def __identity() -> ndarray:
+        return np.arange(256, dtype=np.uint8).reshape((256, 1))
+
+    @staticmethod
+    def __finalize(lut: ndarray) -> ndarray:
+        return np.ascontiguousarray(lut, dtype=np.uint8)
+
+    def apply(self, image: ndarray) -> ndarray:
+        for lut in self.stages:
+            if lut is None:
+                image = bgr_to_grayscale(image)
+            elif lut.shape[1] == 1:
+                # Same mapping for every channel
+                image = cv2.LUT(image, lut)
+            elif image.ndim == 2:
+                # Grayscale to BGR mapping
+                image = lut[image]
+            else:
+                # Per channel mapping
+                image = cv2.LUT(image, lut.reshape((256, 1, 3)))
+
+        return image
+
+
+@functools.lru_cache(maxsize=64)
+def _compile_image_ops(image_ops: Tuple[Tuple[ImageOperation, Tuple[Tuple[str, Union[str, int]], ...]], ...],
+                       channels: int) -> ImagePipeline:
+    return ImagePipeline([(method, dict(args)) for method, args in image_ops], channels)
+
+
+def compile_image_ops(image_ops: List[Tuple[ImageOperation, Optional[dict]]], channels: int = 3) -> ImagePipeline:
+    """
+    Compile a list of image operations into an image pipeline (compiled pipelines are cached by their arguments)
+    :param image_ops: List of image operation tuples, format: (operation, arguments)
+    :param channels: number of channels of the images the pipeline will be applied to
+    :return:
+    """
+    key = tuple((method, tuple(sorted(args.items())) if args is not None else ()) for method, args in image_ops)
+    return _compile_image_ops(key, channels)
+
+
+@traced('capture')
 def screenshot_region(
         region: Tuple[int, int, int, int],
         image_ops: Optional[List[Tuple[ImageOperation, Optional[dict]]]] = None,
         crops: Optional[List[Tuple[int, int, int, int]]] = None,
-        show: bool = False
-) -> Tuple[Union[Image.Image, List[Image.Image]], Image.Image]:
+        show: bool = False,
+        debug_label: Optional[str] = None
+) -> Tuple[Union[ndarray, List[ndarray]], Optional[ndarray]]:
     """
-    Take a screenshot of the specified screen region (wrapper for pyautogui.screenshot)
+    Take a screenshot of the specified screen region (using the configured capture backend)
+    Screenshots are served from the frame cache, so any number of calls for the same region only result in a single
+    screenshot until the cache is invalidated
     :param region: region to take screenshot of, format: (left, top, width, height)
     :param image_ops: List of image operation tuples, format: (operation, arguments)
     :param crops: List of image crop tuples, format: (left, top, right, bottom)
     :param show: whether to show the screenshot
-    :return:
+    :param debug_label: label to save debug screenshots under (used for per-region sampling)
+    :return: cropped screenshot(s) and the full screenshot, as BGR (or grayscale, depending on image_ops) images
+    (the full screenshot is None if the crops were taken from a capture plan's rects, since no full screenshot exists)
     """
-    screenshot = pyautogui.screenshot(region=region)
-    results: List[Image.Image] = []
-    # Apply zero-crop if no crops have been given, since we should not modify the original screenshot
-    for crop in crops if crops is not None else [(0, 0, 0, 0)]:
-        cropped = ImageOps.crop(screenshot, crop)
+    frame_cache = FrameCache()
+    if crops is not None:
+        images, screenshot = frame_cache.get_crops(region, crops)
+    else:
+        # Apply zero-crop if no crops have been given, since we should not modify the original screenshot
+        screenshot = frame_cache.get(region)
+        images = [crop_image(screenshot, (0, 0, 0, 0))]
 
+    results: List[ndarray] = []
+    for cropped in images:
         if image_ops is not None:
-            for operation in image_ops:
-                method, args = operation
-                if method is ImageOperation.invert:
-                    cropped = ImageOps.invert(cropped)
-                elif method is ImageOperation.solarize:
-                    cropped = ImageOps.solarize(cropped, **(args if args is not None else {}))
-                elif method is ImageOperation.grayscale:
-                    cropped = ImageOps.grayscale(cropped)
-                elif method is ImageOperation.colorize:
-                    cropped = ImageOps.colorize(cropped, **(args if args is not None else {}))
+            with Metrics().timed('preprocessing'):
+                cropped = compile_image_ops(image_ops, cropped.shape[2] if cropped.ndim == 3 else 1).apply(cropped)
 
         if show:
-            cropped.show()
+            Image.fromarray(cropped if cropped.ndim == 2 else cv2.cvtColor(cropped, cv2.COLOR_BGR2RGB)).show()
 
-        # Save screenshot to debug directory if debugging is enabled
+        # Queue screenshot for saving to debug directory if debugging is enabled
         config = Config()
         if config.debug_screenshot():
-            # Save screenshot
-            try:
-                cropped.save(
-                    os.path.join(
-                        Config.DEBUG_DIR,
-                        f'screenshot-{datetime.now().strftime("%Y-%m-%d-%H-%M-%S-%f")}.jpg'
-                    )
-                )
-            except OSError as e:
-                logger.error(f'Failed to save screenshot to disk: {e}')
+            DebugScreenshotWriter().submit(cropped, debug_label)
 
         results.append(cropped)
 
@@ -300,43 +696,36 @@ def screenshot_game_window_region(
         game_window: Window,
         image_ops: Optional[List[Tuple[ImageOperation, Optional[dict]]]] = None,
         crops: Optional[List[Tuple[int, int, int, int]]] = None,
-        show: bool = False
-) -> Tuple[Union[Image.Image, List[Image.Image]], Image.Image]:
+        show: bool = False,
+        debug_label: Optional[str] = None
+) -> Tuple[Union[ndarray, List[ndarray]], Optional[ndarray]]:
     """
     Take a screenshot of the specified game window region
     :param game_window: game window to take screenshot of
     :param image_ops: List of image operation tuples, format: (operation, arguments)
     :param crops: List of image crop tuples, format: (left, top, right, bottom)
     :param show: whether to show the screenshot
+    :param debug_label: label to save debug screenshots under (used for per-region sampling)
     :return:
     """
-    left, top, right, bottom = game_window.rect
     return screenshot_region(
-        (
-            left + constants.WINDOW_SHADOW_SIZE,
-            top + constants.WINDOW_TITLE_BAR_HEIGHT,
-            right - constants.WINDOW_SHADOW_SIZE - left - constants.WINDOW_SHADOW_SIZE,
-            bottom - constants.WINDOW_SHADOW_SIZE - top - constants.WINDOW_TITLE_BAR_HEIGHT
-        ),
-        image_ops, crops, show
+        get_game_window_region(game_window),
+        image_ops, crops, show, debug_label
     )
 
 
-def init_pytesseract(tesseract_path: str) -> None:
-    pytesseract.pytesseract.tesseract_cmd = os.path.join(tesseract_path, constants.TESSERACT_EXE)
-
-
-def image_to_string(image: Image, ocr_config: str) -> str:
+@traced('ocr')
+def image_to_string(image: ndarray, ocr_config: str) -> str:
     """
-    Extract text from an image (wrapper for pytesseract.image_to_string)
-    :param image: PIL image to extract text from
+    Extract text from an image (using the configured OCR engine)
+    :param image: BGR or grayscale image to extract text from
     :param ocr_config: config/parameters for Tesseract OCR (see https://guides.nyu.edu/tesseract/usage)
     :return:
     """
-    # pytesseract stopped stripping \n\x0c from ocr results,
-    # returning raw results instead (https://github.com/madmaze/pytesseract/issues/297)
-    # so strip those characters as well as spaces after getting the result
-    ocr_result = pytesseract.image_to_string(image, config=ocr_config).strip(' \n\x0c')
+    # Tesseract results end with \n (and \x0c when run via pytesseract, which stopped stripping those characters,
+    # see https://github.com/madmaze/pytesseract/issues/297), so strip those as well as spaces after getting the result
+    with Metrics().timed('ocr'):
+        ocr_result = OCR().image_to_string(image, ocr_config).strip(' \n\x0c')
 
     # Print ocr result if debugging is enabled
     config = Config()
@@ -346,29 +735,50 @@ def image_to_string(image: Image, ocr_config: str) -> str:
     return ocr_result.lower()
 
 
+@traced('ocr')
+def images_to_strings(images: List[ndarray], ocr_config: str, fallback: bool = True) -> List[str]:
+    """
+    Extract text from multiple images with a single OCR run (falls back to one run per image if required)
+    :param images: BGR or grayscale images to extract text from
+    :param ocr_config: config/parameters for Tesseract OCR (see https://guides.nyu.edu/tesseract/usage)
+    :param fallback: whether to fall back to one run per image if the batch result cannot be split per image (else,
+    only the detected lines are returned, which cannot be mapped to the images)
+    :return:
+    """
+    with Metrics().timed('ocr'):
+        ocr_results = [
+            ocr_result.strip(' \n\x0c') for ocr_result in OCR().images_to_strings(images, ocr_config, fallback)
+        ]
+
+    # Print ocr results if debugging is enabled
+    config = Config()
+    if config.debug_screenshot():
+        logger.debug(f'OCR results: {ocr_results}')
+
+    return [ocr_result.lower() for ocr_result in ocr_results]
+
+
 # Take a screenshot of the given region and run the result through OCR
 def ocr_screenshot_region(
         region: Tuple[int, int, int, int],
         image_ops: Optional[List[Tuple[ImageOperation, Optional[dict]]]] = None,
         crops: Optional[List[Tuple[int, int, int, int]]] = None,
-        show: bool = False, ocr_config: str = r'--oem 3 --psm 7'
+        show: bool = False, ocr_config: str = r'--oem 3 --psm 7', debug_label: Optional[str] = None,
+        batch_fallback: bool = True
 ) -> Union[str, List[str]]:
-    result, screenshot = screenshot_region(region, image_ops, crops, show)
+    result, screenshot = screenshot_region(region, image_ops, crops, show, debug_label)
 
-    if isinstance(result, Image.Image):
+    if isinstance(result, ndarray):
         return image_to_string(result, ocr_config)
 
-    ocr_results: List[str] = []
-    for cropped in result:
-        ocr_results.append(image_to_string(cropped, ocr_config))
-
-    return ocr_results
+    # Run all crops through OCR at once
+    return images_to_strings(result, ocr_config, batch_fallback)
 
 
 def ocr_screenshot_game_window_region(
         game_window: Window, resolution: str, key: str,
         image_ops: Optional[List[Tuple[ImageOperation, Optional[dict]]]] = None,
-        show: bool = False, ocr_config: str = r'--oem 3 --psm 7'
+        show: bool = False, ocr_config: str = r'--oem 3 --psm 7', batch_fallback: bool = True
 ) -> Union[str, List[str]]:
     """
     Run a region of a game window through OCR (wrapper for ocr_screenshot_region)
@@ -378,35 +788,98 @@ def ocr_screenshot_game_window_region(
     :param image_ops: List of image operation tuples, format: (operation, arguments)
     :param show: whether to show the screenshot
     :param ocr_config: config/parameters for Tesseract OCR (see https://guides.nyu.edu/tesseract/usage)
+    :param batch_fallback: for regions with multiple crops, whether to fall back to one OCR run per crop if the result of
+    the batched run cannot be split per crop (else, a list of any detected lines is returned)
     :return:
     """
-    left, top, right, bottom = game_window.rect
     return ocr_screenshot_region(
-        (
-            left + constants.WINDOW_SHADOW_SIZE,
-            top + constants.WINDOW_TITLE_BAR_HEIGHT,
-            right - constants.WINDOW_SHADOW_SIZE - left - constants.WINDOW_SHADOW_SIZE,
-            bottom - constants.WINDOW_SHADOW_SIZE - top - constants.WINDOW_TITLE_BAR_HEIGHT
-        ),
+        get_game_window_region(game_window),
         image_ops,
         constants.COORDINATES[resolution]['ocr'][key],
         show,
-        ocr_config
+        ocr_config,
+        key,
+        batch_fallback
     )
 
 
-def histogram_screenshot_region(game_window: Window, crop: Tuple[int, int, int, int]) -> ndarray:
-    result, screenshot = screenshot_game_window_region(game_window, crops=[crop])
+def is_label_in_game_window_region(
+        game_window: Window, resolution: str, key: str, label: str,
+        image_ops: Optional[List[Tuple[ImageOperation, Optional[dict]]]] = None,
+        ocr_config: str = r'--oem 3 --psm 7'
+) -> bool:
+    """
+    Check whether a game window region shows a fixed label, via template matching if a template exists for the label
+    (falls back to OCR if there is no template or the match is inconclusive)
+    :param game_window: game window to take screenshot of
+    :param resolution: resolution to get/use coordinates for
+    :param key: key of region in coordinates dict
+    :param label: (lowercase) label to check for
+    :param image_ops: List of image operation tuples, format: (operation, arguments)
+    :param ocr_config: config/parameters for Tesseract OCR (see https://guides.nyu.edu/tesseract/usage)
+    :return:
+    """
+    result, screenshot = screenshot_game_window_region(
+        game_window,
+        image_ops,
+        constants.COORDINATES[resolution]['ocr'][key],
+        debug_label=key
+    )
 
-    return calc_cv2_hist_from_pil_image(result)
+    label_matcher = LabelMatcher()
+    matched = label_matcher.match(resolution, key, label, result)
+    if matched is not None:
+        return matched
 
+    found = label in image_to_string(result, ocr_config)
+    if found:
+        label_matcher.learn(resolution, key, label, result)
+    else:
+        label_matcher.confirm_mismatch(resolution, key, label)
 
-def calc_cv2_hist_from_pil_image(pil_image: Image) -> ndarray:
-    # Convert PIL to cv2 image
-    cv_image = cv2.cvtColor(np.asarray(pil_image), cv2.COLOR_RGB2BGR)
-    histogram = cv2.calcHist([cv_image], [0], None, [256], [0, 256])
+    return found
 
-    return histogram
+
+@traced('histogram')
+def histogram_screenshot_region(game_window: Window, crop: Tuple[int, int, int, int],
+                                debug_label: Optional[str] = 'histogram') -> ndarray:
+    result, screenshot = screenshot_game_window_region(game_window, crops=[crop], debug_label=debug_label)
+
+    return calc_cv2_hist(result)
+
+
+@traced('histogram')
+def histogram_screenshot_regions(game_window: Window, crops: List[Tuple[int, int, int, int]],
+                                 debug_label: Optional[str] = 'histogram') -> List[ndarray]:
+    """
+    Calculate histograms of multiple regions of a single game window screenshot
+    :param game_window: game window to take screenshot of
+    :param crops: List of image crop tuples, format: (left, top, right, bottom)
+    :param debug_label: label to save debug screenshots under (used for per-region sampling)
+    :return: histogram of each region (same order as crops)
+    """
+    result, screenshot = screenshot_game_window_region(game_window, crops=crops, debug_label=debug_label)
+
+    return calc_cv2_hists(result if isinstance(result, list) else [result])
+
+
+def calc_cv2_hist(image: ndarray, channel: int = 0) -> ndarray:
+    # Histogram a single channel (default: blue channel of a BGR image). If the image is a view with padded pixels
+    # (e.g. a BGRA capture), cv2 would copy the whole view to make it continuous, so pass just the channel plane instead.
+    with Metrics().timed('histogram'):
+        if image.ndim == 3 and image.strides[1] != image.shape[2] * image.itemsize:
+            return cv2.calcHist([image[:, :, channel]], [0], None, [256], [0, 256])
+
+        return cv2.calcHist([image], [channel], None, [256], [0, 256])
+
+
+def calc_cv2_hists(images: List[ndarray], channel: int = 0) -> List[ndarray]:
+    return [calc_cv2_hist(image, channel) for image in images]
+
+
+def calc_cv2_hist_from_pil_image(pil_image: Image) -> ndarray:
+    # PIL images are RGB, so histogram the blue channel straight away instead of converting the image to BGR first
+    return calc_cv2_hist(np.asarray(pil_image), 2)
 
 
 def calc_cv2_hist_delta(a: ndarray, b: ndarray) -> float:
@@ -424,11 +897,9 @@ def get_resolution_window_size(resolution: str) -> Tuple[int, int]:
     return window_size
 
 
+@recorded_query
 def get_command_line_by_pid(pid: int) -> Optional[List[str]]:
-    try:
-        return psutil.Process(pid=pid).cmdline()
-    except (psutil.NoSuchProcess, psutil.AccessDenied):
-        return
+    return Platform().get_backend().get_process_command_line(pid)
 
 
 def get_mod_from_command_line(pid: int) -> Optional[str]:
@@ -444,10 +915,15 @@ def get_mod_from_command_line(pid: int) -> Optional[str]:
             return command_line[index + 1][5:]
 
 
+# Not recorded, since the game's command line contains the account password
+def launch_process(command: List[str], cwd: str) -> Process:
+    return Platform().get_backend().launch_process(command, cwd)
+
+
+@recorded_input
 def run_conman(args: List[str]) -> None:
     command = [os.path.join(Config.ROOT_DIR, 'redist', 'bf2-conman.exe'), '--no-gui', *args]
-    p = subprocess.run(command, timeout=1.0, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return p.check_returncode()
+    Platform().get_backend().run_process(command, timeout=1.0)
 
 
 def is_similar_str(a: str, b: str, threshold: float = .8) -> bool:
@@ -0,0 +1,118 @@
+import sys
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from BF2AutoSpectator.common.classes import Singleton
+from BF2AutoSpectator.common.clock import Clock
+from BF2AutoSpectator.common.logger import logger
+from BF2AutoSpectator.common.tracing import Tracer
+from BF2AutoSpectator.common.utility import sleep, invalidate_frame_cache
+
+
+class WaitSiteStats:
+    calls: int
+    satisfied: int
+    timeouts: int
+    polls: int
+    total_wait: float
+    max_wait: float
+
+    def __init__(self):
+        self.calls = 0
+        self.satisfied = 0
+        self.timeouts = 0
+        self.polls = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def get_average_wait(self) -> float:
+        return self.total_wait / self.calls if self.calls > 0 else 0.0
+
+
+class WaitStats(metaclass=Singleton):
+    """
+    Keeps track of how long each wait_until call site actually had to wait, in order to see how much wall time the
+    waits need compared to their timeouts (the fixed sleeps they replaced)
+    """
+    sites: Dict[str, WaitSiteStats]
+
+    def __init__(self):
+        self.sites = {}
+        self.__lock = threading.Lock()
+
+    def record(self, label: str, satisfied: bool, polls: int, elapsed: float) -> None:
+        with self.__lock:
+            site = self.sites.get(label)
+            if site is None:
+                site = self.sites[label] = WaitSiteStats()
+
+            site.calls += 1
+            site.polls += polls
+            site.total_wait += elapsed
+            site.max_wait = max(site.max_wait, elapsed)
+            if satisfied:
+                site.satisfied += 1
+            else:
+                site.timeouts += 1
+
+    def get(self, label: str) -> Optional[WaitSiteStats]:
+        return self.sites.get(label)
+
+    def summary(self) -> List[Tuple[str, WaitSiteStats]]:
+        """
+        Get stats of all call sites
+        :return: list of label and stats tuples, sorted by total wait time (descending)
+        """
+        with self.__lock:
+            return sorted(self.sites.items(), key=lambda item: item[1].total_wait, reverse=True)
+
+    def log_summary(self) -> None:
+        for label, site in self.summary():
+            logger.debug(f'Wait {label}: {site.calls} calls, {site.satisfied} satisfied, {site.timeouts} timed out, '
+                         f'avg. {site.get_average_wait():.2f}s, max. {site.max_wait:.2f}s, {site.polls} polls')
+
+    def reset(self) -> None:
+        with self.__lock:
+            self.sites.clear()
+
+
+def wait_until(predicate: Callable[[], bool], timeout: float, poll_interval: float = .1, backoff: float = 1.5,
+               max_poll_interval: float = 1.0, label: Optional[str] = None) -> bool:
+    """
+    Wait until a condition is met (e.g. an expected screen appeared) or the timeout passed, whichever comes first
+    The frame cache is invalidated before each poll, so detectors always check a fresh capture
+    :param predicate: condition to wait for, usually a detector function
+    :param timeout: max. number of seconds to wait for
+    :param poll_interval: number of seconds to wait before the second poll
+    :param backoff: factor to increase the poll interval by after each poll (1 = poll at a fixed interval)
+    :param max_poll_interval: max. number of seconds between two polls
+    :param label: name of the call site to record timing stats under (defaults to the calling function and line)
+    :return: whether the condition was met (predicate is always polled at least once)
+    """
+    if label is None:
+        caller = sys._getframe(1)
+        label = f'{caller.f_code.co_name}:{caller.f_lineno}'
+
+    clock = Clock()
+    started_at = clock.monotonic()
+    deadline = started_at + timeout
+    polls = 0
+    interval = poll_interval
+    with Tracer().span(f'wait {label}', 'wait', {'timeout': timeout}):
+        while True:
+            invalidate_frame_cache()
+            satisfied = predicate()
+            polls += 1
+
+            remaining = deadline - clock.monotonic()
+            if satisfied or remaining <= 0:
+                break
+
+            sleep(min(interval, remaining))
+            interval = min(interval * backoff, max_poll_interval)
+
+    elapsed = clock.monotonic() - started_at
+    WaitStats().record(label, satisfied, polls, elapsed)
+    logger.debug(f'Wait {label} {"satisfied" if satisfied else "timed out"} after {elapsed:.2f}s ({polls} polls)')
+
+    return satisfied
@@ -1,4 +1,5 @@
+from .detections import Detections, Detector, DetectorScheduler, DEFAULT_DETECTOR_BUDGETS, get_loop_phase
 from .instance_manager import GameInstanceManager, GameMessage
 from .instance_state import GameInstanceState
 
-__all__ = ['GameInstanceManager', 'GameMessage', 'GameInstanceState']
+__all__ = ['Detections', 'Detector', 'DetectorScheduler', 'DEFAULT_DETECTOR_BUDGETS', 'get_loop_phase', 'GameInstanceManager', 'GameMessage', 'GameInstanceState']
@@ -0,0 +1,295 @@
+import threading
+import time
+from enum import Enum
+from typing import Dict, List, Set, Tuple, Optional
+
+from BF2AutoSpectator.common.classes import Singleton
+from BF2AutoSpectator.common.clock import Clock
+from BF2AutoSpectator.common.logger import logger
+from BF2AutoSpectator.common.recorder import SessionRecorder
+from BF2AutoSpectator.common.tracing import Tracer
+from BF2AutoSpectator.remote import GamePhase
+from .instance_manager import GameInstanceManager
+from .instance_state import GameInstanceState
+
+
+class Detector(str, Enum):
+    round_end_screen = 'round-end-screen'
+    map_loading = 'map-loading'
+    map_briefing = 'map-briefing'
+    default_camera_view = 'default-camera-view'
+
+
+# Detectors each loop phase needs, in the order they are evaluated in. Any detector not listed for a phase is treated as
+# not detected without running it. Round end screen detection comes first in every phase, since it is cheap
+# (histograms, OCR only runs if those match) and the map loading detection depends on it.
+# Phases only gate detectors, they do not handle anything themselves: the spectate loop's if/elif chain still decides
+# what to do (and thereby which phase the next tick is in, see get_loop_phase). The only transition within a tick is
+# switching to the loading phase once a round end/map loading/map briefing screen is detected.
+PHASE_DETECTORS: Dict[GamePhase, List[Detector]] = {
+    # Between rounds, the round end screen items decide what to do next, so check everything
+    GamePhase.loading: [
+        Detector.round_end_screen, Detector.map_loading, Detector.map_briefing, Detector.default_camera_view
+    ],
+    # The round may end before spawning succeeds, so check everything here as well
+    GamePhase.spawning: [
+        Detector.round_end_screen, Detector.map_loading, Detector.map_briefing, Detector.default_camera_view
+    ],
+    # While spectating, detecting the round end screen is enough to notice the round ending (which switches to the
+    # loading phase)
+    GamePhase.spectating: [
+        Detector.round_end_screen, Detector.default_camera_view
+    ],
+}
+
+# Regions each detector reads, format: (ocr keys, histogram key paths, whether the spectated view is read)
+DETECTOR_REGIONS: Dict[Detector, Tuple[List[str], List[Tuple[str, ...]], bool]] = {
+    Detector.round_end_screen: (
+        ['eor-header-items'],
+        [('eor', 'score-list'), ('eor', 'top-players'), ('eor', 'top-scores'), ('eor', 'map-briefing')],
+        False
+    ),
+    Detector.map_loading: (['join-game-button'], [], False),
+    Detector.map_briefing: (['map-briefing-header'], [], False),
+    Detector.default_camera_view: ([], [], True),
+}
+
+
+# Default max. number of seconds a (negative) detector result may be reused for, instead of running the detector again.
+# The round end screen is rare and fine to detect a tick late, while the map loading (which map load delaying needs to
+# catch early) and the default camera view (which the freecam spawn reacts to) always need a fresh result. Since map
+# loading detection depends on the round end screen, it forces a fresh round end screen result as well.
+DEFAULT_DETECTOR_BUDGETS: Dict[Detector, float] = {
+    Detector.round_end_screen: 3.0,
+    Detector.map_loading: 0.0,
+    Detector.map_briefing: 3.0,
+    Detector.default_camera_view: 0.0,
+}
+
+
+class DetectorStats:
+    runs: int
+    hits: int
+    reuses: int
+    total_cost: float
+    last_result: Optional[bool]
+    last_run_at: float
+
+    def __init__(self):
+        self.runs = 0
+        self.hits = 0
+        self.reuses = 0
+        self.total_cost = 0.0
+        self.last_result = None
+        self.last_run_at = 0.0
+
+    def get_average_cost(self) -> float:
+        return self.total_cost / self.runs if self.runs > 0 else 0.0
+
+    def get_hit_rate(self) -> float:
+        return self.hits / self.runs if self.runs > 0 else 0.0
+
+
+class DetectorScheduler(metaclass=Singleton):
+    """
+    Records the cost (seconds per run) and hit rate (share of runs that detected their screen element) of each detector
+    and decides whether a detector needs to run or whether its last result can be reused. Only negative results are
+    reused, and only within the detector's latency budget, which is shortened by the detector's hit rate (detectors that
+    hit often are likely to hit again soon). Detectors that are cheaper than the min. cost always run, as reusing their
+    result would not save anything. Any reusable results are discarded when the loop phase changes.
+    """
+    budgets: Dict[Detector, float]
+    min_cost: float
+    stats: Dict[Detector, DetectorStats]
+    phase: Optional[GamePhase]
+
+    def __init__(self):
+        self.budgets = dict(DEFAULT_DETECTOR_BUDGETS)
+        self.min_cost = .005
+        self.stats = {detector: DetectorStats() for detector in Detector}
+        self.phase = None
+        self.__lock = threading.Lock()
+
+    def configure(self, budgets: Optional[Dict[str, float]] = None, min_cost: float = .005) -> None:
+        """
+        Configure the scheduler
+        :param budgets: max. number of seconds to reuse a negative result for, by detector name (any detectors not
+        listed keep their default budget)
+        :param min_cost: min. average cost in seconds for a detector's result to be reused
+        :return:
+        """
+        with self.__lock:
+            self.budgets = dict(DEFAULT_DETECTOR_BUDGETS)
+            for name, budget in (budgets if budgets is not None else {}).items():
+                self.budgets[Detector(name)] = budget
+            self.min_cost = min_cost
+
+    def set_phase(self, phase: GamePhase) -> None:
+        with self.__lock:
+            if phase is not self.phase:
+                # Results from another phase say nothing about the current one
+                for stats in self.stats.values():
+                    stats.last_result = None
+            self.phase = phase
+
+    def get_result(self, detector: Detector) -> Optional[bool]:
+        """
+        Get a reusable result of a detector
+        :param detector: detector to get the result of
+        :return: the detector's last result if it can be reused, else None (meaning the detector needs to run)
+        """
+        with self.__lock:
+            stats = self.stats[detector]
+            if stats.last_result is None or stats.last_result or stats.get_average_cost() < self.min_cost:
+                return None
+
+            budget = self.budgets.get(detector, 0.0) * (1 - stats.get_hit_rate())
+            if Clock().monotonic() - stats.last_run_at >= budget:
+                return None
+
+            stats.reuses += 1
+            return stats.last_result
+
+    def record(self, detector: Detector, result: bool, cost: float) -> None:
+        with self.__lock:
+            stats = self.stats[detector]
+            stats.runs += 1
+            stats.hits += 1 if result else 0
+            stats.total_cost += cost
+            stats.last_result = result
+            stats.last_run_at = Clock().monotonic()
+
+    def get_schedule(self) -> Dict[Detector, float]:
+        """
+        Get the number of seconds each detector's negative results are currently reused for
+        :return:
+        """
+        with self.__lock:
+            return {
+                detector: self.budgets.get(detector, 0.0) * (1 - stats.get_hit_rate())
+                if stats.get_average_cost() >= self.min_cost else 0.0
+                for detector, stats in self.stats.items()
+            }
+
+    def log_summary(self) -> None:
+        schedule = self.get_schedule()
+        for detector, stats in self.stats.items():
+            logger.debug(f'Detector {detector.value}: {stats.runs} runs, {stats.reuses} reuses, '
+                         f'avg. cost {stats.get_average_cost() * 1000:.1f}ms, hit rate {stats.get_hit_rate():.2f}, '
+                         f'reused for {schedule[detector]:.2f}s')
+
+
+def get_loop_phase(gis: GameInstanceState) -> GamePhase:
+    """
+    Determine the phase of the spectate loop (and thus which detectors are needed) from the game instance state
+    :param gis: game instance state
+    :return: loading (between rounds), spawning or spectating
+    """
+    if gis.map_loading():
+        return GamePhase.loading
+    elif not gis.round_spawned():
+        return GamePhase.spawning
+
+    return GamePhase.spectating
+
+
+class Detections:
+    """
+    Detector results of a single loop iteration. Detectors are only run when their result is first requested and only
+    if the current phase needs them, any later request returns the same result. Results of previous iterations are
+    reused as long as the detector scheduler allows.
+    """
+    gim: GameInstanceManager
+    phase: GamePhase
+
+    __results: Dict[Detector, bool]
+    __reused: Set[Detector]
+
+    def __init__(self, gim: GameInstanceManager, phase: GamePhase):
+        self.gim = gim
+        self.phase = phase
+        self.__results = {}
+        self.__reused = set()
+        DetectorScheduler().set_phase(phase)
+
+    def set_phase(self, phase: GamePhase) -> None:
+        if phase is not self.phase:
+            logger.debug(f'Switching detections from {self.phase.value} to {phase.value} phase')
+            Tracer().instant(f'phase {phase.value}', 'loop')
+        self.phase = phase
+        DetectorScheduler().set_phase(phase)
+
+    def set_capture_plan(self, ocr_keys: List[str]) -> None:
+        """
+        Limit game window captures to the regions the current phase's detectors (plus the given ones) require
+        :param ocr_keys: keys of any additional regions in the ocr coordinates dict
+        :return:
+        """
+        ocr_keys = list(ocr_keys)
+        hist_keys = []
+        spectated_view = False
+        for detector in PHASE_DETECTORS[self.phase]:
+            detector_ocr_keys, detector_hist_keys, detector_spectated_view = DETECTOR_REGIONS[detector]
+            ocr_keys.extend(detector_ocr_keys)
+            hist_keys.extend(detector_hist_keys)
+            spectated_view = spectated_view or detector_spectated_view
+
+        self.gim.set_capture_plan(ocr_keys, hist_keys, spectated_view)
+
+    def get(self, detector: Detector, fresh: bool = False) -> bool:
+        """
+        Get whether a detector detects its screen element
+        :param detector: detector to get the result of
+        :param fresh: run the detector if its result so far was reused from a previous iteration
+        :return:
+        """
+        if detector not in PHASE_DETECTORS[self.phase]:
+            return False
+
+        result = self.__results.get(detector)
+        if result is None or fresh and detector in self.__reused:
+            result = self.__results[detector] = self.__schedule(detector, fresh)
+
+        return result
+
+    def any_detected(self, *detectors: Detector) -> bool:
+        """
+        Check whether any of the given detectors detect their screen element, stopping at the first one that does
+        (detectors are evaluated in the order the current phase declares)
+        :param detectors: detectors to check
+        :return:
+        """
+        return any(self.get(detector) for detector in PHASE_DETECTORS[self.phase] if detector in detectors)
+
+    def __schedule(self, detector: Detector, fresh: bool) -> bool:
+        scheduler = DetectorScheduler()
+        result = scheduler.get_result(detector) if not fresh else None
+        if result is not None:
+            SessionRecorder().record_detector(detector.value, result, True)
+            self.__reused.add(detector)
+            return result
+
+        self.__reused.discard(detector)
+
+        started_at = time.perf_counter()
+        with Tracer().span(detector.value, 'detector'):
+            result = self.__detect(detector)
+        scheduler.record(detector, result, time.perf_counter() - started_at)
+        SessionRecorder().record_detector(detector.value, result, False)
+
+        return result
+
+    def __detect(self, detector: Detector) -> bool:
+        if detector is Detector.round_end_screen:
+            return self.gim.is_round_end_screen_visible()
+        elif detector is Detector.map_loading:
+            # Map can only be loading if the round end screen is visible, so skip (OCR-ing) the join game button
+            # if it was not (is_map_loading checks both again in an order that avoids a race with entering the map).
+            # A reused (negative) round end screen result may be outdated, which would delay noticing the map load.
+            return self.get(Detector.round_end_screen, fresh=True) and self.gim.is_map_loading()
+        elif detector is Detector.map_briefing:
+            return self.gim.is_map_briefing_visible()
+        elif detector is Detector.default_camera_view:
+            return self.gim.is_default_camera_view_visible()
+
+        raise ValueError(f'Unknown detector: {detector}')
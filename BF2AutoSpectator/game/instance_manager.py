@@ -2,29 +2,29 @@ import os
 import random
 import re
 import subprocess
-import time
 from enum import Enum
-from typing import Tuple, Optional
+from typing import Tuple, Optional, List, Dict, Mapping, Callable
 
 import numpy as np
-import pyautogui
-import win32con
-import win32gui
 
 from BF2AutoSpectator.common import constants
+from BF2AutoSpectator.common.config import Config
 from BF2AutoSpectator.common.exceptions import SpawnCoordinatesNotAvailableException
+from BF2AutoSpectator.common.histograms import ReferenceHistograms, build_reference_histograms
 from BF2AutoSpectator.common.logger import logger
+from BF2AutoSpectator.common.metrics import Metrics
+from BF2AutoSpectator.common.motion import MotionSampler
 from BF2AutoSpectator.common.utility import Window, find_window_by_title, get_resolution_window_size, \
     mouse_move_to_game_window_coord, mouse_click_in_game_window, ocr_screenshot_game_window_region, auto_press_key, \
-    mouse_reset_legacy, mouse_move_legacy, is_responding_pid, histogram_screenshot_region, calc_cv2_hist_delta, \
+    mouse_reset_legacy, mouse_move_legacy, is_running_pid, histogram_screenshot_region, calc_cv2_hist_delta, \
     ImageOperation, mouse_reset, get_mod_from_command_line, run_conman, ocr_screenshot_region, is_similar_str, \
-    press_key, release_key
+    press_key, release_key, sleep, get_game_window_region, set_game_window_capture_plan, \
+    is_label_in_game_window_region, histogram_screenshot_regions, launch_process, press_named_key, write_text, \
+    bring_window_to_foreground, type_text, clear_text_input, mouse_click_at_legacy_coord, \
+    MouseCalibration, screenshot_game_window_region
+from BF2AutoSpectator.common.wait import wait_until
 from .instance_state import GameInstanceState
 
-# Remove the top left corner from pyautogui failsafe points
-# (avoid triggering failsafe exception due to mouse moving to top left during spawn)
-del pyautogui.FAILSAFE_POINTS[0]
-
 
 MAP_NAME_REGEX_NvN = re.compile(r'(\d+).?v.?(\d+)')
 MAP_NAME_REGEX_SEPARATORS = re.compile(r'[_.\s]')
@@ -50,18 +50,21 @@ class GameInstanceManager:
     player_name: str
     player_pass: str
     resolution: str
-    histograms: dict
+    histograms: Mapping[str, dict]
+    references: Dict[str, ReferenceHistograms]
 
     game_window: Optional[Window] = None
 
     state: GameInstanceState
 
-    def __init__(self, game_path: str, player_name: str, player_pass: str, resolution: str, histograms: dict):
+    def __init__(self, game_path: str, player_name: str, player_pass: str, resolution: str,
+                 histograms: Mapping[str, dict]):
         self.game_path = game_path
         self.player_name = player_name
         self.player_pass = player_pass
         self.resolution = resolution
         self.histograms = histograms
+        self.references = build_reference_histograms(histograms)
 
         # Init game instance state
         self.state = GameInstanceState()
@@ -116,29 +119,28 @@ class GameInstanceManager:
 
         # Run command
         try:
-            p = subprocess.Popen(
-                command,
-                close_fds=True, cwd=self.game_path,
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE
-            )
+            p = launch_process(command, self.game_path)
         except (FileNotFoundError, PermissionError, subprocess.SubprocessError) as e:
             logger.error(f'Failed to launch game instance ({e})')
             return False, False, None
 
         # Wait for game window to come up
         game_window_present, correct_params, running_mod = False, False, None
-        check_count = 0
-        check_limit = 5
-        while p.poll() is None and not game_window_present and check_count < check_limit:
+
+        def is_game_window_present() -> bool:
+            nonlocal game_window_present, correct_params, running_mod
             # If we join a server with a different mod without knowing it, the game will restart with that mod
             # => update config to use whatever mod the game is now running with
             game_window_present, correct_params, running_mod = self.find_instance(mod)
-            check_count += 1
-            time.sleep(4)
+            return game_window_present or p.poll() is not None
+
+        wait_until(is_game_window_present, timeout=20, poll_interval=1, label='launch-window')
 
-        # If game window came up, give it some time for login etc.
+        # If game window came up, give it some time for login etc. The menu is drawn before the account login finishes,
+        # so always wait the full login time and only wait longer if the menu is not visible by then
         if game_window_present:
-            time.sleep(6)
+            sleep(6)
+            wait_until(self.is_in_menu, timeout=4, poll_interval=.5, label='launch-login')
 
         return game_window_present, correct_params, running_mod
 
@@ -174,20 +176,21 @@ class GameInstanceManager:
 
         # Click quit menu item
         mouse_move_to_game_window_coord(self.game_window, self.resolution, 'quit-menu-item')
-        time.sleep(.2)
+        sleep(.2)
         mouse_click_in_game_window(self.game_window)
 
-        time.sleep(2)
+        # Only consider the instance quit once the process has exited (not just stopped responding while shutting down)
+        return wait_until(lambda: not is_running_pid(self.game_window.pid), timeout=2, poll_interval=.25,
+                          label='quit-instance')
 
-        return not is_responding_pid(self.game_window.pid)
-
-    def open_menu(self, max_attempts: int = 5, sleep: float = 1.0) -> bool:
+    def open_menu(self, max_attempts: int = 5, delay: float = 1.0) -> bool:
         # Spam press ESC if menu is not already visible
         attempt = 0
-        while not (in_menu := self.is_in_menu()) and attempt < max_attempts:
+        in_menu = self.is_in_menu()
+        while not in_menu and attempt < max_attempts:
             auto_press_key(0x01)
             attempt += 1
-            time.sleep(sleep)
+            in_menu = wait_until(self.is_in_menu, timeout=delay, label='open-menu')
 
         if not in_menu:
             return False
@@ -197,14 +200,39 @@ class GameInstanceManager:
 
         return True
 
+    def set_capture_plan(self, ocr_keys: List[str], hist_keys: List[Tuple[str, ...]],
+                         spectated_view: bool = False) -> None:
+        """
+        Limit game window captures to the regions the given detection coordinates require
+        :param ocr_keys: keys of regions in the ocr coordinates dict
+        :param hist_keys: key paths of regions in the histogram coordinates dict, e.g. ('eor', 'score-list')
+        :param spectated_view: whether to include the spectated view (as used for default camera view/action detection)
+        :return:
+        """
+        crops = []
+        for key in ocr_keys:
+            crops.extend(constants.COORDINATES[self.resolution]['ocr'][key])
+
+        for key_path in hist_keys:
+            coordinates = constants.COORDINATES[self.resolution]['hists']
+            for key in key_path:
+                coordinates = coordinates[key]
+            crops.extend(coordinates if isinstance(coordinates, list) else [coordinates])
+
+        if spectated_view:
+            crops.append(constants.SPECTATED_VIEW_CROP)
+
+        set_game_window_capture_plan(self.game_window, crops)
+
     """
     Functions for detecting game state elements
     """
     def is_game_message_visible(self) -> bool:
-        return 'game message' in ocr_screenshot_game_window_region(
+        return is_label_in_game_window_region(
             self.game_window,
             self.resolution,
             'game-message-header',
+            'game message',
             image_ops=[(ImageOperation.invert, None)]
         )
 
@@ -240,10 +268,11 @@ class GameInstanceManager:
 
     def is_in_menu(self) -> bool:
         # Get ocr result of quit menu item area
-        return 'quit' in ocr_screenshot_game_window_region(
+        return is_label_in_game_window_region(
             self.game_window,
             self.resolution,
             'quit-menu-item',
+            'quit',
             image_ops=[
                 (ImageOperation.grayscale, None),
                 (ImageOperation.colorize, {'black': '#000', 'white': '#fff', 'blackpoint': 30, 'whitepoint': 175}),
@@ -262,26 +291,25 @@ class GameInstanceManager:
             self.game_window,
             constants.COORDINATES[self.resolution]['hists']['menu'][menu_item]
         )
-        delta = calc_cv2_hist_delta(
-            histogram,
-            self.histograms[self.resolution]['menu'][menu_item]['active']
-        )
+        delta = self.references['menu'].distance(histogram, menu_item)
 
         return delta < constants.HISTCMP_MAX_DELTA
 
     def is_disconnect_prompt_visible(self) -> bool:
-        return 'disconnect' in ocr_screenshot_game_window_region(
+        return is_label_in_game_window_region(
             self.game_window,
             self.resolution,
             'disconnect-prompt-header',
+            'disconnect',
             image_ops=[(ImageOperation.invert, None)]
         )
 
     def is_disconnect_button_visible(self) -> bool:
-        return 'disconnect' in ocr_screenshot_game_window_region(
+        return is_label_in_game_window_region(
             self.game_window,
             self.resolution,
             'disconnect-button',
+            'disconnect',
             image_ops=[
                 (ImageOperation.grayscale, None),
                 (ImageOperation.colorize, {'black': '#000', 'white': '#fff', 'blackpoint': 30, 'whitepoint': 175}),
@@ -290,10 +318,11 @@ class GameInstanceManager:
         )
 
     def is_play_now_button_visible(self) -> bool:
-        return 'play now' in ocr_screenshot_game_window_region(
+        return is_label_in_game_window_region(
             self.game_window,
             self.resolution,
             'play-now-button',
+            'play now',
             image_ops=[
                 (ImageOperation.grayscale, None),
                 (ImageOperation.colorize, {'black': '#000', 'white': '#fff', 'blackpoint': 100, 'whitepoint': 200})
@@ -302,7 +331,13 @@ class GameInstanceManager:
 
     def is_round_end_screen_visible(self) -> bool:
         round_end_screen_items = ['score-list', 'top-players', 'top-scores', 'map-briefing']
-        active = [self.is_round_end_screen_item_active(item) for item in round_end_screen_items]
+        histograms = histogram_screenshot_regions(
+            self.game_window,
+            [constants.COORDINATES[self.resolution]['hists']['eor'][item] for item in round_end_screen_items]
+        )
+        # Compare all items against their active reference at once
+        deltas = self.references['eor'].distances_to(histograms, round_end_screen_items)
+        active = [delta < constants.HISTCMP_MAX_DELTA for delta in deltas]
 
         # During map load, only item is active at any time. When the round just ended, all are active.
         if not (all(active) or len([a for a in active if a]) == 1):
@@ -317,11 +352,13 @@ class GameInstanceManager:
                 (ImageOperation.grayscale, None),
                 (ImageOperation.colorize, {'black': '#000', 'white': '#fff', 'blackpoint': 50, 'whitepoint': 135}),
                 (ImageOperation.invert, None),
-            ]
+            ],
+            batch_fallback=False
         )
 
         # Due to the eor header items being transparent, ocr is not going to always detect all items
-        # So, we'll take any ocr match (the strings are fairly unique)
+        # So, we'll take any ocr match (the strings are fairly unique), which also means we don't need to know which
+        # label belongs to which item (no need to fall back to one ocr run per item)
         return any(label in item_labels for label in ['score list', 'top players', 'top scores', 'map briefing'])
 
     def is_round_end_screen_item_active(self, round_end_screen_item: str) -> bool:
@@ -329,18 +366,16 @@ class GameInstanceManager:
             self.game_window,
             constants.COORDINATES[self.resolution]['hists']['eor'][round_end_screen_item]
         )
-        delta = calc_cv2_hist_delta(
-            histogram,
-            self.histograms[self.resolution]['eor'][round_end_screen_item]['active']
-        )
+        delta = self.references['eor'].distance(histogram, round_end_screen_item)
 
         return delta < constants.HISTCMP_MAX_DELTA
 
     def is_connect_to_ip_button_visible(self) -> bool:
-        return 'connect to ip' in ocr_screenshot_game_window_region(
+        return is_label_in_game_window_region(
             self.game_window,
             self.resolution,
             'connect-to-ip-button',
+            'connect to ip',
             image_ops=[
                 (ImageOperation.grayscale, None),
                 (ImageOperation.colorize, {'black': '#000', 'white': '#fff', 'blackpoint': 30, 'whitepoint': 175}),
@@ -353,10 +388,11 @@ class GameInstanceManager:
         mouse_reset(self.game_window)
 
         # Get ocr result of bottom left corner where "join game"-button would be
-        return 'join game' in ocr_screenshot_game_window_region(
+        return is_label_in_game_window_region(
             self.game_window,
             self.resolution,
             'join-game-button',
+            'join game',
             image_ops=[
                 (ImageOperation.grayscale, None),
                 (ImageOperation.colorize, {'black': '#000', 'white': '#fff', 'blackpoint': 30, 'whitepoint': 175}),
@@ -380,16 +416,17 @@ class GameInstanceManager:
 
         delta = calc_cv2_hist_delta(
             histogram,
-            self.histograms[self.resolution]['eor']['loading-bar']
+            self.histograms['eor']['loading-bar']
         )
 
         return delta < constants.HISTCMP_MAX_DELTA
 
     def is_map_briefing_visible(self) -> bool:
-        return 'map briefing' in ocr_screenshot_game_window_region(
+        return is_label_in_game_window_region(
             self.game_window,
             self.resolution,
             'map-briefing-header',
+            'map briefing',
             image_ops=[(ImageOperation.invert, None)]
         )
 
@@ -406,15 +443,13 @@ class GameInstanceManager:
 
         # Move cursor onto map briefing header and click
         mouse_move_to_game_window_coord(self.game_window, self.resolution, 'map-briefing-eor-item')
-        time.sleep(.2)
+        sleep(.2)
         mouse_click_in_game_window(self.game_window, legacy=True)
 
-        time.sleep(.5)
-
         # Move cursor back to default position
         mouse_reset(self.game_window)
 
-        return self.is_map_briefing_visible()
+        return wait_until(self.is_map_briefing_visible, timeout=.5, label='open-map-briefing')
 
     def is_spawn_menu_visible(self) -> bool:
         histogram = histogram_screenshot_region(
@@ -423,7 +458,7 @@ class GameInstanceManager:
         )
         delta = calc_cv2_hist_delta(
             histogram,
-            self.histograms[self.resolution]['spawn-menu']['close-button']
+            self.histograms['spawn-menu']['close-button']
         )
 
         return delta < constants.HISTCMP_MAX_DELTA
@@ -490,82 +525,77 @@ class GameInstanceManager:
 
     def get_player_team(self) -> Optional[int]:
         # Get histograms of team selection areas
-        team_selection_histograms = []
-        for coord_set in constants.COORDINATES[self.resolution]['hists']['teams']:
-            histogram = histogram_screenshot_region(
-                self.game_window,
-                coord_set
-            )
-            team_selection_histograms.append(histogram)
+        team_selection_histograms = histogram_screenshot_regions(
+            self.game_window,
+            constants.COORDINATES[self.resolution]['hists']['teams']
+        )
 
-        # Calculate histogram deltas and compare against known ones
+        # Compare each team selection area against all known (active) teams of that side at once
         team = None
-        for team_key in constants.TEAMS_SPAWN_MENU_LEFT:
-            histogram_delta = calc_cv2_hist_delta(
-                team_selection_histograms[0],
-                self.histograms[self.resolution]['teams'][team_key]['active']
-            )
-
-            if histogram_delta < constants.HISTCMP_MAX_DELTA:
-                team = 0
-                break
-
-        for team_key in constants.TEAMS_SPAWN_MENU_RIGHT:
-            histogram_delta = calc_cv2_hist_delta(
-                team_selection_histograms[1],
-                self.histograms[self.resolution]['teams'][team_key]['active']
-            )
+        left_team_key, left_delta = self.references['teams'].best_match(
+            team_selection_histograms[0],
+            constants.TEAMS_SPAWN_MENU_LEFT
+        )
+        right_team_key, right_delta = self.references['teams'].best_match(
+            team_selection_histograms[1],
+            constants.TEAMS_SPAWN_MENU_RIGHT
+        )
 
-            if histogram_delta < constants.HISTCMP_MAX_DELTA:
-                team = 1
-                break
+        if right_delta < constants.HISTCMP_MAX_DELTA:
+            team = 1
+        elif left_delta < constants.HISTCMP_MAX_DELTA:
+            team = 0
 
-        logger.debug(f'Detected team is {team}')
+        logger.debug(f'Detected team is {team} (best matches: {left_team_key}/{left_delta:.3f}, '
+                     f'{right_team_key}/{right_delta:.3f})')
 
         return team
 
     def is_default_camera_view_visible(self) -> bool:
         map_name = self.state.get_rotation_map_name()
         # Return false if map has not been determined (yet) or is not supported
-        if map_name is None or map_name not in self.histograms[self.resolution]['maps']['default-camera-view']:
+        if map_name is None or map_name not in self.references['maps/default-camera-view']:
             return False
 
         histogram = histogram_screenshot_region(
             self.game_window,
-            (
-                168,
-                0,
-                168,
-                0
-            )
-        )
-        delta = calc_cv2_hist_delta(
-            histogram,
-            self.histograms[self.resolution]['maps']['default-camera-view'][map_name]
+            constants.SPECTATED_VIEW_CROP
         )
+        delta = self.references['maps/default-camera-view'].distance(histogram, map_name)
 
         return delta < constants.DEFAULT_CAMERA_VIEW_HISTCMP_MAX_DELTA
 
+    def get_spectated_view_region(self) -> Optional[Tuple[int, int, int, int]]:
+        # Only provide a region while spectating, there is no point in sampling menus or the spawn screen
+        game_window = self.game_window
+        if game_window is None or not self.state.round_spawned():
+            return None
+
+        left, top, width, height = get_game_window_region(game_window)
+        crop_left, crop_top, crop_right, crop_bottom = constants.SPECTATED_VIEW_CROP
+        return left + crop_left, top + crop_top, width - crop_left - crop_right, height - crop_top - crop_bottom
+
     def is_sufficient_action_on_screen(self, screenshot_count: int = 3, screenshot_sleep: float = .55,
-                                       min_delta: float = .022) -> bool:
+                                       min_delta: float = .022, min_motion_score: float = .015) -> bool:
+        # Use the background motion sampler's rolling score if available, which does not require blocking
+        motion_score = MotionSampler().get_score() if MotionSampler().is_running() else None
+        if motion_score is not None:
+            logger.debug(f'Motion score: {motion_score}')
+            return motion_score > min_motion_score
+
         histograms = []
 
         # Take screenshots and calculate histograms
         for i in range(0, screenshot_count):
             histogram = histogram_screenshot_region(
                 self.game_window,
-                (
-                    168,
-                    0,
-                    168,
-                    0
-                )
+                constants.SPECTATED_VIEW_CROP
             )
             histograms.append(histogram)
 
             # Sleep before taking next screenshot
             if i + 1 < screenshot_count:
-                time.sleep(screenshot_sleep)
+                sleep(screenshot_sleep)
 
         histogram_deltas = []
         # Calculate histogram differences
@@ -579,72 +609,140 @@ class GameInstanceManager:
 
         return average_delta > min_delta
 
+    def scan_for_active_player(self, candidates: int, dwell: float, min_motion_score: float,
+                               on_decision: Optional[Callable[[int, Optional[float], bool], None]] = None,
+                               return_tolerance: float = .75) -> bool:
+        """
+        Rapidly rotate through players and settle on the one with the most action on screen, scoring each candidate
+        from a short motion sample (requires the motion sampler to be running). Since the spectator can only cycle
+        forward (and the number of players is unknown), the best candidate is returned to by cycling on until a
+        candidate again scores higher than every other candidate did (and close to the best score). If no candidate was
+        active, the scan ends after the first pass.
+        :param candidates: max. number of players to rotate through (per pass)
+        :param dwell: max. number of seconds to sample each candidate for
+        :param min_motion_score: min. motion score to consider a candidate active
+        :param on_decision: called for each rotation with the candidate number, its score and whether it was settled on
+        :param return_tolerance: min. share of the best score a candidate needs to reach to be settled on when cycling back
+        :return: whether an active player was settled on (else, the last scanned candidate remains spectated)
+        """
+        sampler = MotionSampler()
+        if not sampler.is_running():
+            logger.warning('Motion sampler is not running, cannot scan for active player')
+            return False
+
+        # First pass: score every candidate
+        best_candidate, best_score, runner_up_score = None, None, None
+        for candidate in range(1, candidates + 1):
+            score = self.__measure_scan_candidate(sampler, candidate, dwell)
+            if score is not None and (best_score is None or score > best_score):
+                best_candidate, best_score, runner_up_score = candidate, score, best_score
+            elif score is not None and (runner_up_score is None or score > runner_up_score):
+                runner_up_score = score
+
+            # Settle right away if the last candidate is the best one (there is no need to cycle back to it)
+            settled = candidate == candidates and best_candidate == candidates
+            if on_decision is not None:
+                on_decision(candidate, score, settled)
+            if settled:
+                return best_score > min_motion_score
+            elif score is None:
+                return False
+
+        if best_score is None or best_score <= min_motion_score:
+            # Cycling back would only cost more time without ending up on an active player
+            logger.debug(f'AFK scan found no active candidate (best motion score {best_score}), staying on last')
+            return False
+
+        logger.debug(f'AFK scan best candidate: #{best_candidate} (motion score {best_score}), cycling back to it')
+
+        # Second pass: cycle forward until reaching a candidate that stands out like the best candidate did
+        for candidate in range(candidates + 1, 2 * candidates + 1):
+            score = self.__measure_scan_candidate(sampler, candidate, dwell)
+            settled = score is not None and score > min_motion_score and score >= best_score * return_tolerance and \
+                (runner_up_score is None or score > runner_up_score)
+            if on_decision is not None:
+                on_decision(candidate, score, settled)
+            if settled:
+                return True
+            elif score is None:
+                return False
+
+        logger.debug('AFK scan did not get back to a candidate scoring close to the best one')
+        return False
+
+    def __measure_scan_candidate(self, sampler: MotionSampler, candidate: int, dwell: float) -> Optional[float]:
+        self.rotate_to_next_player()
+        Metrics().increment('afk_rotations')
+        score = sampler.measure(dwell)
+        if score is None:
+            # The sampler was stopped (or could not capture the spectated view) while measuring
+            logger.warning(f'AFK scan candidate #{candidate}: no motion samples taken '
+                           f'(sampler running: {sampler.is_running()}, errors: {sampler.errors}), aborting scan')
+        else:
+            logger.debug(f'AFK scan candidate #{candidate}: motion score {score}')
+
+        return score
+
     """
     Functions to interact with the game instance (=change state)
     """
     def bring_to_foreground(self) -> None:
-        win32gui.ShowWindow(self.game_window.handle, win32con.SW_SHOW)
-        win32gui.SetForegroundWindow(self.game_window.handle)
+        bring_window_to_foreground(self.game_window)
 
     def connect_to_server(self, server_ip: str, server_port: str, server_pass: Optional[str] = None) -> bool:
         if not self.is_multiplayer_menu_active():
             # Move cursor onto multiplayer menu item and click
             mouse_move_to_game_window_coord(self.game_window, self.resolution, 'multiplayer-menu-item')
-            time.sleep(.2)
+            sleep(.2)
             mouse_click_in_game_window(self.game_window)
 
         if not self.is_join_internet_menu_active():
             # Move cursor onto join internet menu item and click
             mouse_move_to_game_window_coord(self.game_window, self.resolution, 'join-internet-menu-item')
-            time.sleep(.2)
+            sleep(.2)
             mouse_click_in_game_window(self.game_window)
 
-        check_count = 0
-        check_limit = 10
-        while not self.is_connect_to_ip_button_visible() and check_count < check_limit:
-            check_count += 1
-            time.sleep(1)
-
-        if not self.is_connect_to_ip_button_visible():
+        if not wait_until(self.is_connect_to_ip_button_visible, timeout=10, poll_interval=.25,
+                          label='connect-to-ip-button'):
             return False
 
         # Move cursor onto connect to ip button and click
         mouse_move_to_game_window_coord(self.game_window, self.resolution, 'connect-to-ip-button')
-        time.sleep(.2)
+        sleep(.2)
         mouse_click_in_game_window(self.game_window)
 
         # Give field popup time to appear
-        time.sleep(.3)
+        sleep(.3)
 
         # Clear out ip field
-        pyautogui.press('backspace', presses=20, interval=.05)
+        press_named_key('backspace', presses=20, interval=.05)
 
         # Write ip
-        pyautogui.write(server_ip, interval=.05)
+        write_text(server_ip, interval=.05)
 
         # Hit tab to enter port
-        pyautogui.press('tab')
+        press_named_key('tab')
 
         # Clear out port field
-        pyautogui.press('backspace', presses=10, interval=.05)
+        press_named_key('backspace', presses=10, interval=.05)
 
         # Write port
-        pyautogui.write(server_port, interval=.05)
+        write_text(server_port, interval=.05)
 
-        time.sleep(.3)
+        sleep(.3)
 
         # Write password if required
         # Field clears itself, so need to clear manually
         if server_pass is not None:
-            pyautogui.press('tab')
+            press_named_key('tab')
 
-            pyautogui.write(server_pass, interval=.05)
+            write_text(server_pass, interval=.05)
 
-            time.sleep(.3)
+            sleep(.3)
 
         # Move cursor onto ok button and click
         mouse_move_to_game_window_coord(self.game_window, self.resolution, 'connect-to-ip-ok-button')
-        time.sleep(.2)
+        sleep(.2)
         mouse_click_in_game_window(self.game_window)
 
         # Successfully joining a server means leaving the menu, so wait for menu to disappear
@@ -661,13 +759,13 @@ class GameInstanceManager:
                 logger.warning('Disconnect prompt is visible, clicking "Yes" to disconnect')
                 # Click "yes" in order to disconnect
                 mouse_move_to_game_window_coord(self.game_window, self.resolution, 'disconnect-prompt-yes-button')
-                time.sleep(.2)
+                sleep(.2)
                 mouse_click_in_game_window(self.game_window)
-                time.sleep(.5)
+                sleep(.5)
                 # Stop checking, since we will stay in menu (game only disconnects here, we need to retry connecting)
                 break
             check_count += 1
-            time.sleep(1)
+            sleep(1)
 
         return not in_menu
 
@@ -676,17 +774,14 @@ class GameInstanceManager:
         if self.is_disconnect_button_visible():
             # Move cursor onto disconnect button and click
             mouse_move_to_game_window_coord(self.game_window, self.resolution, 'disconnect-button')
-            time.sleep(.2)
+            sleep(.2)
             mouse_click_in_game_window(self.game_window)
 
             # Reset mouse to avoid blocking ocr of button region
             mouse_reset(self.game_window)
 
-            check = 0
-            max_checks = 5
-            while not self.is_play_now_button_visible() and check < max_checks:
-                check += 1
-                time.sleep(.3)
+            wait_until(self.is_play_now_button_visible, timeout=1.5, poll_interval=.3, backoff=1,
+                       label='disconnect')
 
         # We should still be in the menu but see the "play now" button instead of the "disconnect" button
         return self.is_in_menu() and self.is_play_now_button_visible()
@@ -695,26 +790,18 @@ class GameInstanceManager:
         if not self.state.map_loading():
             return False
 
-        check_count = 0
-        check_limit = 18
-        started_loading = False
-        while not started_loading and check_count < check_limit:
-            started_loading = self.is_loading_bar_visible()
-            if not started_loading:
-                check_count += 1
-                time.sleep(.25)
-
-        if not started_loading:
+        if not wait_until(self.is_loading_bar_visible, timeout=4.5, poll_interval=.25, backoff=1,
+                          label='map-load-start'):
             return False
 
         # Toggling ALT somehow "pauses"/"resumes" the game while keeping the audio running
         # In contrast, BF2mld's approach of suspending the process pauses the audio (not ideal with loading music on)
         logger.debug('Suspending map load')
-        pyautogui.press('alt')
-        time.sleep(delay)
+        press_named_key('alt')
+        sleep(delay)
 
         logger.debug('Resuming map load')
-        pyautogui.press('alt')
+        press_named_key('alt')
 
         return True
 
@@ -725,28 +812,30 @@ class GameInstanceManager:
         # Open/toggle console
         self.toggle_console()
 
-        # Clear out command input
+        # Clear out command input (select all and delete, fall back to backspaces if that did not clear it)
         attempt = 0
-        max_attempts = 5
+        max_attempts = 6
         while not (ready := self.is_console_ready()) and attempt < max_attempts:
-            pyautogui.press('backspace', presses=pow((attempt + 1), 2), interval=.05)
+            if attempt == 0:
+                clear_text_input()
+            else:
+                press_named_key('backspace', presses=pow(attempt, 2), interval=.05)
             attempt += 1
 
         if not ready:
             return False
 
-        # Write command
-        pyautogui.write(command, interval=.05)
-        time.sleep(.3)
+        # Write command (all at once)
+        type_text(command)
 
         # Read command back
-        written_command = self.get_console_command(len(command))
-        if not is_similar_str(command, written_command.lstrip('>')):
+        if not wait_until(lambda: is_similar_str(command, self.get_console_command(len(command)).lstrip('>')),
+                          timeout=.3, label='console-command'):
             return False
 
         # Hit enter
-        pyautogui.press('enter')
-        time.sleep(.1)
+        press_named_key('enter')
+        sleep(.1)
 
         # X / toggle console
         self.toggle_console()
@@ -765,14 +854,8 @@ class GameInstanceManager:
         don't expect an exact match with the command that was put in)
         """
         # Set screenshot width based on command length (add 5px per character)
-        left, top, right, bottom = self.game_window.rect
         return ocr_screenshot_region(
-            (
-                left + constants.WINDOW_SHADOW_SIZE,
-                top + constants.WINDOW_TITLE_BAR_HEIGHT,
-                right - constants.WINDOW_SHADOW_SIZE - left - constants.WINDOW_SHADOW_SIZE,
-                bottom - constants.WINDOW_SHADOW_SIZE - top - constants.WINDOW_TITLE_BAR_HEIGHT
-            ),
+            get_game_window_region(self.game_window),
             crops=[(
                 constants.COORDINATES[self.resolution]['ocr']['console-command'][0][0],
                 constants.COORDINATES[self.resolution]['ocr']['console-command'][0][1],
@@ -784,12 +867,12 @@ class GameInstanceManager:
     @staticmethod
     def toggle_console() -> None:
         auto_press_key(0x1d)
-        time.sleep(.25)
+        sleep(.25)
 
     @staticmethod
-    def open_spawn_menu(sleep: float = 1.5) -> None:
+    def open_spawn_menu(delay: float = 1.5) -> None:
         auto_press_key(0x1c)
-        time.sleep(sleep)
+        sleep(delay)
 
     def spawn_coordinates_available(self) -> bool:
         map_name = self.state.get_rotation_map_name()
@@ -803,35 +886,27 @@ class GameInstanceManager:
                 (randomize and self.select_random_spawn_point() or (not randomize and self.select_spawn_point())):
             # Hit enter to spawn
             auto_press_key(0x1c)
-            time.sleep(1)
+            sleep(1)
 
             # Re-open spawn menu
             self.open_spawn_menu(.3)
 
-            # Reset cursor again
-            mouse_reset_legacy()
-
             # De-select spawn point
-            mouse_move_to_game_window_coord(self.game_window, self.resolution, 'spawnpoint-deselect', True)
-            time.sleep(0.3)
-            mouse_click_in_game_window(self.game_window, legacy=True)
+            self.click_spawn_menu_coord(*constants.COORDINATES[self.resolution]['clicks']['spawnpoint-deselect'])
 
         # Suicide button may be visible even though we did not detect a spawn as selected
         # e.g. when spectator is still alive from a previous spawn-suicide attempt
         suicide_button_visible = self.is_suicide_button_visible()
         if suicide_button_visible:
-            mouse_reset_legacy()
             # Click suicide button
-            mouse_move_to_game_window_coord(self.game_window, self.resolution, 'suicide-button', True)
-            time.sleep(.3)
-            mouse_click_in_game_window(self.game_window, legacy=True)
-            time.sleep(.5)
+            self.click_spawn_menu_coord(*constants.COORDINATES[self.resolution]['clicks']['suicide-button'])
 
         # Reset mouse again to make sure it does not block any OCR attempts
         mouse_reset_legacy()
 
         # Make sure the button was visible before but is not any longer
-        return suicide_button_visible and not self.is_suicide_button_visible()
+        return suicide_button_visible and \
+            wait_until(lambda: not self.is_suicide_button_visible(), timeout=.5, label='suicide')
 
     def select_spawn_point(self) -> bool:
         # Make sure spawning on map and size is supported
@@ -840,14 +915,9 @@ class GameInstanceManager:
         if not self.spawn_coordinates_available():
             raise SpawnCoordinatesNotAvailableException
 
-        # Reset mouse to top left corner
-        mouse_reset_legacy()
-
         # Select default spawn based on current team
         spawn_coordinates = constants.COORDINATES['spawns'][map_name][map_size][self.state.get_round_team()]
-        mouse_move_legacy(spawn_coordinates[0], spawn_coordinates[1])
-        time.sleep(.3)
-        mouse_click_in_game_window(self.game_window, legacy=True)
+        self.click_spawn_menu_coord(spawn_coordinates[0], spawn_coordinates[1], confirm=self.is_spawn_point_selected)
 
         # Try any alternate spawns if primary one is not available
         alternate_spawns = constants.COORDINATES['spawns'][map_name][str(map_size)][2:]
@@ -861,12 +931,8 @@ class GameInstanceManager:
             # Try to select any of the alternate spawn points
             for coordinates in alternate_spawns:
                 logger.debug(f'Trying spawn coordinates {coordinates}')
-                mouse_reset_legacy()
-                mouse_move_legacy(*coordinates)
-                time.sleep(.1)
-                mouse_click_in_game_window(self.game_window, legacy=True)
-                time.sleep(.1)
-                if self.is_spawn_point_selected():
+                self.click_spawn_menu_coord(*coordinates, delay=.1, confirm=self.is_spawn_point_selected)
+                if wait_until(self.is_spawn_point_selected, timeout=.1, label='alternate-spawn-point'):
                     break
 
         return self.is_spawn_point_selected()
@@ -875,30 +941,104 @@ class GameInstanceManager:
         attempt = 0
         max_attempts = 5
         while not self.is_spawn_point_selected() and attempt < max_attempts:
-            # Reset mouse to top left corner
-            mouse_reset_legacy()
-
             # Try to select a spawn point by randomly clicking on the spawn menu map
             # (use bigger step, since clicking next to a spawn point also works)
             spawn_coordinates = random.randrange(260, 613, 22), random.randrange(50, 403, 22)
-            mouse_move_legacy(spawn_coordinates[0], spawn_coordinates[1])
-            time.sleep(.3)
-            mouse_click_in_game_window(self.game_window, legacy=True)
+            self.click_spawn_menu_coord(spawn_coordinates[0], spawn_coordinates[1],
+                                        confirm=self.is_spawn_point_selected)
 
             attempt += 1
 
         return self.is_spawn_point_selected()
 
+    def click_spawn_menu_coord(self, x: int, y: int, delay: float = .3,
+                               confirm: Optional[Callable[[], bool]] = None) -> None:
+        """
+        Click a target on the spawn menu
+        :param x: horizontal distance of the target from the top left corner (in mickeys)
+        :param y: vertical distance of the target from the top left corner (in mickeys)
+        :param delay: number of seconds to wait between moving the cursor and clicking (legacy mouse mode only)
+        :param confirm: check whether the click selected its target (used to calibrate absolute clicks, which are only
+        used once calibrated)
+        :return:
+        """
+        calibration = MouseCalibration()
+        absolute = Config().get_mouse_mode() == 'absolute' and calibration.is_usable(self.resolution)
+        offset = calibration.get(self.game_window, self.resolution) if absolute else None
+        # A check that is already satisfied cannot confirm anything
+        confirmable = confirm is not None and not confirm()
+        if absolute and offset is None and confirmable:
+            self.__calibrate_absolute_clicks(x, y, confirm)
+            return
+        elif offset is not None:
+            mouse_click_at_legacy_coord(self.game_window, x, y, offset)
+            if not confirmable or wait_until(confirm, timeout=.3, label='absolute-click'):
+                return
+
+        self.__click_spawn_menu_coord_legacy(x, y, delay)
+
+        # The target could be hit, just not via the calibrated absolute click, so calibrate again next time
+        if offset is not None and wait_until(confirm, timeout=.3, label='legacy-click'):
+            calibration.discard(self.game_window, self.resolution)
+
+    def __calibrate_absolute_clicks(self, x: int, y: int, confirm: Callable[[], bool]) -> bool:
+        """
+        Select a target via legacy click, then find the offset for which an absolute click selects the same target
+        (leaves the target selected either way)
+        :param x: horizontal distance of the target from the top left corner (in mickeys)
+        :param y: vertical distance of the target from the top left corner (in mickeys)
+        :param confirm: check whether the target is selected
+        :return: whether an offset was confirmed
+        """
+        self.__click_spawn_menu_coord_legacy(x, y, .3)
+        if not wait_until(confirm, timeout=.3, label='calibration-legacy-click'):
+            # Nothing to compare against if the target cannot be selected (e.g. spawn point not available)
+            return False
+
+        _, reference = screenshot_game_window_region(self.game_window)
+        deselect_coordinates = constants.COORDINATES[self.resolution]['clicks']['spawnpoint-deselect']
+        calibration = MouseCalibration()
+        for offset in calibration.CANDIDATE_OFFSETS:
+            self.__click_spawn_menu_coord_legacy(*deselect_coordinates, .1)
+            if not wait_until(lambda: not confirm(), timeout=.3, label='calibration-deselect'):
+                logger.debug('Failed to de-select target, aborting mouse calibration')
+                return False
+
+            mouse_click_at_legacy_coord(self.game_window, x, y, offset)
+            if not wait_until(confirm, timeout=.3, label='calibration-absolute-click'):
+                continue
+
+            _, screenshot = screenshot_game_window_region(self.game_window)
+            if calibration.is_same_selection(reference, screenshot, calibration.get_target_position(offset, x, y)):
+                calibration.confirm(self.game_window, self.resolution, offset)
+                return True
+
+        calibration.set_unusable(self.resolution)
+
+        # Any absolute click may have selected a different target, so select the target via legacy click again
+        self.__click_spawn_menu_coord_legacy(*deselect_coordinates, .1)
+        self.__click_spawn_menu_coord_legacy(x, y, .3)
+
+        return False
+
+    def __click_spawn_menu_coord_legacy(self, x: int, y: int, delay: float = .3) -> None:
+        # Reset mouse to top left corner, then move it onto the target
+        mouse_reset_legacy()
+        mouse_move_legacy(x, y)
+        sleep(delay)
+        mouse_click_in_game_window(self.game_window, legacy=True)
+
     @staticmethod
     def start_spectating_via_freecam_toggle() -> None:
         auto_press_key(0x39)
-        time.sleep(.2)
+        sleep(.2)
 
     def is_spawn_point_selectable(self) -> bool:
-        return 'select' in ocr_screenshot_game_window_region(
+        return is_label_in_game_window_region(
             self.game_window,
             self.resolution,
             'spawn-selected-text',
+            'select',
             image_ops=[
                 (ImageOperation.grayscale, None),
                 (ImageOperation.colorize, {'black': '#000', 'white': '#fff', 'blackpoint': 30, 'whitepoint': 175}),
@@ -907,10 +1047,11 @@ class GameInstanceManager:
         )
 
     def is_spawn_point_selected(self) -> bool:
-        return 'done' in ocr_screenshot_game_window_region(
+        return is_label_in_game_window_region(
             self.game_window,
             self.resolution,
             'spawn-selected-text',
+            'done',
             image_ops=[
                 (ImageOperation.grayscale, None),
                 (ImageOperation.colorize, {'black': '#000', 'white': '#fff', 'blackpoint': 30, 'whitepoint': 175}),
@@ -919,10 +1060,11 @@ class GameInstanceManager:
         )
 
     def is_suicide_button_visible(self) -> bool:
-        return 'suicide' in ocr_screenshot_game_window_region(
+        return is_label_in_game_window_region(
             self.game_window,
             self.resolution,
             'suicide-button',
+            'suicide',
             image_ops=[
                 (ImageOperation.grayscale, None),
                 (ImageOperation.colorize, {'black': '#000', 'white': '#fff', 'blackpoint': 30, 'whitepoint': 175}),
@@ -933,21 +1075,19 @@ class GameInstanceManager:
     def show_scoreboard(self, duration: float = .5) -> bool:
         # Press tab
         press_key(0x0f)
-        time.sleep(.25)
 
         # Scoreboard should be visible
-        if not self.is_scoreboard_visible():
+        if not wait_until(self.is_scoreboard_visible, timeout=.25, label='scoreboard-open'):
             release_key(0x0f)
             return False
 
-        time.sleep(duration)
+        sleep(duration)
 
         # Release tab
         release_key(0x0f)
-        time.sleep(.25)
 
         # Scoreboard should no longer be visible
-        return not self.is_scoreboard_visible()
+        return wait_until(lambda: not self.is_scoreboard_visible(), timeout=.25, label='scoreboard-close')
 
     def is_scoreboard_visible(self) -> bool:
         for side in ['table-icons-left', 'table-icons-right']:
@@ -958,7 +1098,7 @@ class GameInstanceManager:
 
             delta = calc_cv2_hist_delta(
                 histogram,
-                self.histograms[self.resolution]['scoreboard'][side]
+                self.histograms['scoreboard'][side]
             )
 
             if delta >= constants.HISTCMP_MAX_DELTA:
@@ -969,6 +1109,8 @@ class GameInstanceManager:
     @staticmethod
     def rotate_to_next_player():
         auto_press_key(0x2e)
+        # Any motion sampled so far was sampled on the previous player
+        MotionSampler().reset()
 
     def join_game(self) -> bool:
         if not self.is_join_game_button_visible():
@@ -976,15 +1118,13 @@ class GameInstanceManager:
 
         # Move cursor onto join game button and click
         mouse_move_to_game_window_coord(self.game_window, self.resolution, 'join-game-button')
-        time.sleep(.2)
+        sleep(.2)
         mouse_click_in_game_window(self.game_window, legacy=True)
 
-        time.sleep(.5)
-
-        return not self.is_join_game_button_visible()
+        return wait_until(lambda: not self.is_join_game_button_visible(), timeout=.5, label='join-game')
 
     def close_game_message(self) -> None:
         # Move cursor onto ok button and click
         mouse_move_to_game_window_coord(self.game_window, self.resolution, 'game-message-close-button')
-        time.sleep(.2)
+        sleep(.2)
         mouse_click_in_game_window(self.game_window)
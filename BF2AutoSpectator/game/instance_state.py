@@ -1,6 +1,8 @@
 from datetime import datetime, timedelta
 from typing import Tuple, Optional
 
+from BF2AutoSpectator.common.clock import Clock
+
 
 class GameInstanceState:
     # Global details
@@ -62,13 +64,13 @@ class GameInstanceState:
         return self.__map_loading
 
     def set_active_join_possible(self, after: float):
-        self.__active_join_possible_after = datetime.now() + timedelta(seconds=after)
+        self.__active_join_possible_after = Clock().now() + timedelta(seconds=after)
 
     def active_join_pending(self) -> bool:
         return self.__active_join_possible_after is not None
 
     def active_join_possible(self) -> bool:
-        return self.__active_join_possible_after is not None and datetime.now() > self.__active_join_possible_after
+        return self.__active_join_possible_after is not None and Clock().now() > self.__active_join_possible_after
 
     def increment_round_num(self):
         self.__round_num += 1
@@ -203,12 +205,12 @@ class GameInstanceState:
         # Don't overwrite any existing timestamp
         if self.__halted_since is not None:
             return
-        self.__halted_since = datetime.now() if halted else None
+        self.__halted_since = Clock().now() if halted else None
 
     def halted(self, grace_period: float = 0.0) -> bool:
         if self.__halted_since is None:
             return False
-        return datetime.now() >= self.__halted_since + timedelta(seconds=grace_period)
+        return Clock().now() >= self.__halted_since + timedelta(seconds=grace_period)
 
     # Reset relevant fields after map rotation
     def map_rotation_reset(self):
@@ -1,10 +1,11 @@
 from enum import Enum
-from typing import Union
+from typing import Union, Optional
 
 import socketio
 
 from BF2AutoSpectator.common.commands import CommandStore
 from BF2AutoSpectator.common.logger import logger
+from BF2AutoSpectator.common.recorder import SessionRecorder
 
 
 class GamePhase(str, Enum):
@@ -43,6 +44,7 @@ class ControllerClient:
         @self.sio.on('command')
         def on_command(dto):
             logger.debug(f'Controller issued command {dto["command"]} ({dto["args"]})')
+            SessionRecorder().record_command(dto['command'], dto['args'])
             cs = CommandStore()
             cs.set(dto['command'], dto['args'])
 
@@ -78,6 +80,8 @@ class ControllerClient:
             logger.error(f'Failed to send current server reset to controller ({e})')
 
     def update_game_phase(self, phase: GamePhase, **kwargs: Union[str, int, dict]) -> None:
+        SessionRecorder().record_phase(phase.value)
+
         if not self.sio.connected:
             return
 
@@ -97,3 +101,16 @@ class ControllerClient:
             self.sio.emit('rotate')
         except socketio.client.exceptions.SocketIOError as e:
             logger.error(f'Failed to send player rotation report to controller ({e})')
+
+    def report_afk_scan_decision(self, candidate: int, score: Optional[float], accepted: bool) -> None:
+        if not self.sio.connected:
+            return
+
+        try:
+            self.sio.emit('afk-scan', {
+                'candidate': candidate,
+                'score': score,
+                'accepted': accepted
+            })
+        except socketio.client.exceptions.SocketIOError as e:
+            logger.error(f'Failed to send afk scan decision to controller ({e})')
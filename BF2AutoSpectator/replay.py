@@ -0,0 +1,361 @@
+import argparse
+import bisect
+import collections
+import json
+import os
+import tempfile
+import time
+import zipfile
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+from numpy import ndarray
+
+from BF2AutoSpectator import spectate
+from BF2AutoSpectator.common import constants
+from BF2AutoSpectator.common.capture import CaptureBackend
+from BF2AutoSpectator.common.clock import Clock
+from BF2AutoSpectator.common.exceptions import ClockStoppedException
+from BF2AutoSpectator.common.logger import logger
+from BF2AutoSpectator.common.metrics import Metrics
+from BF2AutoSpectator.common.platform import SimulatedPlatformBackend, Window
+from BF2AutoSpectator.common.recorder import ARCHIVE_VERSION, CHUNK_EVENTS_FILE, INDEX_FILE, get_frame_path
+from BF2AutoSpectator.common.utility import set_platform_backend
+from BF2AutoSpectator.remote import ControllerClient, GamePhase
+
+
+class ReplaySession:
+    """
+    Session recorded by the SessionRecorder, loaded for replaying. Events of all chunks are indexed by time relative to
+    the start of the oldest chunk still on disk (= start of the replay), frames are decoded on demand.
+    """
+    directory: str
+    index: dict
+    meta: dict
+    offset: float
+    duration: float
+
+    frames: Dict[Tuple[int, int, int, int], Tuple[List[float], List[Tuple[str, str]]]]
+    queries: Dict[str, Tuple[List[float], List[Any]]]
+    phases: List[Tuple[float, str]]
+
+    __archives: Dict[str, zipfile.ZipFile]
+    __decoded: 'collections.OrderedDict[str, ndarray]'
+
+    def __init__(self, directory: str, decoded_cache_size: int = 32):
+        self.directory = directory
+        with open(os.path.join(directory, INDEX_FILE), 'r') as f:
+            self.index = json.load(f)
+
+        if self.index.get('version') != ARCHIVE_VERSION:
+            raise ValueError(f'Unsupported session archive version: {self.index.get("version")}')
+        if len(self.index['chunks']) == 0:
+            raise ValueError(f'Session does not contain any chunks: {directory}')
+
+        self.meta = self.index.get('meta', {})
+        self.offset = self.index['chunks'][0]['start']
+        self.duration = self.index['chunks'][-1]['end'] - self.offset
+
+        self.frames = {}
+        self.queries = {}
+        self.phases = []
+        self.__archives = {}
+        self.__decoded = collections.OrderedDict()
+        self.__decoded_cache_size = decoded_cache_size
+
+        for chunk in self.index['chunks']:
+            self.__load_chunk(chunk['file'])
+
+    def __load_chunk(self, filename: str) -> None:
+        archive = zipfile.ZipFile(os.path.join(self.directory, filename), 'r')
+        self.__archives[filename] = archive
+
+        for line in archive.read(CHUNK_EVENTS_FILE).decode('utf-8').splitlines():
+            event = json.loads(line)
+            t = event['t'] - self.offset
+            if event['type'] == 'frame':
+                times, frames = self.frames.setdefault(tuple(event['region']), ([], []))
+                times.append(t)
+                frames.append((filename, event['hash']))
+            elif event['type'] == 'query':
+                times, results = self.queries.setdefault(event['name'], ([], []))
+                times.append(t)
+                results.append(event['result'])
+            elif event['type'] == 'phase':
+                self.phases.append((t, event['phase']))
+
+    def get_frame(self, rect: Tuple[int, int, int, int], t: float) -> Optional[ndarray]:
+        """
+        Get the given screen rect as it was last captured at the given time (or as first captured, if it had not been
+        captured yet at that time)
+        :param rect: screen rect to get, format: (left, top, width, height)
+        :param t: number of seconds since the start of the replay
+        :return: BGR image of the rect, None if no recorded region covers the rect
+        """
+        left, top, width, height = rect
+        latest = None
+        for region, (times, frames) in self.frames.items():
+            r_left, r_top, r_width, r_height = region
+            if not (r_left <= left and r_top <= top and left + width <= r_left + r_width and
+                    top + height <= r_top + r_height):
+                continue
+
+            index = max(bisect.bisect_right(times, t) - 1, 0)
+            if latest is None or times[index] > latest[0]:
+                latest = times[index], region, frames[index]
+
+        if latest is None:
+            return None
+
+        _, (r_left, r_top, _, _), (filename, frame_hash) = latest
+        frame = self.__decode(filename, frame_hash)
+        x, y = left - r_left, top - r_top
+        return frame[y:y + height, x:x + width]
+
+    def __decode(self, filename: str, frame_hash: str) -> ndarray:
+        frame = self.__decoded.get(frame_hash)
+        if frame is not None:
+            self.__decoded.move_to_end(frame_hash)
+            return frame
+
+        encoded = np.frombuffer(self.__archives[filename].read(get_frame_path(frame_hash)), dtype=np.uint8)
+        frame = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+        self.__decoded[frame_hash] = frame
+        if len(self.__decoded) > self.__decoded_cache_size:
+            self.__decoded.popitem(last=False)
+
+        return frame
+
+    def get_query_result(self, name: str, t: float) -> Tuple[bool, Any]:
+        """
+        Get the result a query returned last at the given time (or first, if it had not been made yet at that time)
+        :param name: name of the query function
+        :param t: number of seconds since the start of the replay
+        :return: tuple of whether the query was recorded at all and its result
+        """
+        recorded = self.queries.get(name)
+        if recorded is None:
+            return False, None
+
+        times, results = recorded
+        return True, results[max(bisect.bisect_right(times, t) - 1, 0)]
+
+    def get_time_to_phase(self, phase: str) -> Optional[float]:
+        return next((t for t, p in self.phases if p == phase), None)
+
+    def close(self) -> None:
+        for archive in self.__archives.values():
+            archive.close()
+        self.__archives.clear()
+
+
+class SessionCaptureBackend(CaptureBackend):
+    """
+    Serves frames of a recorded session according to the (virtual) clock instead of capturing the screen
+    """
+    session: ReplaySession
+    missing: int
+
+    def __init__(self, session: ReplaySession):
+        self.session = session
+        self.missing = 0
+
+    def grab(self, region: Tuple[int, int, int, int]) -> ndarray:
+        frame = self.session.get_frame(region, Clock().elapsed())
+        if frame is None:
+            # Region was never captured during the recording (e.g. window position changed), so there is nothing to see
+            self.missing += 1
+            _, _, width, height = region
+            return np.zeros((height, width, 3), dtype=np.uint8)
+
+        return frame
+
+
+class ReplayPlatformBackend(SimulatedPlatformBackend):
+    """
+    Simulated platform answering window and process queries the way they were answered at the same time during the
+    recording
+    """
+    session: ReplaySession
+
+    def __init__(self, session: ReplaySession):
+        super().__init__()
+        self.session = session
+
+    def __get_result(self, name: str) -> Tuple[bool, Any]:
+        recorded, result = self.session.get_query_result(name, Clock().elapsed())
+        if not recorded:
+            logger.debug(f'No recorded results for {name}, answering with simulated platform')
+        return recorded, result
+
+    def __get_window(self) -> Optional[Window]:
+        _, result = self.__get_result('find_window_by_title')
+        if not isinstance(result, dict):
+            return None
+
+        return Window(result['handle'], result['title'], tuple(result['rect']), result['class_name'], result['pid'])
+
+    def find_windows(self) -> List[Window]:
+        window = self.__get_window()
+        return [window] if window is not None else []
+
+    def get_window_rect(self, handle: int) -> Optional[Tuple[int, int, int, int]]:
+        window = self.__get_window()
+        return window.rect if window is not None else None
+
+    def get_cursor_state(self) -> Tuple[bool, Tuple[int, int]]:
+        recorded, on_window = self.__get_result('is_cursor_on_game_window')
+        if not recorded:
+            return super().get_cursor_state()
+
+        # A hidden cursor counts as being on the game window, so either hide it or move it off screen
+        return (False, self.cursor) if on_window else (True, (-1, -1))
+
+    def is_process_responding(self, pid: int) -> bool:
+        recorded, responding = self.__get_result('is_responding_pid')
+        return responding is True if recorded else super().is_process_responding(pid)
+
+    def is_process_running(self, pid: int) -> bool:
+        recorded, running = self.__get_result('is_running_pid')
+        if recorded:
+            return running is True
+
+        # Sessions recorded before process exits were queried only know whether the process responded
+        return self.is_process_responding(pid)
+
+    def get_process_command_line(self, pid: int) -> Optional[List[str]]:
+        recorded, command_line = self.__get_result('get_command_line_by_pid')
+        return command_line if recorded else super().get_process_command_line(pid)
+
+
+class ReplayControllerClient(ControllerClient):
+    """
+    Controller client that never connects, but keeps track of the game phases the spectator went through (and when)
+    """
+    phases: List[Tuple[float, str]]
+
+    def __init__(self):
+        super().__init__('')
+        self.phases = []
+
+    def update_game_phase(self, phase: GamePhase, **kwargs: Union[str, int, dict]) -> None:
+        if len(self.phases) == 0 or self.phases[-1][1] != phase.value:
+            self.phases.append((Clock().elapsed(), phase.value))
+        super().update_game_phase(phase, **kwargs)
+
+
+def install_replay(session: ReplaySession) -> Tuple[ReplayPlatformBackend, SessionCaptureBackend]:
+    """
+    Set up the spectator to replay the session: answer window/process queries with the recorded results, ignore any
+    input and switch to a virtual clock (the returned capture backend serves captures from the session and needs to be
+    passed to the spectator)
+    :param session: session to replay
+    :return: platform backend (counting inputs) and capture backend (counting missing frames) used for the replay
+    """
+    platform = ReplayPlatformBackend(session)
+    set_platform_backend(platform)
+
+    # Passed to the spectator instead of its configured backend
+    backend = SessionCaptureBackend(session)
+
+    started_at = datetime.fromisoformat(session.index['started_at']) + timedelta(seconds=session.offset)
+    # Keep going for a bit after the last recorded event, else the end of the recording could not be reached if the
+    # replayed loop is slower than the recorded one
+    Clock().set_virtual(started_at, session.duration + 30.0)
+
+    return platform, backend
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        prog='BF2AutoSpectator replay',
+        description='Run the spectator against a recorded session (offline and faster than real time, on any OS), '
+                    'measuring time-to-spectate and loop CPU time. Any other arguments are passed to the spectator '
+                    '(e.g. to set detector budgets).'
+    )
+    parser.add_argument('session', help='Path to recorded session directory (containing index.json)', type=str)
+    parser.add_argument('--tesseract-path', help='Path to Tesseract install folder', type=str, default='/usr/bin')
+    parser.add_argument('--ocr-engine', help='How to run Tesseract OCR', choices=['api', 'pytesseract'], type=str,
+                        default='api')
+    parser.add_argument('--max-duration',
+                        help='Max. number of virtual seconds to replay (default: duration of the recording)', type=float)
+    parser.add_argument('--json', dest='json', action='store_true', help='Print results as JSON')
+    parser.set_defaults(json=False)
+    args, spectator_args = parser.parse_known_args()
+
+    session = ReplaySession(args.session)
+    platform, backend = install_replay(session)
+    if args.max_duration is not None:
+        Clock().stop_after = args.max_duration
+
+    cc = ReplayControllerClient()
+    phases = cc.phases
+
+    # Spectator refuses to start without the game's executable, which the replay never launches
+    with tempfile.TemporaryDirectory(prefix=f'{constants.APP_NAME}-replay-') as game_path:
+        open(os.path.join(game_path, constants.BF2_EXE), 'w').close()
+
+        spectator_args = [
+            '--player-name', 'replay',
+            '--player-pass', 'replay',
+            '--server-ip', '127.0.0.1',
+            '--server-mod', session.meta.get('server_mod', 'bf2'),
+            '--game-res', session.meta.get('resolution', '720p'),
+            '--game-path', game_path,
+            '--tesseract-path', args.tesseract_path,
+            '--ocr-engine', args.ocr_engine,
+            # Background sampling runs on real time, take blocking samples (which sleep on the virtual clock) instead
+            '--motion-sample-rate', '0',
+            *spectator_args
+        ]
+
+        started_at, cpu_started_at = time.perf_counter(), time.process_time()
+        try:
+            spectate.run(spectator_args, capture_backend=backend, controller_client=cc)
+        except ClockStoppedException as e:
+            logger.info(f'Replay finished ({e})')
+        except SystemExit as e:
+            logger.info(f'Spectator exited during replay ({e})')
+        wall, cpu = time.perf_counter() - started_at, time.process_time() - cpu_started_at
+    session.close()
+
+    ticks = Metrics().ticks.count
+    spectating = next((t for t, phase in phases if phase == 'spectating'), None)
+    results = {
+        'virtual_seconds': Clock().elapsed(),
+        'wall_seconds': wall,
+        'speedup': Clock().elapsed() / wall if wall > 0 else 0.0,
+        'ticks': ticks,
+        'cpu_seconds': cpu,
+        'cpu_per_tick': cpu / ticks if ticks > 0 else 0.0,
+        'time_to_spectate': spectating,
+        'recorded_time_to_spectate': session.get_time_to_phase('spectating'),
+        'phases': phases,
+        'missing_frames': backend.missing,
+        'inputs': dict(platform.inputs.most_common()),
+        'stages': Metrics().summary()['stages']
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    def format_seconds(seconds: Optional[float]) -> str:
+        return f'{seconds:.2f}s' if seconds is not None else 'never'
+
+    print(f'Replayed {results["virtual_seconds"]:.2f}s in {wall:.2f}s ({results["speedup"]:.1f}x real time)')
+    print(f'Time to spectate: {format_seconds(spectating)} '
+          f'(recorded: {format_seconds(results["recorded_time_to_spectate"])})')
+    print(f'Loop: {ticks} ticks, {cpu:.2f}s CPU, {results["cpu_per_tick"] * 1000:.2f} ms CPU per tick')
+    for stage, stats in results['stages'].items():
+        print(f'  {stage}: {stats["count"]} calls, {stats["total"]:.2f}s total, {stats["per_tick"] * 1000:.2f} ms per tick')
+    print(f'Phases: {", ".join(f"{phase} at {t:.2f}s" for t, phase in phases)}')
+    print(f'Inputs: {", ".join(f"{name} x{count}" for name, count in platform.inputs.most_common())}')
+    if backend.missing > 0:
+        print(f'Frames missing from the recording: {backend.missing}')
+
+
+if __name__ == '__main__':
+    run()
@@ -1,23 +1,42 @@
 import argparse
 import logging
 import os
-import pickle
 import sys
-import time
-from datetime import datetime
+from typing import Optional, List
 
 from BF2AutoSpectator.common import constants
+from BF2AutoSpectator.common.capture import CaptureBackend, DesktopCaptureBackend, GDICaptureBackend
+from BF2AutoSpectator.common.clock import Clock
 from BF2AutoSpectator.common.commands import CommandStore
 from BF2AutoSpectator.common.config import Config
+from BF2AutoSpectator.common.debug import DebugScreenshotWriter
 from BF2AutoSpectator.common.exceptions import SpawnCoordinatesNotAvailableException
+from BF2AutoSpectator.common.labels import LabelMatcher
 from BF2AutoSpectator.common.logger import logger
-from BF2AutoSpectator.common.utility import is_responding_pid, find_window_by_title, taskkill_pid, init_pytesseract
-from BF2AutoSpectator.game import GameInstanceManager, GameMessage
+from BF2AutoSpectator.common.metrics import Metrics
+from BF2AutoSpectator.common.motion import MotionSampler
+from BF2AutoSpectator.common.ocr import OCR, OCRResultCache, create_ocr_engine
+from BF2AutoSpectator.common.recorder import SessionRecorder
+from BF2AutoSpectator.common.references import ReferenceStore
+from BF2AutoSpectator.common.tracing import Tracer
+from BF2AutoSpectator.common.utility import is_responding_pid, find_window_by_title, taskkill_pid, \
+    sleep, invalidate_frame_cache, set_capture_backend, FrameCache
+from BF2AutoSpectator.common.wait import WaitStats, wait_until
+from BF2AutoSpectator.game import GameInstanceManager, GameMessage, Detections, Detector, DetectorScheduler, \
+    DEFAULT_DETECTOR_BUDGETS, get_loop_phase
 from BF2AutoSpectator.remote import ControllerClient, GamePhase, OBSClient
 from BF2AutoSpectator.global_state import GlobalState
 
 
-def run():
+def run(argv: Optional[List[str]] = None, capture_backend: Optional[CaptureBackend] = None,
+        controller_client: Optional[ControllerClient] = None):
+    """
+    Parse arguments and run the spectator
+    :param argv: command line arguments (default: sys.argv)
+    :param capture_backend: capture backend to use instead of the configured one (e.g. to replay a recorded session)
+    :param controller_client: controller client to use instead of one connecting to the configured controller
+    :return:
+    """
     parser = argparse.ArgumentParser(
         prog='BF2AutoSpectator',
         description='Launch and control a Battlefield 2 spectator instance'
@@ -33,8 +52,23 @@ def run():
     parser.add_argument('--game-path', help='Path to BF2 install folder',
                         type=str, default='C:\\Program Files (x86)\\EA Games\\Battlefield 2\\')
     parser.add_argument('--game-res', help='Resolution to use for BF2 window', choices=['720p', '900p'], type=str, default='720p')
+    parser.add_argument('--capture-backend', help='Method to use for capturing the game window',
+                        choices=['desktop', 'gdi'], type=str, default='desktop')
+    parser.add_argument('--mouse-mode', help='How to click spawn menu targets (legacy: reset the cursor and move it '
+                                             'relatively, absolute: single absolute move and click, once it selected '
+                                             'the same spawn point a legacy click did)',
+                        choices=['legacy', 'absolute'], type=str, default='legacy')
     parser.add_argument('--tesseract-path', help='Path to Tesseract install folder',
                         type=str, default='C:\\Program Files\\Tesseract-OCR\\')
+    parser.add_argument('--ocr-engine', help='How to run Tesseract OCR (in-process via its API or via pytesseract, '
+                                             'the API falls back to pytesseract if it cannot be loaded)',
+                        choices=['api', 'pytesseract'], type=str, default='api')
+    parser.add_argument('--ocr-cache-size', help='Number of OCR results to cache by image content (0 = no caching)',
+                        type=int, default=256)
+    parser.add_argument('--ocr-cache-perceptual', dest='ocr_cache_perceptual', action='store_true',
+                        help='Match cached OCR results by perceptual image hash instead of exact image content')
+    parser.add_argument('--no-label-templates', dest='label_templates', action='store_false',
+                        help='Always use OCR to detect menu labels instead of matching them against (learned) templates')
     parser.add_argument('--instance-rtl', help='How many rounds to use a game instance for (rounds to live)', type=int, default=6)
     parser.add_argument('--min-iterations-on-player',
                         help='Number of iterations to stay on a player before allowing the next_player command',
@@ -42,6 +76,47 @@ def run():
     parser.add_argument('--map-load-delay',
                         help='Number of seconds to delay map loading by (think: BF2mld)',
                         type=int, default=5)
+    parser.add_argument('--motion-sample-rate',
+                        help='Samples per second to take of the spectated view in the background to detect AFK players '
+                             '(0 = take blocking samples when checking instead)',
+                        type=float, default=4.0)
+    parser.add_argument('--motion-window', help='Number of seconds to compute the motion score over',
+                        type=float, default=1.5)
+    parser.add_argument('--motion-min-score',
+                        help='Min. motion score (mean pixel difference between samples, 0-1) to consider a player active',
+                        type=float, default=.015)
+    parser.add_argument('--afk-scan-candidates',
+                        help='Number of players to rapidly scan for action after detecting an AFK player '
+                             '(0 = just rotate to the next player, requires background motion sampling)',
+                        type=int, default=3)
+    parser.add_argument('--afk-scan-dwell', help='Max. number of seconds to sample each player for when scanning',
+                        type=float, default=.6)
+    parser.add_argument('--detector-budget',
+                        help='Max. number of seconds to reuse a negative detector result for instead of running the '
+                             'detector again, format: detector=seconds (detectors: '
+                             f'{", ".join(detector.value for detector in Detector)}; defaults: '
+                             f'{", ".join(f"{d.value}={budget:g}" for d, budget in DEFAULT_DETECTOR_BUDGETS.items())})',
+                        type=str, nargs='*', default=[])
+    parser.add_argument('--metrics-port',
+                        help='Local port to serve metrics on in Prometheus text format (0 = do not serve metrics)',
+                        type=int, default=0)
+    parser.add_argument('--metrics-log-interval',
+                        help='Number of seconds between logging a JSON summary of metrics (0 = do not log metrics)',
+                        type=float, default=0)
+    parser.add_argument('--trace', dest='trace', action='store_true',
+                        help='Record spans of screenshots, OCR, histograms, input and sleeps and write them to the '
+                             'debug directory as Chrome Trace Event JSON')
+    parser.add_argument('--trace-flush-ticks',
+                        help='Write a trace file every n loop iterations (0 = only when requested via controller)',
+                        type=int, default=50)
+    parser.add_argument('--record', dest='record', action='store_true',
+                        help='Record captured frames, detector results, input and controller commands to a session '
+                             'archive for offline analysis/replay')
+    parser.add_argument('--record-chunk-size', help='Max. megabytes per session archive chunk',
+                        type=int, default=16)
+    parser.add_argument('--record-quota',
+                        help='Max. megabytes of session archive chunks to keep, oldest get deleted first (0 = no limit)',
+                        type=int, default=2048)
     parser.add_argument('--use-controller', dest='use_controller', action='store_true')
     parser.add_argument('--controller-base-uri', help='Base uri of web controller', type=str)
     parser.add_argument('--control-obs', dest='control_obs', action='store_true')
@@ -50,8 +125,31 @@ def run():
     parser.add_argument('--no-rtl-limit', dest='limit_rtl', action='store_false')
     parser.add_argument('--debug-log', dest='debug_log', action='store_true')
     parser.add_argument('--debug-screenshot', dest='debug_screenshot', action='store_true')
-    parser.set_defaults(limit_rtl=True, debug_log=False, debug_screenshot=False, use_controller=False, control_obs=False)
-    args = parser.parse_args()
+    parser.add_argument('--debug-screenshot-format', help='Format to write debug screenshots as',
+                        choices=DebugScreenshotWriter.FORMATS, type=str, default='jpg')
+    parser.add_argument('--debug-screenshot-quality', help='JPEG quality to write debug screenshots with (0-100)',
+                        type=int, default=95)
+    parser.add_argument('--debug-screenshot-quota',
+                        help='Max. megabytes of debug screenshots to keep on disk, oldest get deleted first (0 = no limit)',
+                        type=int, default=0)
+    parser.add_argument('--debug-screenshot-sample-rate',
+                        help='Only write every nth debug screenshot of a region, format: region=n (use "default" as '
+                             'region to set the rate of all other regions)',
+                        type=str, nargs='*', default=[])
+    parser.set_defaults(limit_rtl=True, ocr_cache_perceptual=False, label_templates=True, trace=False, record=False, debug_log=False, debug_screenshot=False, use_controller=False, control_obs=False)
+    args = parser.parse_args(argv)
+
+    detector_budgets = {}
+    for item in args.detector_budget:
+        detector, _, budget = item.partition('=')
+        if detector not in [detector.value for detector in Detector]:
+            parser.error(f'argument --detector-budget: unknown detector "{detector}" '
+                         f'(choose from {", ".join(detector.value for detector in Detector)})')
+        try:
+            detector_budgets[detector] = float(budget)
+        except ValueError:
+            parser.error(f'argument --detector-budget: invalid budget "{budget}" for {detector} '
+                         f'(format: detector=seconds)')
 
     logger.setLevel(logging.DEBUG if args.debug_log else logging.INFO)
 
@@ -66,6 +164,10 @@ def run():
         server_mod=args.server_mod,
         game_path=args.game_path,
         tesseract_path=args.tesseract_path,
+        ocr_engine=args.ocr_engine,
+        ocr_cache_size=args.ocr_cache_size,
+        ocr_cache_perceptual=args.ocr_cache_perceptual,
+        label_templates=args.label_templates,
         limit_rtl=args.limit_rtl,
         instance_rtl=args.instance_rtl,
         map_load_delay=args.map_load_delay,
@@ -75,7 +177,28 @@ def run():
         obs_url=args.obs_url,
         obs_source_name=args.obs_source_name,
         resolution=args.game_res,
+        capture_backend=args.capture_backend,
+        mouse_mode=args.mouse_mode,
         debug_screenshot=args.debug_screenshot,
+        debug_screenshot_format=args.debug_screenshot_format,
+        debug_screenshot_quality=args.debug_screenshot_quality,
+        debug_screenshot_quota=args.debug_screenshot_quota,
+        debug_screenshot_sample_rates={
+            region: int(rate) for region, rate in (item.split('=', 1) for item in args.debug_screenshot_sample_rate)
+        },
+        motion_sample_rate=args.motion_sample_rate,
+        motion_window=args.motion_window,
+        motion_min_score=args.motion_min_score,
+        afk_scan_candidates=args.afk_scan_candidates,
+        afk_scan_dwell=args.afk_scan_dwell,
+        detector_budgets=detector_budgets,
+        metrics_port=args.metrics_port,
+        metrics_log_interval=args.metrics_log_interval,
+        trace=args.trace,
+        trace_flush_ticks=args.trace_flush_ticks,
+        record=args.record,
+        record_chunk_size=args.record_chunk_size,
+        record_quota=args.record_quota,
         min_iterations_on_player=args.min_iterations_on_player,
         max_iterations_on_player=5,
         max_iterations_on_default_camera_view=6,
@@ -88,20 +211,70 @@ def run():
     elif not os.path.isfile(os.path.join(config.get_game_path(), constants.BF2_EXE)):
         sys.exit(f'Could not find {constants.BF2_EXE} in given game install folder: {config.get_game_path()}')
 
-    # Init pytesseract
-    init_pytesseract(config.get_tesseract_path())
-
-    # Load pickles
-    logger.debug('Loading pickles')
-    with open(os.path.join(config.ROOT_DIR, 'pickle', 'histograms.pickle'), 'rb') as histogramFile:
-        histograms = pickle.load(histogramFile)
+    # Init OCR engine
+    OCR().set_engine(create_ocr_engine(config.get_tesseract_path(), config.get_ocr_engine()))
+    if config.get_ocr_cache_size() > 0:
+        OCR().set_cache(OCRResultCache(config.get_ocr_cache_size(), config.ocr_cache_perceptual()))
+
+    # Init label template matching (templates learned at runtime, plus any placed in the templates folder)
+    if config.label_templates():
+        LabelMatcher().configure([os.path.join(config.ROOT_DIR, 'templates')], Config.TEMPLATE_DIR)
+
+    # Init screen capture backend (unless one was passed in)
+    if capture_backend is None and config.get_capture_backend() == 'gdi':
+        capture_backend = GDICaptureBackend()
+    elif capture_backend is None:
+        capture_backend = DesktopCaptureBackend()
+    set_capture_backend(capture_backend)
+
+    # Load reference histograms (only the active resolution's, categories are read from disk on first use)
+    logger.debug('Loading reference histograms')
+    histograms = ReferenceStore(os.path.join(config.ROOT_DIR, 'references')).load(config.get_resolution())
+
+    # Init detector scheduling (which detector results may be reused for how long)
+    DetectorScheduler().configure(config.get_detector_budgets())
+
+    # Init metrics export (metrics are always recorded)
+    metrics = Metrics()
+    metrics.register_collector('captures', lambda: FrameCache().captures)
+    metrics.register_collector('ocr_calls', lambda: OCR().engine.calls if OCR().engine is not None else 0)
+    if config.get_metrics_port() > 0:
+        metrics.start_server(config.get_metrics_port())
+    if config.get_metrics_log_interval() > 0:
+        metrics.start_log(config.get_metrics_log_interval())
 
     # Init debug directory if debugging is/could be enabled
-    if config.debug_screenshot() or config.use_controller():
+    if config.debug_screenshot() or config.use_controller() or config.trace():
         # Create debug output dir if needed
         if not os.path.isdir(config.DEBUG_DIR):
             os.mkdir(Config.DEBUG_DIR)
 
+        DebugScreenshotWriter().configure(
+            config.DEBUG_DIR,
+            config.get_debug_screenshot_format(),
+            config.get_debug_screenshot_quality(),
+            config.get_debug_screenshot_quota(),
+            config.get_debug_screenshot_sample_rates()
+        )
+
+    # Init session recording
+    if config.record():
+        SessionRecorder().configure(
+            config.RECORDING_DIR,
+            {
+                'app_version': constants.APP_VERSION,
+                'resolution': config.get_resolution(),
+                'capture_backend': config.get_capture_backend(),
+                'server_mod': config.get_server_mod()
+            },
+            config.get_record_chunk_size(),
+            quota_mb=config.get_record_quota()
+        )
+
+    # Init tracing (spans are only recorded if enabled)
+    if config.trace():
+        Tracer().configure(config.DEBUG_DIR, config.get_trace_flush_ticks())
+
     # Init game instance state store
     gim = GameInstanceManager(
         config.get_game_path(),
@@ -111,7 +284,17 @@ def run():
         histograms
     )
     gis = gim.get_state()
-    cc = ControllerClient(
+
+    # Start sampling the spectated view in the background (used to detect AFK players without blocking)
+    if config.get_motion_sample_rate() > 0:
+        MotionSampler().configure(
+            capture_backend,
+            gim.get_spectated_view_region,
+            config.get_motion_sample_rate(),
+            config.get_motion_window()
+        )
+        MotionSampler().start()
+    cc = controller_client if controller_client is not None else ControllerClient(
         config.get_controller_base_uri()
     )
     obsc = OBSClient(
@@ -126,6 +309,11 @@ def run():
     if config.control_obs():
         obsc.connect()
 
+    def report_afk_scan_decision(candidate: int, score: Optional[float], accepted: bool) -> None:
+        # Each scanned candidate means one player rotation
+        cc.report_player_rotation()
+        cc.report_afk_scan_decision(candidate, score, accepted)
+
     # Try to find any existing game instance
     logger.info('Looking for an existing game instance')
     got_instance, correct_params, *_ = gim.find_instance(config.get_server_mod())
@@ -147,6 +335,11 @@ def run():
     gis.set_iterations_on_player(config.get_max_iterations_on_player())
     gs = GlobalState()
     while True:
+        metrics.tick()
+        Tracer().tick()
+        # Any frame captured during the last iteration is outdated by now
+        invalidate_frame_cache()
+
         bf2_window = gim.get_game_window()
         # Try to bring BF2 window to foreground
         if bf2_window is not None and not gis.error_restart_required():
@@ -163,7 +356,7 @@ def run():
             if gis.get_error_unresponsive_count() < 3:
                 logger.info('Unresponsive count below limit, giving time to recover')
                 gis.increment_error_unresponsive_count()
-                time.sleep(2)
+                sleep(2)
                 continue
             else:
                 logger.error('Unresponsive count exceeded limit, scheduling restart')
@@ -173,7 +366,7 @@ def run():
             # Game got it together, reset unresponsive count
             gis.reset_error_unresponsive_count()
             # Wait for a few seconds to let game settle back in
-            time.sleep(3)
+            sleep(3)
 
         # Check for (debug assertion and Visual C++ Runtime) error window
         if not gis.error_restart_required() and \
@@ -265,6 +458,13 @@ def run():
                 logger.setLevel(logging.INFO)
                 config.set_debug_screenshot(False)
 
+        if cs.pop('trace_flush'):
+            if Tracer().enabled:
+                logger.info('Trace flush requested via controller, writing trace file')
+                Tracer().flush()
+            else:
+                logger.info('Tracing is not enabled, ignoring trace flush requested via controller')
+
         if config.control_obs():
             streaming = None
             try:
@@ -279,7 +479,7 @@ def run():
                 logger.info('Stopping OBS stream')
                 try:
                     obsc.stop_stream()
-                    time.sleep(5)
+                    sleep(5)
                 except Exception as e:
                     logger.error(f'Failed to stop OBS stream: {str(e)}')
             elif streaming is False and not (gs.stopped() or gis.halted()) and bf2_window is not None:
@@ -287,7 +487,7 @@ def run():
                 logger.info('Starting OBS stream')
                 try:
                     obsc.start_stream()
-                    time.sleep(5)
+                    sleep(5)
                 except Exception as e:
                     logger.error(f'Failed to start OBS stream: {str(e)}')
 
@@ -313,7 +513,8 @@ def run():
                 killed = taskkill_pid(bf2_window.pid)
                 logger.debug(f'Instance killed: {killed}')
                 # Give Windows time to actually close the window
-                time.sleep(3)
+                wait_until(lambda: find_window_by_title(constants.BF2_WINDOW_TITLE, 'BF2') is None, timeout=3,
+                           poll_interval=.25, label='instance-window-close')
 
             # Run find instance to update (dispose of) current game window reference
             gim.find_instance(config.get_server_mod())
@@ -322,12 +523,13 @@ def run():
             if gs.stopped():
                 cc.reset_current_server()
                 cc.update_game_phase(GamePhase.stopped)
-                time.sleep(30)
+                sleep(30)
                 continue
 
             # Init game new game instance
             logger.info('Starting new game instance')
             cc.update_game_phase(GamePhase.launching)
+            metrics.increment('restarts')
             got_instance, correct_params, running_mod = gim.launch_instance(config.get_server_mod())
 
             """
@@ -375,6 +577,13 @@ def run():
 
             continue
 
+        # Only run the detectors the current phase needs (results are evaluated lazily, in the phase's order),
+        # the if/elif chain below decides what to do and thereby the phase of the next iteration
+        detections = Detections(gim, get_loop_phase(gis))
+
+        # Only capture the regions checked on (almost) every iteration, any other region triggers a full capture
+        detections.set_capture_plan(['game-message-header'])
+
         if gim.is_game_message_visible():
             logger.debug('Game message present, ocr-ing message')
             game_message, raw_message = gim.get_game_message()
@@ -382,7 +591,7 @@ def run():
             if game_message is GameMessage.ServerFull:
                 logger.warning('Server full, trying to rejoin in 20 seconds')
                 gis.set_spectator_on_server(False)
-                time.sleep(20)
+                sleep(20)
             elif game_message is GameMessage.Kicked:
                 logger.warning('Got kicked, trying to rejoin')
                 gis.set_spectator_on_server(False)
@@ -431,7 +640,7 @@ def run():
                     'port': config.get_server_port(),
                     'password': config.get_server_pass()
                 })
-                time.sleep(20)
+                sleep(20)
             else:
                 # There is no clear way to recover without a controller, so just exit
                 sys.exit(1)
@@ -456,7 +665,7 @@ def run():
             loaded when (re-)joining a server. Instead, press ESC once and wait a bit longer. Fail and retry next 
             iteration if menu does not open in time.
             """
-            if (gim.is_in_menu() or gim.open_menu(max_attempts=1, sleep=3.0)) and gim.disconnect_from_server():
+            if (gim.is_in_menu() or gim.open_menu(max_attempts=1, delay=3.0)) and gim.disconnect_from_server():
                 cc.update_game_phase(GamePhase.inMenu)
                 gis.set_spectator_on_server(False)
 
@@ -476,7 +685,7 @@ def run():
             Don't spam press ESC before (re-)joining. It can lead to the game opening the menu again after the map has
             loaded. Instead, press ESC once and wait a bit longer. Fail and restart game if menu does not open in time.
             """
-            if gim.is_in_menu() or gim.open_menu(max_attempts=1, sleep=3.0):
+            if gim.is_in_menu() or gim.open_menu(max_attempts=1, delay=3.0):
                 cc.update_game_phase(GamePhase.inMenu)
             else:
                 logger.error('Game menu is not visible and could not be opened, restart required')
@@ -510,31 +719,36 @@ def run():
 
             continue
 
-        on_round_finish_screen = gim.is_round_end_screen_visible()
-        map_is_loading = gim.is_map_loading()
-        map_briefing_present = gim.is_map_briefing_visible()
-        default_camera_view_visible = gim.is_default_camera_view_visible()
-
         # Update instance state if any map load/eor screen is present
         # (only _set_ map loading state here, since it should only be _unset_ when attempting to spawn
-        if not gis.map_loading() and (on_round_finish_screen or map_is_loading or map_briefing_present):
+        if not gis.map_loading() and \
+                detections.any_detected(Detector.round_end_screen, Detector.map_loading, Detector.map_briefing):
             gis.set_map_loading(True)
+            # Any other detectors now need to be evaluated according to the loading phase
+            detections.set_phase(get_loop_phase(gis))
+
+        on_round_finish_screen = detections.get(Detector.round_end_screen)
 
         # Always reset iteration counter if default camera view is no longer visible
-        if not default_camera_view_visible and gis.get_iterations_on_default_camera_view() > 0:
+        if gis.get_iterations_on_default_camera_view() > 0 and not detections.get(Detector.default_camera_view):
             logger.info('Game is no longer on default camera view, resetting counter')
             gis.reset_iterations_on_default_camera_view()
         if config.limit_rtl() and on_round_finish_screen and gis.get_round_num() >= config.get_instance_trl():
             logger.info('Game instance has reached rtl limit, restart required')
             gis.set_rtl_restart_required(True)
-        elif map_is_loading:
+        elif detections.get(Detector.map_loading):
             logger.info('Map is loading')
             # Reset state once if it still reflected to be "in" the round
             if gis.round_entered():
                 logger.info('Performing map rotation reset')
                 cc.update_game_phase(GamePhase.betweenRounds)
                 gis.map_rotation_reset()
-                time.sleep(6)
+                # Keep the fixed wait here: map load delaying suspends the load relative to this point, so waiting any
+                # shorter (e.g. only until the loading bar shows) would suspend the load earlier than it used to
+                sleep(6)
+                # Log how much time the waits and detectors of the last round actually took
+                WaitStats().log_summary()
+                DetectorScheduler().log_summary()
                 continue
 
             # Suspend/delay map loading to avoid a modified content kick on map switches
@@ -542,11 +756,12 @@ def run():
             if delay > 0 and not gis.rotation_map_load_delayed() and gim.delay_map_load(delay):
                 gis.set_rotation_map_load_delayed(True)
             elif delay == 0 or gis.rotation_map_load_delayed():
-                time.sleep(3)
+                # Map has finished loading once the join game button is visible
+                wait_until(gim.is_join_game_button_visible, timeout=3, poll_interval=.5, label='map-loading')
 
             # Set loading phase *after* between rounds phase to make sure we go spectating -> between rounds -> loading
             cc.update_game_phase(GamePhase.loading)
-        elif map_briefing_present:
+        elif detections.get(Detector.map_briefing):
             logger.info('Map briefing present, checking map')
             map_name, map_size, game_mode = gim.get_map_details()
 
@@ -572,7 +787,7 @@ def run():
             if gis.active_join_possible() and gim.join_game():
                 logger.debug('Entered game by clicking "Join game" button')
 
-            time.sleep(3)
+            wait_until(lambda: not gim.is_map_briefing_visible(), timeout=3, poll_interval=.5, label='map-briefing')
         elif on_round_finish_screen:
             logger.info('Game is on round finish screen')
             # Reset state once if it still reflected to be "in" the round
@@ -596,45 +811,47 @@ def run():
                     gim.join_game()
                     gis.set_spectator_on_server(False)
                 continue
-            time.sleep(3)
-        elif default_camera_view_visible and gis.round_spawned() and \
+            sleep(3)
+        elif detections.get(Detector.default_camera_view) and gis.round_spawned() and \
                 gis.get_iterations_on_default_camera_view() == 0:
             # In rare cases, an AFK/dead player might be detected as the default camera view
             # => try to rotate to next player to "exit" what is detected as the default camera view
             logger.info('Game is on default camera view, trying to rotate to next player')
             gim.rotate_to_next_player()
             gis.increment_iterations_on_default_camera_view()
-            time.sleep(3)
-        elif default_camera_view_visible and gis.round_spawned() and \
+            wait_until(lambda: not gim.is_default_camera_view_visible(), timeout=3, poll_interval=.25,
+                       label='default-camera-view-rotate')
+        elif detections.get(Detector.default_camera_view) and gis.round_spawned() and \
                 gis.get_iterations_on_default_camera_view() < config.get_max_iterations_on_default_camera_view():
             # Default camera view is visible after spawning once, either after a round restart or after the round ended
             logger.info('Game is still on default camera view, waiting to see if round ended')
             gis.increment_iterations_on_default_camera_view()
-            time.sleep(3)
-        elif default_camera_view_visible and gis.round_spawned() and \
+            wait_until(lambda: not gim.is_default_camera_view_visible(), timeout=3, poll_interval=.25,
+                       label='default-camera-view-wait')
+        elif detections.get(Detector.default_camera_view) and gis.round_spawned() and \
                 gis.get_iterations_on_default_camera_view() == config.get_max_iterations_on_default_camera_view():
             # Default camera view has been visible for a while, most likely due to a round restart
             # => try to restart spectating by pressing space (only works on freecam-enabled servers)
             logger.info('Game is still on default camera view, trying to (re-)start spectating via freecam toggle')
             gim.start_spectating_via_freecam_toggle()
             gis.increment_iterations_on_default_camera_view()
-            time.sleep(3)
-        elif default_camera_view_visible and gis.round_spawned() and \
+            wait_until(lambda: not gim.is_default_camera_view_visible(), timeout=3, poll_interval=.25,
+                       label='default-camera-view-freecam')
+        elif detections.get(Detector.default_camera_view) and gis.round_spawned() and \
                 gis.get_iterations_on_default_camera_view() > config.get_max_iterations_on_default_camera_view():
             # Default camera view has been visible for a while, failed to restart spectating by pressing space
             # => spawn-suicide again to restart spectating
             logger.info('Game is still on default camera view, queueing another spawn-suicide to restart spectating')
             gis.set_round_spawned(False)
             gis.reset_iterations_on_default_camera_view()
-        elif default_camera_view_visible and not gis.round_spawned() and not gis.round_freecam_toggle_spawn_attempted():
+        elif detections.get(Detector.default_camera_view) and not gis.round_spawned() and not gis.round_freecam_toggle_spawn_attempted():
             # Try to restart spectating without suiciding on consecutive rounds (only works on freecam-enabled servers)
             logger.info('Game is on default camera view, trying to (re-)start spectating via freecam toggle')
             gis.set_map_loading(False)
             gim.start_spectating_via_freecam_toggle()
             gis.set_round_freecam_toggle_spawn_attempted(True)
-            time.sleep(.5)
             # Set round spawned to true of default camera view is no longer visible, else enable hud for spawn-suicide
-            if not gim.is_default_camera_view_visible():
+            if wait_until(lambda: not gim.is_default_camera_view_visible(), timeout=.5, label='freecam-spawn'):
                 logger.info('Started spectating via freecam toggle, skipping spawn-suicide')
                 cc.update_game_phase(GamePhase.spectating)
                 gis.set_round_spawned(True)
@@ -658,7 +875,7 @@ def run():
             # Re-enable hud if required
             if gis.hud_hidden():
                 # Give game time to swap teams
-                time.sleep(3)
+                sleep(3)
                 # Re-enable hud
                 logger.info('Enabling hud')
                 if not gim.toggle_hud(1):
@@ -667,7 +884,7 @@ def run():
                     continue
                 # Update state
                 gis.set_hud_hidden(False)
-                time.sleep(1)
+                sleep(1)
 
             if not gim.is_spawn_menu_visible():
                 logger.info('Spawn menu not visible, opening with enter')
@@ -751,23 +968,39 @@ def run():
         elif not on_round_finish_screen and gis.get_iterations_on_player() < config.get_max_iterations_on_player() and \
                 not config.player_rotation_paused() and not force_next_player:
             # Check if player is afk
-            if not gim.is_sufficient_action_on_screen():
+            if not gim.is_sufficient_action_on_screen(min_motion_score=config.get_motion_min_score()):
                 logger.info('Insufficient action on screen')
-                gis.set_iterations_on_player(config.get_max_iterations_on_player())
+                if config.get_afk_scan_candidates() > 0 and MotionSampler().is_running():
+                    logger.info(f'Scanning up to {config.get_afk_scan_candidates()} players for action')
+                    if gim.scan_for_active_player(
+                        config.get_afk_scan_candidates(),
+                        config.get_afk_scan_dwell(),
+                        config.get_motion_min_score(),
+                        report_afk_scan_decision
+                    ):
+                        logger.info('Found player with sufficient action on screen')
+                    else:
+                        logger.info('Did not find player with sufficient action on screen, staying on last scanned')
+                    # We just rotated (possibly several times) to a new player either way
+                    gis.reset_iterations_on_player()
+                else:
+                    # Player will be rotated away from in the next iteration
+                    metrics.increment('afk_rotations')
+                    gis.set_iterations_on_player(config.get_max_iterations_on_player())
             else:
                 logger.info('Nothing to do, stay on player')
                 gis.increment_iterations_on_player()
-                time.sleep(2)
+                sleep(2)
         elif not on_round_finish_screen and config.player_rotation_paused() and not force_next_player:
             logger.info(f'Player rotation is paused until {config.get_player_rotation_paused_until().isoformat()}')
             # If rotation pause flag is still set even though the pause expired, remove the flag
-            if config.get_player_rotation_paused_until() < datetime.now():
+            if config.get_player_rotation_paused_until() < Clock().now():
                 logger.info('Player rotation pause expired, re-enabling rotation')
                 config.unpause_player_rotation()
                 # Set counter to max to rotate off current player right away
                 gis.set_iterations_on_player(config.get_max_iterations_on_player())
             else:
-                time.sleep(2)
+                sleep(2)
         elif not on_round_finish_screen:
             logger.info('Rotating to next player')
             gim.rotate_to_next_player()